@@ -1,7 +1,11 @@
 from datetime import date as _pythondate
 from datetime import timedelta, datetime
+import os
 import re
+import tempfile
+import warnings
 from math import sqrt
+from statistics import NormalDist
 
 from abc import ABCMeta, abstractmethod
 import pandas as pd
@@ -197,15 +201,39 @@ class TimePeriod(CummutativeAddition, CummutativeMultiplication):
     unit = property(_get_unit)
 
 
+_iso_date_cache = {}
+iso_date_cache_stats = {'hits' : 0, 'misses' : 0}
+iso_date_cache_size = 100000
+
+def parse_iso_date(bank_date):
+    '''A YYYY-MM-DD string as a date, None if it isn't one. A book only
+    holds a few thousand distinct dates, so each string is parsed once and
+    looked up afterwards. At most iso_date_cache_size dates are kept, the
+    oldest going first, and strings that aren't dates are never kept.'''
+    day = _iso_date_cache.get(bank_date)
+    if day is not None:
+        iso_date_cache_stats['hits'] += 1
+        return day
+    iso_date_cache_stats['misses'] += 1
+    try:
+        day = datetime.strptime(bank_date, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+    if len(_iso_date_cache) >= iso_date_cache_size:
+        del _iso_date_cache[next(iter(_iso_date_cache))]
+    _iso_date_cache[bank_date] = day
+    return day
+
+
 class BankDate(_pythondate):
 
-    def __new__(self, bank_date=_pythondate.today()):
+    def __new__(self, bank_date=None):
         day = None
-        if isinstance(bank_date, str):
-            try:
-                day = datetime.strptime(bank_date, "%Y-%m-%d").date()
-            except:
-                pass
+        if bank_date is None:
+            #Looked up on every call, a default argument would freeze it at import
+            day = _pythondate.today()
+        elif isinstance(bank_date, str):
+            day = parse_iso_date(bank_date)
         elif isinstance(bank_date, _pythondate):
             day = bank_date
         elif isinstance(bank_date, BankDate):
@@ -324,7 +352,7 @@ class BankDate(_pythondate):
             raise BankDateError(
             'The nextday must be  in (-1, 1), not %s of type %s'
             % (nextday, type(nextday)))
-        lst = [BankDate(d).__str__() for d in holidaylist]
+        lst = set(BankDate(d).__str__() for d in holidaylist)
         date = self
         for i in range(30):
             if date.isoweekday() < 6 and str(date) not in lst:
@@ -332,55 +360,56 @@ class BankDate(_pythondate):
             date = date.add_days(nextday)
         return date
 
-    def adjust_to_bankingday(self, daterolling='Actual', holidaylist=()):
-        
+    def _actual_daterolling(self, holidaylist):
+        '''Implement date rolling method Actual, ie no change
+        '''
+        return self
 
-        def actual_daterolling(holidaylist):
-            '''Implement date rolling method Actual, ie no change
-            '''
-            return self
+    def _following_daterolling(self, holidaylist):
+        '''Implement date rolling method Following
+        '''
+        return self.find_next_banking_day(1, holidaylist)
 
-        def following_daterolling(holidaylist):
-            '''Implement date rolling method Following
-            '''
-            return self.find_next_banking_day(1, holidaylist)
+    def _previous_daterolling(self, holidaylist):
+        '''Implement date rolling method Previous
+        '''
+        return self.find_next_banking_day(-1, holidaylist)
 
-        def previous_daterolling(holidaylist):
-            '''Implement date rolling method Previous
-            '''
+    def _modified_following_daterolling(self, holidaylist):
+        '''Implement date rolling method Modified Following
+        '''
+        next_bd = self.find_next_banking_day(1, holidaylist)
+        if self.month == next_bd.month:
+            return next_bd
+        else:
             return self.find_next_banking_day(-1, holidaylist)
 
-        def modified_following_daterolling(holidaylist):
-            '''Implement date rolling method Modified Following
-            '''
-            next_bd = self.find_next_banking_day(1, holidaylist)
-            if self.month == next_bd.month:
-                return next_bd
-            else:
-                return self.find_next_banking_day(-1, holidaylist)
-
-        def modified_previous_daterolling(holidaylist):
-            '''Implement date rolling method Modified Previous
-            '''
-            next_bd = self.find_next_banking_day(-1, holidaylist)
-            if self.month == next_bd.month:
-                return next_bd
-            else:
-                return self.find_next_banking_day(1, holidaylist)
-
-        daterolling_dict = {
-            'Actual':             actual_daterolling,
-            'Following':          following_daterolling,
-            'Previous':           previous_daterolling,
-            'ModifiedFollowing':  modified_following_daterolling,
-            'ModifiedPrevious':   modified_previous_daterolling,
-            }
-        if daterolling in daterolling_dict.keys():
-            return daterolling_dict[daterolling](holidaylist)
+    def _modified_previous_daterolling(self, holidaylist):
+        '''Implement date rolling method Modified Previous
+        '''
+        next_bd = self.find_next_banking_day(-1, holidaylist)
+        if self.month == next_bd.month:
+            return next_bd
+        else:
+            return self.find_next_banking_day(1, holidaylist)
+
+    #Built once with the class rather than on every call
+    daterolling_dict = {
+        'Actual':             _actual_daterolling,
+        'Following':          _following_daterolling,
+        'Previous':           _previous_daterolling,
+        'ModifiedFollowing':  _modified_following_daterolling,
+        'ModifiedPrevious':   _modified_previous_daterolling,
+        }
+
+    def adjust_to_bankingday(self, daterolling='Actual', holidaylist=()):
+        
+        if daterolling in self.daterolling_dict:
+            return self.daterolling_dict[daterolling](self, holidaylist)
         else:
             raise BankDateError(
             'The daterolling must be one of %s, not %s of type %s' \
-            % (daterolling_dict.keys(), daterolling, type(daterolling)))
+            % (self.daterolling_dict.keys(), daterolling, type(daterolling)))
 
     def weekday(self, as_string=False):
         '''
@@ -391,7 +420,7 @@ class BankDate(_pythondate):
         if as_string:
             return self.strftime('%a')
         else:
-            return self.weekday()
+            return super(BankDate, self).weekday()
 
     def first_day_in_month(self):
         ''':Return: first day in month for this BankDate as BankDate
@@ -405,18 +434,11 @@ class BankDate(_pythondate):
 
         reference: http://en.wikipedia.org/wiki/IMM_dates
 
-        :Return: Next IMM date for BankDate as BankDate
+        :Return: Next IMM date after BankDate (the last one before it if not
+                 future) as BankDate
         '''
-        month = self.month
-        if future:
-            add_month = 3 - (month % 3)
-        else:
-            add_month = - ((month % 3) or 3)
-        # First day in imm month
-        out_date = self.first_day_in_month() + '%sm' % add_month
-        add_day = 13 + (9 - out_date.weekday()) % 6
-        out_date += '%sd' % add_day
-        return out_date
+        ordinal = next_roll_dates(self.toordinal(), 'IMM', future)
+        return BankDate(_pythondate.fromordinal(int(ordinal)))
 
     def nbr_of_months(self, date):
         '''
@@ -424,8 +446,9 @@ class BankDate(_pythondate):
         :type date: BankDate
         :return: The number of months between this bankingday and a date
         '''
-        date = BankDate(date)
-        if self.__str__() < date.__str__():
+        if not isinstance(date, _pythondate):
+            date = BankDate(date)
+        if self.toordinal() < date.toordinal():
             date_min, date_max = self, date
             sign = +1
         else:
@@ -446,9 +469,9 @@ class BankDate(_pythondate):
         '''
         nom = self.nbr_of_months(date)
         if nom > 0:
-            return int(nom / 12)
+            return nom // 12
         else:
-            return - int(-nom / 12)
+            return - (-nom // 12)
 
     def nbr_of_days(self, value):
         '''
@@ -464,7 +487,7 @@ class BankDate(_pythondate):
 
 def daterange_iter(
         enddate_or_integer,
-        start_date=BankDate(),
+        start_date=None,
         step='1y',
         keep_start_date=True,
         daterolling='Actual',
@@ -492,7 +515,7 @@ def daterange_iter(
 
 def daterange(
         enddate_or_integer,
-        start_date=BankDate(),
+        start_date=None,
         step='1y',
         keep_start_date=True,
         daterolling='Actual',
@@ -503,7 +526,7 @@ def daterange(
                     keep_start_date, daterolling, holidaylist))
 
 
-def period_count(end_date, start_date=BankDate(), period='1y'):
+def period_count(end_date, start_date=None, period='1y'):
 
     return len(list(daterange_iter(end_date,  start_date, period,  False)))
 
@@ -511,37 +534,401 @@ if __name__ == '__main__':
     import doctest
     doctest.testmod()
 
-def payment_dates(dateval, step):
+_ordinal_epoch = _pythondate(1970, 1, 1).toordinal()
+
+def ordinals_to_datetime64(ordinals):
+    """Python date ordinals (date.toordinal()) as numpy datetime64[D]"""
+    return (np.asarray(ordinals, dtype=np.int64) - _ordinal_epoch).astype('datetime64[D]')
+
+def split_ordinals(ordinals):
+    """Year, month and day arrays for an array of date ordinals"""
+    dates = ordinals_to_datetime64(ordinals)
+    months = dates.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    return (years.astype(np.int64) + 1970,
+            months.astype(np.int64) % 12 + 1,
+            (dates - months).astype(np.int64) + 1)
+
+#Character positions of the digits and dashes in YYYY-MM-DD
+_iso_digit_positions = [0, 1, 2, 3, 5, 6, 8, 9]
+_iso_dash_positions = [4, 7]
+
+def parse_iso_dates(dates):
+    """Ordinals for a whole column of YYYY-MM-DD strings at once.
+    Strings in exactly that layout are read straight off their characters,
+    anything else (dates, unpadded strings) goes through BankDate one by one.
+    Returns the ordinals and a boolean array marking the rows that aren't
+    dates, their ordinals are 0
+    """
+    values = np.asarray(dates, dtype=object).ravel()
+    characters = values.astype('U11').view(np.uint32).reshape(len(values), 11).astype(np.int64)
+    digits = characters[:, _iso_digit_positions] - ord('0')
+    strict = (digits >= 0).all(axis=1) & (digits <= 9).all(axis=1)\
+             & (characters[:, _iso_dash_positions] == ord('-')).all(axis=1) & (characters[:, 10] == 0)
+    years = np.dot(digits[:, :4], [1000, 100, 10, 1])
+    months = np.dot(digits[:, 4:6], [10, 1])
+    days = np.dot(digits[:, 6:], [10, 1])
+    strict &= (years >= 1) & (months >= 1) & (months <= 12) & (days >= 1)
+    month_starts = np.where(strict, (years - 1970) * 12 + months - 1, 0).astype('datetime64[M]')
+    first_days = month_starts.astype('datetime64[D]')
+    strict &= days <= ((month_starts + 1).astype('datetime64[D]') - first_days).astype(np.int64)
+    ordinals = np.where(strict, first_days.astype(np.int64) + days - 1 + _ordinal_epoch, 0)
+    invalid = np.zeros(len(values), dtype=bool)
+    for row in np.flatnonzero(~strict):
+        day = BankDate(values[row]) if isinstance(values[row], (str, _pythondate)) else None
+        if day is None:
+            invalid[row] = True
+        else:
+            ordinals[row] = day.toordinal()
+    return ordinals, invalid
+
+def iso_date_ordinals(dates, column='date'):
+    """parse_iso_dates raising a BankDateError naming the rows that aren't
+    dates"""
+    ordinals, invalid = parse_iso_dates(dates)
+    if invalid.any():
+        rows = np.flatnonzero(invalid)
+        raise BankDateError('Rows %s of %s are not YYYY-MM-DD dates: %s'
+                            % (rows[:10].tolist(), column, list(np.asarray(dates, dtype=object).ravel()[rows[:10]])))
+    return ordinals
+
+def third_wednesdays(month_starts):
+    """Third wednesday of each month, month starts as datetime64[M]"""
+    first_days = month_starts.astype('datetime64[D]')
+    #Day 0 of datetime64 was a thursday, monday is weekday 0
+    weekdays = (first_days.astype(np.int64) + 3) % 7
+    return first_days + (2 - weekdays) % 7 + 14
+
+def twentieths(month_starts):
+    return month_starts.astype('datetime64[D]') + 19
+
+#Roll date conventions: the months (1 to 12) they roll in and the day in
+#those months
+roll_conventions = {
+    'IMM':          ([3, 6, 9, 12], third_wednesdays),
+    'Serial IMM':   (list(range(1, 13)), third_wednesdays),
+    'CDS':          ([3, 6, 9, 12], twentieths),
+    }
+
+#Years the roll date tables run over
+roll_table_years = (1900, 2200)
+
+_roll_date_tables = {}
+
+def roll_date_table(convention='IMM'):
+    """Every roll date of a convention in roll_table_years as sorted
+    ordinals, built the first time it's asked for"""
+    if convention not in roll_conventions:
+        raise BankDateError('The roll convention must be one of %s, not %s of type %s'
+                            % (list(roll_conventions.keys()), convention, type(convention)))
+    if convention not in _roll_date_tables:
+        roll_months, roll_day = roll_conventions[convention]
+        months = np.arange((roll_table_years[0] - 1970) * 12, (roll_table_years[1] - 1970) * 12)
+        months = months[np.isin(months % 12 + 1, roll_months)].astype('datetime64[M]')
+        _roll_date_tables[convention] = roll_day(months).astype(np.int64) + _ordinal_epoch
+    return _roll_date_tables[convention]
+
+def _roll_table_error(table):
+    return BankDateError('Roll dates are only tabulated from %s to %s'
+                         % (_pythondate.fromordinal(int(table[0])), _pythondate.fromordinal(int(table[-1]))))
+
+def roll_dates(start_date, end_date, convention='IMM'):
+    """Ordinals of the roll dates of a convention from start_date to
+    end_date, both included"""
+    table = roll_date_table(convention)
+    start, end = BankDate(start_date).toordinal(), BankDate(end_date).toordinal()
+    if start < table[0] or end > table[-1]:
+        raise _roll_table_error(table)
+    return table[np.searchsorted(table, start, side='left'):np.searchsorted(table, end, side='right')]
+
+def next_roll_dates(ordinals, convention='IMM', future=True):
+    """The first roll date after each ordinal, or the last one before it
+    if not future"""
+    table = roll_date_table(convention)
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if future:
+        positions = np.searchsorted(table, ordinals, side='right')
+    else:
+        positions = np.searchsorted(table, ordinals, side='left') - 1
+    if np.any(positions < 0) or np.any(positions >= len(table)):
+        raise _roll_table_error(table)
+    return table[positions]
+
+#np.busday_offset roll for each BankDate.adjust_to_bankingday date rolling,
+#on a monday to friday week
+busday_rolls = {
+    'Actual':             None,
+    'Following':          'forward',
+    'Previous':           'backward',
+    'ModifiedFollowing':  'modifiedfollowing',
+    'ModifiedPrevious':   'modifiedpreceding',
+    }
+
+_busday_calendars = {}
+busday_calendar_cache_size = 64
+
+def business_day_calendar(holidaylist=()):
+    """numpy business day calendar for a holiday list, holidays that aren't
+    dates are ignored like find_next_banking_day does. At most
+    busday_calendar_cache_size calendars are kept, the oldest going first"""
+    holiday_ordinals, invalid = parse_iso_dates(list(holidaylist))
+    key = tuple(sorted(set(holiday_ordinals[~invalid].tolist())))
+    if key not in _busday_calendars:
+        if len(_busday_calendars) >= busday_calendar_cache_size:
+            del _busday_calendars[next(iter(_busday_calendars))]
+        _busday_calendars[key] = np.busdaycalendar(weekmask='1111100', holidays=ordinals_to_datetime64(list(key)))
+    return _busday_calendars[key]
+
+def adjust_to_bankingdays(ordinals, daterolling='Actual', holidaylist=()):
+    """BankDate.adjust_to_bankingday over an array of ordinals in one call"""
+    if daterolling not in busday_rolls:
+        raise BankDateError('The daterolling must be one of %s, not %s of type %s'
+                            % (busday_rolls.keys(), daterolling, type(daterolling)))
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if busday_rolls[daterolling] is None:
+        return ordinals.copy()
+    rolled = np.busday_offset(ordinals_to_datetime64(ordinals), 0, roll=busday_rolls[daterolling],\
+                              busdaycal=business_day_calendar(holidaylist))
+    return rolled.astype(np.int64) + _ordinal_epoch
+
+def year_fraction_act_365f(start_ordinals, end_ordinals):
+    return (np.asarray(end_ordinals) - np.asarray(start_ordinals)) / 365
+
+def year_fraction_act_360(start_ordinals, end_ordinals):
+    return (np.asarray(end_ordinals) - np.asarray(start_ordinals)) / 360
+
+def year_fraction_act_act_isda(start_ordinals, end_ordinals):
+    """Days falling in each calendar year divided by that year's length"""
+    def year_position(ordinals):
+        dates = ordinals_to_datetime64(ordinals)
+        year_start = dates.astype('datetime64[Y]')
+        days_in_year = ((year_start + 1).astype('datetime64[D]') - year_start.astype('datetime64[D]')).astype(np.int64)
+        return (year_start.astype(np.int64) + 1970,
+                (dates - year_start.astype('datetime64[D]')).astype(np.int64) / days_in_year)
+    start_year, start_part = year_position(start_ordinals)
+    end_year, end_part = year_position(end_ordinals)
+    return end_year - start_year + end_part - start_part
+
+def year_fraction_30_360(start_ordinals, end_ordinals):
+    """30/360 bond basis: day 31 counts as 30, and an end date on the 31st
+    counts as 30 only when the start date is the 30th or 31st
+    """
+    start_year, start_month, start_day = split_ordinals(start_ordinals)
+    end_year, end_month, end_day = split_ordinals(end_ordinals)
+    start_day = np.minimum(start_day, 30)
+    end_day = np.where((end_day == 31) & (start_day == 30), 30, end_day)
+    return (360 * (end_year - start_year) + 30 * (end_month - start_month) + end_day - start_day) / 360
+
+day_count_conventions = {
+    'ACT/365F':      year_fraction_act_365f,
+    'ACT/360':       year_fraction_act_360,
+    'ACT/ACT ISDA':  year_fraction_act_act_isda,
+    '30/360':        year_fraction_30_360,
+    }
+
+def year_fraction(start_ordinals, end_ordinals, day_count_convention='ACT/365F'):
+    """Year fractions between arrays (or scalars) of date ordinals"""
+    if day_count_convention in day_count_conventions:
+        return day_count_conventions[day_count_convention](start_ordinals, end_ordinals)
+    else:
+        raise BankDateError(
+        'The day count convention must be one of %s, not %s of type %s' \
+        % (list(day_count_conventions.keys()), day_count_convention, type(day_count_convention)))
+
+def years_to_maturity(maturity_dates, day_count_convention='ACT/365F', as_of=None):
+    """Remaining maturity in years of one or more maturity dates, seen from
+    as_of (default today)
+    """
+    maturity_ordinals = iso_date_ordinals(np.atleast_1d(maturity_dates), 'maturity_date')
+    return year_fraction(BankDate(as_of).toordinal(), maturity_ordinals, day_count_convention)
+
+def _periodic_compounding(frequency):
+    def compounding(rates, years):
+        rates = np.asarray(rates, dtype=np.float64) / 100
+        years = np.asarray(years, dtype=np.float64)
+        return np.exp(-frequency * years * np.log1p(rates / frequency)), 1 + rates / frequency, 1 / frequency
+    return compounding
+
+def continuous_compounding(rates, years):
+    rates = np.asarray(rates, dtype=np.float64) / 100
+    return np.exp(-rates * np.asarray(years, dtype=np.float64)), 1.0, 0.0
+
+def simple_compounding(rates, years):
+    years = np.asarray(years, dtype=np.float64)
+    growth = 1 + np.asarray(rates, dtype=np.float64) / 100 * years
+    return 1 / growth, growth, years
+
+#Compounding periods a year, inf for continuous and 0 for simple interest
+compounding_frequencies = {
+    'Continuous':   np.inf,
+    'Annual':       1,
+    'Semiannual':   2,
+    'Quarterly':    4,
+    'Monthly':      12,
+    'Daily':        365,
+    'Simple':       0,
+    }
+
+compounding_conventions = dict((name, continuous_compounding if frequency == np.inf else\
+                                simple_compounding if frequency == 0 else _periodic_compounding(frequency))\
+                               for name, frequency in compounding_frequencies.items())
+
+def discount_kernel(rates, year_fractions, compounding='Daily'):
+    """Discount factors for discount rates (percent) over year fractions,
+    plus the growth and step terms duration and convexity need, so one set
+    of factors serves value, duration and convexity. With pv = cf * factor
+    and P the sum of the pvs
+        modified duration = sum(pv * t / growth) / P
+        convexity         = sum(pv * t*(t + step) / growth**2) / P
+    Compounding n times a year discounts by exp(-n*t*log1p(y/n)) with
+    growth 1 + y/n and step 1/n, which stays accurate for daily
+    compounding where (1 + y/365) loses digits
+    """
+    if compounding in compounding_conventions:
+        return compounding_conventions[compounding](rates, year_fractions)
+    else:
+        raise CashFlowError(
+        'The compounding must be one of %s, not %s of type %s' \
+        % (list(compounding_conventions.keys()), compounding, type(compounding)))
+
+def payment_dates(dateval, step, as_of=None):
     #step = (input('How often does this instrument pay a cash flow?  '))
     #Steps in number of months or years
     # e.g. '6m', '3m', '2y'
+    #or the payments per year, stepped like payment_schedule
     #dateval = BankDate(input('What is the maturity date of this instrument?   '))
     #dateval as maturity date of instrument
-    new_dates = []
-    for date in daterange(dateval, step ='6m'):
-        if datetime.weekday(date) == 6:
-            date = date + '1d'
-            new_dates.append(date)
-        elif datetime.weekday(date) == 5:
-            date = date + '2d'
-            new_dates.append(date)
-        else:
-            new_dates.append(date)
-    return(new_dates)
+    if not isinstance(step, str):
+        step = '%sm' % payment_period_months(step)
+    unrolled_ordinals = [date.toordinal() for date in daterange(dateval, start_date = as_of, step = step)]
+    return [BankDate(_pythondate.fromordinal(int(ordinal)))\
+            for ordinal in adjust_to_bankingdays(unrolled_ordinals, 'Following')]
 
-def days_to_payment(mat_date, pay_step):
+def days_to_payment(mat_date, pay_step, as_of=None):
     #
     #
     step = pay_step
     dateval = mat_date
-    new_dates = payment_dates(dateval, step)
+    new_dates = payment_dates(dateval, step, as_of)
+    valuation_date = BankDate(as_of)
     days_to_payment = []
     for date in new_dates:
-        days = BankDate().nbr_of_days(date)
+        days = valuation_date.nbr_of_days(date)
         days_to_payment.append(days)
     return (days_to_payment)    
 
-def value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type):
+key_rate_tenors = ['2yr', '5yr', '10yr', '20yr']
+
+def key_rate_weights(bond_maturity_remaining):
+    """Weights value_bond puts on the 2/5/10/20yr rates for the given
+    remaining maturities in years (scalar or array), one column per tenor
+    in key_rate_tenors. Linear interpolation between the neighbouring
+    tenors, the nearer one weighted more, flat beyond 2yr and 20yr, so the
+    weights always sum to one. The discount rate is linear in the key rates
+    so a key rate bump moves a bond's rate by weight * bump
+    """
+    maturity = np.atleast_1d(np.asarray(bond_maturity_remaining, dtype=np.float64))
+    weights = np.zeros((len(maturity), len(key_rate_tenors)))
+    under_two = maturity < 2
+    two_five = (2 <= maturity) & (maturity < 5)
+    five_ten = (5 <= maturity) & (maturity < 10)
+    ten_twenty = (10 <= maturity) & (maturity < 20)
+    over_twenty = 20 <= maturity
+    weights[under_two, 0] = 1.0
+    weights[two_five, 0] = (5 - maturity[two_five]) / 3
+    weights[two_five, 1] = (maturity[two_five] - 2) / 3
+    weights[five_ten, 1] = (10 - maturity[five_ten]) / 5
+    weights[five_ten, 2] = (maturity[five_ten] - 5) / 5
+    weights[ten_twenty, 2] = (20 - maturity[ten_twenty]) / 10
+    weights[ten_twenty, 3] = (maturity[ten_twenty] - 10) / 10
+    weights[over_twenty, 3] = 1.0
+    return weights
+
+def key_rates_by_rating(bond_ratings, discount_rates):
+    """Key rate quotes for each rating, one row per rating, one column per
+    tenor. Tenors not quoted for a rating come back as nan
+    """
+    rates = np.full((len(bond_ratings), len(key_rate_tenors)), np.nan)
+    for i, bond_rating in enumerate(bond_ratings):
+        for j, tenor in enumerate(key_rate_tenors):
+            column = str(tenor + '_' + str(bond_rating))
+            if column in discount_rates.columns:
+                rates[i, j] = discount_rates[column].iloc[0]
+    return rates
+
+def interpolated_discount_rate(bond_maturity_remaining, bond_rating, discount_rates):
+    weights = key_rate_weights(bond_maturity_remaining)[0]
+    rates = key_rates_by_rating([bond_rating], discount_rates)[0]
+    return np.dot(weights[weights != 0], rates[weights != 0])
+
+def payment_period_months(payments_per_year):
+    """Months between coupon dates, zero coupon bonds keep the semiannual grid"""
+    if not payments_per_year:
+        return 6
+    if 12 % payments_per_year:
+        raise BankDateError('Can not build a schedule paying %s times a year' % payments_per_year)
+    return int(12 // payments_per_year)
+
+_payment_schedule_cache = {}
+payment_schedule_cache_size = 20000
+valuation_dates_per_schedule = 32
+payment_schedule_cache_stats = {'hits' : 0, 'misses' : 0}
+
+def payment_schedule(maturity_date, payments_per_year, day_count_convention='ACT/365F', as_of=None):
+    """Payment dates (as ordinals) after the valuation date as_of (default
+    today) with the days and year fractions to each.
+    The dates only depend on the maturity and frequency, so they're built
+    once (from the earliest valuation date asked for) and every later
+    valuation date just drops the flows already paid. Year fractions are
+    worked out once per valuation date and day count convention.
+    At most payment_schedule_cache_size schedules, each with its latest
+    valuation_dates_per_schedule valuation dates, are kept, the oldest
+    going first
+    """
+    valuation_ordinal = BankDate(as_of).toordinal()
+    key = (str(maturity_date), payments_per_year)
+    schedule = _payment_schedule_cache.get(key)
+    if schedule is None or schedule['start_ordinal'] > valuation_ordinal:
+        payment_schedule_cache_stats['misses'] += 1
+        #Rolled like payment_dates, Saturdays and Sundays go to the Monday
+        period_months = payment_period_months(payments_per_year)
+        unrolled_dates = daterange(maturity_date, start_date = as_of, step = '%sm' % period_months,\
+                                   keep_start_date = False)
+        unrolled_ordinals = np.array([date.toordinal() for date in unrolled_dates], dtype=np.int64)
+        ordinals = adjust_to_bankingdays(unrolled_ordinals, 'Following')
+        #The coupon date before the first one is where the first coupon starts accruing
+        previous_coupon_date = (BankDate(maturity_date) + '-%sm' % (period_months * len(ordinals)))\
+                               .adjust_to_bankingday('Following')
+        schedule = {'start_ordinal' : valuation_ordinal,
+                    'unrolled_ordinals' : unrolled_ordinals,
+                    'ordinals' : ordinals,
+                    'accrual_start_ordinals' : np.concatenate(([previous_coupon_date.toordinal()], ordinals[:-1])),
+                    'as_of' : {}}
+        _payment_schedule_cache.pop(key, None)
+        if len(_payment_schedule_cache) >= payment_schedule_cache_size:
+            del _payment_schedule_cache[next(iter(_payment_schedule_cache))]
+        _payment_schedule_cache[key] = schedule
+    else:
+        payment_schedule_cache_stats['hits'] += 1
+    if valuation_ordinal not in schedule['as_of']:
+        if len(schedule['as_of']) >= valuation_dates_per_schedule:
+            del schedule['as_of'][next(iter(schedule['as_of']))]
+        outstanding = schedule['unrolled_ordinals'] > valuation_ordinal
+        ordinals = schedule['ordinals'][outstanding]
+        schedule['as_of'][valuation_ordinal] = {'valuation_ordinal' : valuation_ordinal,
+                                                'unrolled_ordinals' : schedule['unrolled_ordinals'][outstanding],
+                                                'ordinals' : ordinals,
+                                                'accrual_start_ordinals' : schedule['accrual_start_ordinals'][outstanding],
+                                                'days' : ordinals - valuation_ordinal,
+                                                'year_fractions' : {}}
+    valuation_schedule = schedule['as_of'][valuation_ordinal]
+    if day_count_convention not in valuation_schedule['year_fractions']:
+        valuation_schedule['year_fractions'][day_count_convention] = \
+            year_fraction(valuation_ordinal, valuation_schedule['ordinals'], day_count_convention)
+    return valuation_schedule
+
+def value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+               day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
     pv_fcf = []
     """face_value = float(input('What is the face value?   '))
     maturity_date = BankDate(input('On what date does the bond mature YYYY-MM-DD?   '))
@@ -553,61 +940,24 @@ def value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_ratin
     discount_rates = yesterdays_yield_close_values_corp
     #else:
     #    discount_rate = yesterdays_yield_close_values_notcorp[bond_rating]
-    bond_maturity_remaining = (BankDate().nbr_of_days(maturity_date))/365
-    if bond_maturity_remaining < 2:
-        two_string = str('2yr_' + str(bond_rating))
-        disc_rate_two = discount_rates.at[0,two_string]
-        disc_rate_under_two = disc_rate_two * (2 / 3)
-        discount_rate = disc_rate_under_two
-
-    elif 2 < bond_maturity_remaining < 5:
-        proportion_two_year_rate = (bond_maturity_remaining - 2)/3
-        proportion_five_year_rate = (5 - bond_maturity_remaining)/3
-        two_string = str('2yr_' + str(bond_rating))
-        five_string = str('5yr_' + str(bond_rating))
-        disc_rate_two = discount_rates.at[0,two_string]
-        disc_rate_five = discount_rates.at[0,five_string]
-        discount_rate = disc_rate_two * proportion_two_year_rate + disc_rate_five * proportion_five_year_rate
-
-    elif 5 < bond_maturity_remaining < 10:
-        proportion_five_year_rate = (bond_maturity_remaining - 5)/5
-        proportion_ten_year_rate = (10 - bond_maturity_remaining)/5
-        five_string = str('5yr_' + str(bond_rating))
-        ten_string = str('10yr_' + str(bond_rating))
-        disc_rate_five = discount_rates.at[0,five_string]
-        disc_rate_ten = discount_rates.at[0,ten_string]
-        discount_rate = disc_rate_five * proportion_five_year_rate + disc_rate_ten * proportion_ten_year_rate
-
-    elif 10 < bond_maturity_remaining < 20:
-        proportion_ten_year_rate = (bond_maturity_remaining - 10)/10
-        proportion_twenty_year_rate = (20 - bond_maturity_remaining)/10
-        ten_string = str('10yr_' + str(bond_rating))
-        twenty_string = str('20yr_' + str(bond_rating))
-        disc_rate_ten = discount_rates.at[0,ten_string]
-        disc_rate_twenty = discount_rates.at[0,twenty_string]
-        discount_rate = disc_rate_ten * proportion_ten_year_rate + disc_rate_twenty * proportion_twenty_year_rate
-
-    elif 20 < bond_maturity_remaining:
-        twenty_string = str('20yr_' + str(bond_rating))
-        disc_rate_twenty = discount_rates.at[0,twenty_string]
-        disc_rate_over_twenty = disc_rate_twenty * (6 / 5)
-
-
-    payment_step = str(payments_per_year/12) + 'm'
+    bond_maturity_remaining = years_to_maturity(maturity_date, day_count_convention, as_of)[0]
+    discount_rate = interpolated_discount_rate(bond_maturity_remaining, bond_rating, discount_rates)
+
     if payments_per_year == 0:
         coupon_payment = 0
     else:
         coupon_payment = ((coupon_rate/100)*face_value)/payments_per_year
-    days_to_payments = days_to_payment(maturity_date,payment_step)
-    del days_to_payments[0]
+    schedule = payment_schedule(maturity_date,payments_per_year,day_count_convention,as_of)
+    days_to_payments = schedule['days'].tolist()
+    discount_factors = discount_kernel(discount_rate, schedule['year_fractions'][day_count_convention],\
+                                       compounding)[0].tolist()
     #print (days_to_payments)
-    for day_count in days_to_payments:
+    for day_count, discount_factor in zip(days_to_payments, discount_factors):
         if day_count == max(days_to_payments):
-            pv_cf = (coupon_payment + face_value)\
-            /((1+(discount_rate/100/365))**day_count)
+            pv_cf = (coupon_payment + face_value) * discount_factor
             pv_fcf.append(pv_cf)
         elif day_count != 0 and day_count != max(days_to_payments):
-            pv_cf = coupon_payment/((1+(discount_rate/100/365))**day_count)
+            pv_cf = coupon_payment * discount_factor
             pv_fcf.append(pv_cf)
         else:
             pass
@@ -617,24 +967,25 @@ def value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_ratin
     #print('Bond Value:' + str(bond_val))
     return (bond_val, pv_fcf, days_to_payments, bond_maturity_remaining, discount_rate)
 
-def value_bond_var(face_value,maturity_date,coupon_rate,payments_per_year,discount_rate):
+def value_bond_var(face_value,maturity_date,coupon_rate,payments_per_year,discount_rate,\
+                   day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
     pv_fcf = []
-    bond_maturity_remaining = (BankDate().nbr_of_days(maturity_date))/365
-    payment_step = str(payments_per_year/12) + 'm'
+    bond_maturity_remaining = years_to_maturity(maturity_date, day_count_convention, as_of)[0]
     if payments_per_year == 0:
         coupon_payment = 0
     else:
         coupon_payment = ((coupon_rate/100)*face_value)/payments_per_year
-    days_to_payments = days_to_payment(maturity_date,payment_step)
-    del days_to_payments[0]
+    schedule = payment_schedule(maturity_date,payments_per_year,day_count_convention,as_of)
+    days_to_payments = schedule['days'].tolist()
+    discount_factors = discount_kernel(discount_rate, schedule['year_fractions'][day_count_convention],\
+                                       compounding)[0].tolist()
     #print (days_to_payments)
-    for day_count in days_to_payments:
+    for day_count, discount_factor in zip(days_to_payments, discount_factors):
         if day_count == max(days_to_payments):
-            pv_cf = (coupon_payment + face_value)\
-            /((1+(discount_rate/100/365))**day_count)
+            pv_cf = (coupon_payment + face_value) * discount_factor
             pv_fcf.append(pv_cf)
         elif day_count != 0 and day_count != max(days_to_payments):
-            pv_cf = coupon_payment/((1+(discount_rate/100/365))**day_count)
+            pv_cf = coupon_payment * discount_factor
             pv_fcf.append(pv_cf)
         else:
             pass
@@ -646,57 +997,69 @@ def generate_portfolio(csv_location):
                        header = 0,\
                        delimiter = ',',\
                        converters = {'face_value':np.float64,'maturity_date':str,'coupon_rate':np.float64,\
-                                     'payments_per_year':np.float64,'bond_rating':str,'bond_type':str
+                                     'payments_per_year':np.float64,'bond_rating':str,'bond_type':str,\
+                                     'coupon_type':str,'principal_type':str,'issue_date':str,\
+                                     'sinking_fund_start':str,'call_date':str,'put_date':str
                                     }
                        )
     return portfolio
 
-def value_portfolio(csv_location):
+def value_portfolio(csv_location, day_count_convention='ACT/365F', as_of=None, compounding='Daily'):
     #csv_location = str(input('What is the file path?'))
     bond_val_portfolio = []
     bond_maturity_set = []
     portfolio = generate_portfolio(csv_location)
     for bond in zip(portfolio['face_value'],portfolio['maturity_date'],portfolio['coupon_rate'],\
                    portfolio['payments_per_year'],portfolio['bond_rating'],portfolio['bond_type']):
-        bond_val = value_bond(*bond)[0]
-        bond_maturity_set.append(value_bond(*bond)[3])
+        bond_val = value_bond(*bond, day_count_convention=day_count_convention, as_of=as_of, compounding=compounding)[0]
+        bond_maturity_set.append(value_bond(*bond, day_count_convention=day_count_convention, as_of=as_of,\
+                                            compounding=compounding)[3])
         bond_val_portfolio.append(bond_val)
     portfolio_val = sum(bond_val_portfolio)
     #print ('Portfolio Value:',portfolio_val)
     return (portfolio_val, bond_val_portfolio, bond_maturity_set)
 
-def duration_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type):
-    value_bond_output_db = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)
+def duration_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                  day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    value_bond_output_db = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                                    day_count_convention,as_of,compounding)
     days_to_payments = value_bond_output_db[2]
     pv_fcf = value_bond_output_db[1]
     bond_val = value_bond_output_db[0]
     intermediate_dur_calcs = []
-    years_to_payments = [ days / 365 for days in days_to_payments ]
+    years_to_payments = payment_schedule(maturity_date,payments_per_year,day_count_convention,as_of)\
+                        ['year_fractions'][day_count_convention].tolist()
     #print(years_to_payments)
-    cfs = list(zip(pv_fcf,years_to_payments))
+    growth = np.broadcast_to(discount_kernel(value_bond_output_db[4], years_to_payments, compounding)[1],\
+                             len(years_to_payments)).tolist()
+    intermediate_mm_dur_calcs = []
+    cfs = list(zip(pv_fcf,years_to_payments,growth))
     for cf in cfs:
         inter_dur_calc = cf[0]*cf[1]
         intermediate_dur_calcs.append(inter_dur_calc)
+        intermediate_mm_dur_calcs.append(inter_dur_calc/cf[2])
         
     #print(intermediate_dur_calcs)
     #print(sum(intermediate_dur_calcs))
     bond_duration = sum(intermediate_dur_calcs)/bond_val
-    mm_duration = bond_duration/(1 + value_bond_output_db[4] / 100)
+    mm_duration = sum(intermediate_mm_dur_calcs)/bond_val
     #print('Bond Duration: ',bond_duration, 'Modified Duration',mm_duration)
     return {'Bond Duration' : bond_duration, 'Modified Duration' : mm_duration}
 
-def portfolio_duration(csv_location):
+def portfolio_duration(csv_location, day_count_convention='ACT/365F', as_of=None, compounding='Daily'):
     bond_dur_portfolio=[]
     mm_bond_dur_portfolio=[]
     weighted_bond_dur_portfolio = []
     weighted_mm_bond_dur_portfolio = []
     portfolio = generate_portfolio(csv_location)
-    val_portfolio_output = value_portfolio(csv_location)
+    val_portfolio_output = value_portfolio(csv_location, day_count_convention, as_of, compounding)
     for bond in zip(portfolio['face_value'],portfolio['maturity_date'],portfolio['coupon_rate'],\
                    portfolio['payments_per_year'],portfolio['bond_rating'],portfolio['bond_type']):
-        bond_dur = duration_bond(*bond)['Bond Duration']
+        bond_dur = duration_bond(*bond, day_count_convention=day_count_convention, as_of=as_of,\
+                                 compounding=compounding)['Bond Duration']
         bond_dur_portfolio.append(bond_dur)
-        mm_bond_dur = duration_bond(*bond)['Modified Duration']
+        mm_bond_dur = duration_bond(*bond, day_count_convention=day_count_convention, as_of=as_of,\
+                                    compounding=compounding)['Modified Duration']
         mm_bond_dur_portfolio.append(mm_bond_dur)
     bond_dur_val_zip = list(zip(bond_dur_portfolio,val_portfolio_output[1],mm_bond_dur_portfolio))
     for group in bond_dur_val_zip:
@@ -709,36 +1072,42 @@ def portfolio_duration(csv_location):
     #print ('Portfolio Duration:',portfolio_dur,'Modified Portfolio Duration:',mm_portfolio_dur)
     return {'Portfolio Duration' : portfolio_dur, 'Modified Portfolio Duration' : mm_portfolio_dur}
 
-def convexity_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type):
-    value_bond_output_cb = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)
+def convexity_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                   day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    value_bond_output_cb = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                                    day_count_convention,as_of,compounding)
     days_to_payments = value_bond_output_cb[2]
     pv_fcf = value_bond_output_cb[1]
     bond_val = value_bond_output_cb [0]
     intermediate_conv_calcs = []
     start_int = 1
-    years_to_payments = [days/365 for days in days_to_payments]
-    cfs = list(zip(pv_fcf,years_to_payments))
+    years_to_payments = payment_schedule(maturity_date,payments_per_year,day_count_convention,as_of)\
+                        ['year_fractions'][day_count_convention].tolist()
+    growth, step = discount_kernel(value_bond_output_cb[4], years_to_payments, compounding)[1:]
+    growth = np.broadcast_to(growth, len(years_to_payments)).tolist()
+    step = np.broadcast_to(step, len(years_to_payments)).tolist()
+    cfs = list(zip(pv_fcf,years_to_payments,growth,step))
     for pv_cf in cfs:
-        inter_conv_calc =  (pv_cf[0])*(pv_cf[1]**2+pv_cf[1])
+        inter_conv_calc =  (pv_cf[0])*pv_cf[1]*(pv_cf[1]+pv_cf[3]) / pv_cf[2]**2
         start_int = start_int +1
         intermediate_conv_calcs.append(inter_conv_calc)
         #print(inter_conv_calc)
         
     #print(intermediate_conv_calcs)
     #print(sum(intermediate_conv_calcs))
-    bond_convexity = sum(intermediate_conv_calcs) / \
-                    ( bond_val * ( 1 + value_bond_output_cb[4] / 100) **2 )
+    bond_convexity = np.sum(intermediate_conv_calcs) / bond_val
     #print('Bond Convexity: ',bond_convexity)
     return bond_convexity
 
-def convexity_portfolio(csv_location):
+def convexity_portfolio(csv_location, day_count_convention='ACT/365F', as_of=None, compounding='Daily'):
     bond_conv_portfolio = []
     weighted_bond_conv_portfolio = []
     portfolio = generate_portfolio(csv_location)
-    val_portfolio_output = value_portfolio(csv_location)
+    val_portfolio_output = value_portfolio(csv_location, day_count_convention, as_of, compounding)
     for bond in zip(portfolio['face_value'],portfolio['maturity_date'],portfolio['coupon_rate'],\
                    portfolio['payments_per_year'],portfolio['bond_rating'],portfolio['bond_type']):
-        bond_conv = convexity_bond(*bond)
+        bond_conv = convexity_bond(*bond, day_count_convention=day_count_convention, as_of=as_of,\
+                                   compounding=compounding)
         bond_conv_portfolio.append(bond_conv)
     bond_conv_val_zip = list(zip(bond_conv_portfolio,val_portfolio_output[1]))
     for entry in bond_conv_val_zip:
@@ -747,6 +1116,512 @@ def convexity_portfolio(csv_location):
     portfolio_convexity = sum(weighted_bond_conv_portfolio)
     return portfolio_convexity
 
+def single_bond_portfolio(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type):
+    """One row portfolio frame, laid out like generate_portfolio output"""
+    return pd.DataFrame({'face_value':[face_value],'maturity_date':[maturity_date],\
+                         'coupon_rate':[coupon_rate],'payments_per_year':[payments_per_year],\
+                         'bond_rating':[bond_rating],'bond_type':[bond_type]})
+
+def portfolio_key_rates(bond_ratings, discount_rates):
+    """Key rate quotes for every bond, looked up once per rating"""
+    unique_ratings = sorted(set(bond_ratings))
+    rating_rates = key_rates_by_rating(unique_ratings, discount_rates)
+    rating_numbers = dict((rating, i) for i, rating in enumerate(unique_ratings))
+    return rating_rates[[rating_numbers[rating] for rating in bond_ratings]]
+
+class CashFlowError(Exception):
+    '''A class to implement error messages from the cash flow buffer.'''
+    pass
+
+def months_difference(start_ordinals, end_ordinals):
+    """BankDate.nbr_of_months over arrays of ordinals: whole months between
+    the earlier and the later date, negative when the end is before the start
+    """
+    start_ordinals = np.asarray(start_ordinals, dtype=np.int64)
+    end_ordinals = np.asarray(end_ordinals, dtype=np.int64)
+    min_years, min_months, min_days = split_ordinals(np.minimum(start_ordinals, end_ordinals))
+    max_years, max_months, max_days = split_ordinals(np.maximum(start_ordinals, end_ordinals))
+    months = (max_years - min_years) * 12 + max_months - min_months - (max_days < min_days)
+    return np.where(start_ordinals < end_ordinals, months, -months)
+
+def years_difference(start_ordinals, end_ordinals):
+    """BankDate.nbr_of_years over arrays of ordinals, whole years rounded
+    towards zero"""
+    months = months_difference(start_ordinals, end_ordinals)
+    return np.sign(months) * (np.abs(months) // 12)
+
+def portfolio_column(portfolio, column, default):
+    """An optional portfolio column as an array, blanks filled with default"""
+    if column not in portfolio.columns:
+        return np.full(len(portfolio), default, dtype=object)
+    values = portfolio[column].astype(object)
+    return np.asarray(values.where(values.notnull() & (values != ''), default), dtype=object)
+
+def principal_schedules(portfolio, frequencies):
+    """Sinking periods and the face retired in each, per bond, for the
+    principal types:
+        'Bullet'     face repaid at maturity
+        'Amortizing' face repaid in equal parts on every payment date from
+                     issue_date to maturity
+        'Sinking'    sinking_fund_percent of face retired on every payment
+                     date from sinking_fund_start, the rest at maturity
+    A bond's flow j payment dates before maturity repays the retired amount
+    if 1 <= j <= sinking periods, so the buffer only needs the flow's
+    position and not the full schedule from issue
+    """
+    face_values = np.asarray(portfolio['face_value'], dtype=np.float64)
+    principal_types = portfolio_column(portfolio, 'principal_type', 'Bullet')
+    unknown = set(principal_types) - {'Bullet', 'Amortizing', 'Sinking'}
+    if unknown:
+        raise CashFlowError('Unknown principal type: %s' % sorted(unknown))
+    sinking_periods = np.zeros(len(portfolio), dtype=np.int64)
+    sinking_amounts = np.zeros(len(portfolio))
+    for principal_type, start_column in [('Amortizing', 'issue_date'), ('Sinking', 'sinking_fund_start')]:
+        rows = np.flatnonzero(principal_types == principal_type)
+        if not len(rows):
+            continue
+        start_ordinals, invalid = parse_iso_dates(portfolio_column(portfolio, start_column, '')[rows])
+        if invalid.any():
+            raise CashFlowError('%s bonds need a %s' % (principal_type, start_column))
+        period_months = np.array([payment_period_months(frequency) for frequency in frequencies[rows]])
+        months = months_difference(start_ordinals, iso_date_ordinals(portfolio['maturity_date'].values[rows], 'maturity_date'))
+        if principal_type == 'Amortizing':
+            periods = np.maximum(np.round(months / period_months).astype(np.int64), 1)
+            sinking_periods[rows] = periods - 1
+            sinking_amounts[rows] = face_values[rows] / periods
+        else:
+            sinking_periods[rows] = months // period_months
+            sinking_amounts[rows] = np.asarray(portfolio['sinking_fund_percent'].values[rows], dtype=np.float64)\
+                                    / 100 * face_values[rows]
+    if np.any(sinking_periods * sinking_amounts > face_values + 1e-9):
+        raise CashFlowError('Sinking fund retires more than the face value')
+    return sinking_periods, sinking_amounts
+
+def zero_curve_discount_factors(years, key_rates, compounding='Daily'):
+    """Discount factors off a zero curve given by its key rates (percent,
+    one per key_rate_tenors, nan for unquoted tenors), linear between the
+    tenors, flat outside them and compounded like value_bond (see
+    discount_kernel)
+    """
+    tenors = np.array([tenor_years(tenor) for tenor in key_rate_tenors])
+    key_rates = np.asarray(key_rates, dtype=np.float64)
+    quoted = np.isfinite(key_rates)
+    if not quoted.any():
+        raise CashFlowError('No key rates quoted for the zero curve')
+    years = np.asarray(years, dtype=np.float64)
+    return discount_kernel(np.interp(years, tenors[quoted], key_rates[quoted]), years, compounding)[0]
+
+def risk_free_key_rates(discount_rates=None):
+    """The lowest quote of any rating at each key rate tenor, as a Series
+    keyed by tenor
+    """
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    bond_ratings = sorted(set(column.split('_')[1] for column in discount_rates.columns if column != 'Date'))
+    quotes = key_rates_by_rating(bond_ratings, discount_rates)
+    quoted = np.isfinite(quotes).any(axis=0)
+    if not quoted.all():
+        raise CashFlowError('No quotes at %s' % list(np.array(key_rate_tenors)[~quoted]))
+    return pd.Series(np.nanmin(quotes, axis=0), index=key_rate_tenors)
+
+def projected_forward_rates(valuation_ordinal, start_ordinals, end_ordinals, index_rates,\
+                            day_count_convention='ACT/365F'):
+    """Forward rates (percent, simple) between each start and end date off
+    the index curve (see zero_curve_discount_factors). Periods already
+    running fix off today's curve
+    """
+    index_curve = np.array([float(np.asarray(index_rates[tenor]).ravel()[0]) for tenor in key_rate_tenors])
+    start_years = np.maximum(year_fraction(valuation_ordinal, start_ordinals, day_count_convention), 0.0)
+    end_years = np.maximum(year_fraction(valuation_ordinal, end_ordinals, day_count_convention), start_years + 1/365)
+    return (zero_curve_discount_factors(start_years, index_curve) / zero_curve_discount_factors(end_years, index_curve)\
+            - 1) / (end_years - start_years) * 100
+
+def portfolio_cashflows(portfolio, discount_rates=None, day_count_convention='ACT/365F', as_of=None,\
+                        index_rates=None):
+    """Flattens every bond's cash flows after as_of (default today) into one
+    set of arrays so the whole book can be discounted in a single numpy
+    expression. bond_index maps each flow back to its row in the portfolio.
+    Besides fixed coupon bullets the portfolio may carry a coupon_type of
+    'Floating', where coupon_rate is the margin over the forward rate
+    projected off index_rates (default risk_free_key_rates), and a principal_type (see principal_schedules).
+    Coupons are paid on the face still outstanding
+    """
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    valuation_ordinal = BankDate(as_of).toordinal()
+    bond_count = len(portfolio)
+    face_values = np.asarray(portfolio['face_value'], dtype=np.float64)
+    coupon_rates = np.asarray(portfolio['coupon_rate'], dtype=np.float64)
+    frequencies = np.asarray(portfolio['payments_per_year'], dtype=np.float64)
+    #Bonds sharing a maturity and frequency share a schedule, so each one is
+    #looked up once and the book is laid out with repeat/take
+    schedule_numbers = {}
+    bond_schedules = np.empty(bond_count, dtype=np.int64)
+    for i, schedule_key in enumerate(zip(portfolio['maturity_date'], portfolio['payments_per_year'])):
+        bond_schedules[i] = schedule_numbers.setdefault(schedule_key, len(schedule_numbers))
+    schedules = [payment_schedule(maturity_date, payments_per_year, day_count_convention, as_of)\
+                 for maturity_date, payments_per_year in schedule_numbers]
+    schedule_lengths = np.array([len(schedule['days']) for schedule in schedules], dtype=np.int64)
+    schedule_offsets = np.cumsum(schedule_lengths) - schedule_lengths
+    bond_lengths = schedule_lengths[bond_schedules]
+    bond_ends = np.cumsum(bond_lengths)
+    bond_index = np.repeat(np.arange(bond_count), bond_lengths)
+    flow_positions = np.arange(len(bond_index)) - np.repeat(bond_ends - bond_lengths, bond_lengths) \
+                     + np.repeat(schedule_offsets[bond_schedules], bond_lengths)
+    def gather(field):
+        if not schedules:
+            return np.zeros(0)
+        return np.concatenate([schedule[field] for schedule in schedules])[flow_positions]
+    days = gather('days')
+    ordinals = gather('ordinals').astype(np.int64)
+    accrual_start_ordinals = gather('accrual_start_ordinals').astype(np.int64)
+    #Schedules run oldest first, so this counts payment dates back from maturity
+    periods_to_maturity = bond_ends[bond_index] - 1 - np.arange(len(bond_index))
+    sinking_periods, sinking_amounts = principal_schedules(portfolio, frequencies)
+    flow_sinking_periods = sinking_periods[bond_index]
+    retired = sinking_amounts[bond_index] * np.maximum(flow_sinking_periods - periods_to_maturity, 0)
+    outstanding_face = face_values[bond_index] - retired
+    principals = np.where(periods_to_maturity == 0, outstanding_face,\
+                          np.where(periods_to_maturity <= flow_sinking_periods, sinking_amounts[bond_index], 0.0))
+    coupon_types = portfolio_column(portfolio, 'coupon_type', 'Fixed')
+    unknown = set(coupon_types) - {'Fixed', 'Floating'}
+    if unknown:
+        raise CashFlowError('Unknown coupon type: %s' % sorted(unknown))
+    flow_coupon_rates = coupon_rates[bond_index]
+    floating = (coupon_types == 'Floating')[bond_index]
+    if floating.any():
+        if index_rates is None:
+            index_rates = risk_free_key_rates(discount_rates)
+        flow_coupon_rates = flow_coupon_rates.copy()
+        flow_coupon_rates[floating] += projected_forward_rates(valuation_ordinal, accrual_start_ordinals[floating],\
+                                                               ordinals[floating], index_rates, day_count_convention)
+    paying = (frequencies != 0)[bond_index] & (days != 0)
+    coupons = np.zeros(len(bond_index))
+    coupons[paying] = ((flow_coupon_rates[paying]/100)*outstanding_face[paying])/frequencies[bond_index][paying]
+    amounts = coupons + principals
+    maturity_ordinals = iso_date_ordinals([maturity_date for maturity_date, payments_per_year in schedule_numbers],\
+                                          'maturity_date')[bond_schedules]
+    maturity_remaining = year_fraction(valuation_ordinal, maturity_ordinals, day_count_convention)
+    bond_ratings = list(portfolio['bond_rating'])
+    return {'bond_index' : bond_index,
+            'unrolled_ordinals' : gather('unrolled_ordinals').astype(np.int64),
+            'ordinals' : ordinals,
+            'accrual_start_ordinals' : accrual_start_ordinals,
+            'days' : days.astype(np.int64),
+            'year_fractions' : np.concatenate([schedule['year_fractions'][day_count_convention]\
+                                               for schedule in schedules] or [np.zeros(0)])[flow_positions],
+            'amounts' : amounts,
+            'coupons' : coupons,
+            'bond_count' : bond_count,
+            'face_values' : face_values,
+            'bond_ratings' : bond_ratings,
+            'maturity_ordinals' : maturity_ordinals,
+            'valuation_ordinal' : valuation_ordinal,
+            'day_count_convention' : day_count_convention,
+            'maturity_remaining' : maturity_remaining,
+            'key_rate_weights' : key_rate_weights(maturity_remaining),
+            'key_rates' : portfolio_key_rates(bond_ratings, discount_rates)}
+
+_cashflow_flow_fields = ['bond_index', 'unrolled_ordinals', 'ordinals', 'accrual_start_ordinals', 'amounts', 'coupons']
+
+def rebase_cashflows(cashflows, as_of, discount_rates=None):
+    """The same book seen from a later valuation date: flows paid by as_of
+    are dropped and days, year fractions and tenor weights are recomputed
+    from the arrays, without touching the schedules. discount_rates swaps in
+    the curve for that date, otherwise the buffer's rates are kept
+    """
+    valuation_ordinal = BankDate(as_of).toordinal()
+    if valuation_ordinal < cashflows['valuation_ordinal']:
+        raise BankDateError('Can not rebase cash flows from %s back to %s'
+                            % (BankDate(_pythondate.fromordinal(cashflows['valuation_ordinal'])), as_of))
+    day_count_convention = cashflows['day_count_convention']
+    outstanding = cashflows['unrolled_ordinals'] > valuation_ordinal
+    rebased = dict(cashflows)
+    #Cached per flow figures belong to the old valuation date
+    rebased.pop('zero_discount_factors', None)
+    for field in _cashflow_flow_fields:
+        rebased[field] = cashflows[field][outstanding]
+    rebased['valuation_ordinal'] = valuation_ordinal
+    rebased['days'] = rebased['ordinals'] - valuation_ordinal
+    rebased['year_fractions'] = year_fraction(valuation_ordinal, rebased['ordinals'], day_count_convention)
+    rebased['maturity_remaining'] = year_fraction(valuation_ordinal, cashflows['maturity_ordinals'],\
+                                                  day_count_convention)
+    rebased['key_rate_weights'] = key_rate_weights(rebased['maturity_remaining'])
+    if discount_rates is not None:
+        rebased['key_rates'] = portfolio_key_rates(cashflows['bond_ratings'], discount_rates)
+    return rebased
+
+def project_cashflows(portfolio, discount_rates=None, day_count_convention='ACT/365F', as_of=None,\
+                      as_arrow=False, compounding='Daily'):
+    """Every projected cash flow of the book as one long table, one row per
+    flow: bond id, pay date, amount (split into coupon and principal), year
+    fraction, discount factor and PV. Built straight from the flattened cash
+    flow arrays, no per row Python.
+    portfolio is a generate_portfolio frame or its csv location; the bond id
+    is its 'bond_id' column if it has one, otherwise the row index.
+    as_arrow returns a pyarrow Table instead of a DataFrame
+    """
+    if isinstance(portfolio, str):
+        portfolio = generate_portfolio(portfolio)
+    cashflows = portfolio_cashflows(portfolio, discount_rates, day_count_convention, as_of)
+    bond_ids = np.asarray(portfolio['bond_id'] if 'bond_id' in portfolio.columns else portfolio.index)
+    discount_factors = cashflow_discount_factors(cashflows, compounding=compounding)
+    columns = {'bond_id' : bond_ids[cashflows['bond_index']],
+               'pay_date' : ordinals_to_datetime64(cashflows['ordinals']),
+               'amount' : cashflows['amounts'],
+               'coupon' : cashflows['coupons'],
+               'principal' : cashflows['amounts'] - cashflows['coupons'],
+               'year_fraction' : cashflows['year_fractions'],
+               'discount_factor' : discount_factors,
+               'pv' : cashflows['amounts'] * discount_factors}
+    if as_arrow:
+        import pyarrow
+        return pyarrow.table(columns)
+    return pd.DataFrame(columns)
+
+def cashflow_ladder(portfolio, buckets='monthly', discount_rates=None, day_count_convention='ACT/365F',\
+                    as_of=None, compounding='Daily'):
+    """Projected cash flows of the book summed into time buckets for
+    liquidity reporting. buckets is 'weekly', 'monthly' (calendar months) or
+    a list of tenors such as ['1m','3m','6m','1y','5y','10y'], where each
+    bucket runs up to and including as_of + tenor and a last bucket holds
+    anything beyond the longest tenor.
+    Every flow is placed with one searchsorted/integer division over the
+    ordinal dates and summed with np.bincount, so the whole book is laddered
+    without a Python loop
+    """
+    if isinstance(portfolio, str):
+        portfolio = generate_portfolio(portfolio)
+    cashflows = portfolio_cashflows(portfolio, discount_rates, day_count_convention, as_of)
+    ordinals = cashflows['ordinals']
+    valuation_ordinal = cashflows['valuation_ordinal']
+    if buckets == 'weekly':
+        bucket_index = (ordinals - valuation_ordinal) // 7
+        bucket_count = int(bucket_index.max()) + 1 if len(bucket_index) else 0
+        starts = valuation_ordinal + 7 * np.arange(bucket_count)
+        ends = starts + 6
+        labels = ['%sw' % (week + 1) for week in range(bucket_count)]
+    elif buckets == 'monthly':
+        valuation_month = ordinals_to_datetime64(valuation_ordinal).astype('datetime64[M]')
+        bucket_index = (ordinals_to_datetime64(ordinals).astype('datetime64[M]') - valuation_month).astype(np.int64)
+        bucket_count = int(bucket_index.max()) + 1 if len(bucket_index) else 0
+        months = valuation_month + np.arange(bucket_count + 1)
+        month_starts = months.astype('datetime64[D]').astype(np.int64) + _ordinal_epoch
+        starts = np.maximum(month_starts[:-1], valuation_ordinal)
+        ends = month_starts[1:] - 1
+        labels = [str(month) for month in months[:-1]]
+    elif isinstance(buckets, str):
+        raise BankDateError('Unknown cash flow bucketing: %s' % buckets)
+    else:
+        valuation_date = BankDate(_pythondate.fromordinal(int(valuation_ordinal)))
+        edges = np.array([(valuation_date + TimePeriod(tenor)).toordinal() for tenor in buckets], dtype=np.int64)
+        if np.any(np.diff(edges) <= 0):
+            raise BankDateError('Ladder tenors must be increasing: %s' % list(buckets))
+        bucket_index = np.searchsorted(edges, ordinals, side='left')
+        bucket_count = len(edges) + 1
+        starts = np.concatenate(([valuation_ordinal], edges + 1))
+        last_ordinal = max(int(ordinals.max()) if len(ordinals) else edges[-1], edges[-1] + 1)
+        ends = np.concatenate((edges, [last_ordinal]))
+        labels = [str(tenor) for tenor in buckets] + ['>%s' % buckets[-1]]
+    pv_fcf = cashflows['amounts'] * cashflow_discount_factors(cashflows, compounding=compounding)
+    amounts = np.bincount(bucket_index, weights=cashflows['amounts'], minlength=bucket_count)
+    coupons = np.bincount(bucket_index, weights=cashflows['coupons'], minlength=bucket_count)
+    return pd.DataFrame({'Bucket' : labels,
+                         'Start Date' : ordinals_to_datetime64(starts),
+                         'End Date' : ordinals_to_datetime64(ends),
+                         'Cash Flows' : np.bincount(bucket_index, minlength=bucket_count),
+                         'Amount' : amounts,
+                         'Coupon' : coupons,
+                         'Principal' : amounts - coupons,
+                         'PV' : np.bincount(bucket_index, weights=pv_fcf, minlength=bucket_count),
+                         'Cumulative Amount' : np.cumsum(amounts)})
+
+def cashflow_discount_rates(cashflows, rate_shift=0.0):
+    """Each bond's interpolated discount rate (percent) plus rate_shift,
+    which may be a per bond array
+    """
+    weights = cashflows['key_rate_weights']
+    #Tenors a rating isn't quoted at are nan but carry no weight
+    return np.where(weights != 0, weights * cashflows['key_rates'], 0.0).sum(axis=1) + rate_shift
+
+def cashflow_discount_terms(cashflows, rate_shift=0.0, compounding='Daily'):
+    """discount_kernel for every flow off its bond's discount rate"""
+    flow_rate = cashflow_discount_rates(cashflows, rate_shift)[cashflows['bond_index']]
+    return discount_kernel(flow_rate, cashflows['year_fractions'], compounding)
+
+def cashflow_discount_factors(cashflows, rate_shift=0.0, compounding='Daily'):
+    """Discount factor of every flow, as used in value_bond"""
+    return cashflow_discount_terms(cashflows, rate_shift, compounding)[0]
+
+def price_cashflows(cashflows, rate_shift=0.0, compounding='Daily'):
+    """Bond values from a portfolio_cashflows buffer, discounting the same
+    way as value_bond
+    """
+    pv_fcf = cashflows['amounts'] * cashflow_discount_factors(cashflows, rate_shift, compounding)
+    return np.bincount(cashflows['bond_index'], weights=pv_fcf, minlength=cashflows['bond_count'])
+
+def cashflow_analytics(cashflows, compounding='Daily'):
+    """Value, DV01, effective duration and effective convexity of every bond,
+    differentiated analytically through the discount factors, so no bonds
+    are repriced.
+    For P = sum(cf * (1 + y/365)**(-365*t)) with y the decimal rate and t
+    the year fraction (daily compounding, see discount_kernel for the rest):
+        duration  = sum(pv * t) / (P * (1 + y/365))
+        convexity = sum(pv * t*(t + 1/365)) / (P * (1 + y/365)**2)
+    DV01 is the value lost for a 1bp rise to first order, PV01 adds the
+    convexity term
+    """
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    years = cashflows['year_fractions']
+    discount_factors, growth, step = cashflow_discount_terms(cashflows, compounding=compounding)
+    pv_fcf = cashflows['amounts'] * discount_factors
+    bond_vals = np.bincount(bond_index, weights=pv_fcf, minlength=bond_count)
+    pv_times = np.bincount(bond_index, weights=pv_fcf * years / growth, minlength=bond_count)
+    pv_times_squared = np.bincount(bond_index, weights=pv_fcf * years * (years + step) / growth**2,\
+                                   minlength=bond_count)
+    effective_duration = pv_times / bond_vals
+    effective_convexity = pv_times_squared / bond_vals
+    dv01 = bond_vals * effective_duration * 0.0001
+    pv01 = dv01 - 0.5 * bond_vals * effective_convexity * 0.0001**2
+    return pd.DataFrame({'Bond Value' : bond_vals, 'DV01' : dv01, 'PV01' : pv01,
+                         'Effective Duration' : effective_duration,
+                         'Effective Convexity' : effective_convexity})
+
+def cashflow_durations(cashflows, compounding='Daily'):
+    """duration_bond and convexity_bond for every bond in a cash flow
+    buffer at once, same definitions
+    """
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    years = cashflows['year_fractions']
+    discount_rate = cashflow_discount_rates(cashflows)
+    discount_factors, growth, step = cashflow_discount_terms(cashflows, compounding=compounding)
+    pv_fcf = cashflows['amounts'] * discount_factors
+    bond_vals = np.bincount(bond_index, weights=pv_fcf, minlength=bond_count)
+    bond_duration = np.bincount(bond_index, weights=pv_fcf * years, minlength=bond_count) / bond_vals
+    modified_duration = np.bincount(bond_index, weights=pv_fcf * years / growth, minlength=bond_count) / bond_vals
+    bond_convexity = np.bincount(bond_index, weights=pv_fcf * years * (years + step) / growth**2,\
+                                 minlength=bond_count) / bond_vals
+    return pd.DataFrame({'Bond Value' : bond_vals,
+                         'Bond Duration' : bond_duration,
+                         'Modified Duration' : modified_duration,
+                         'Bond Convexity' : bond_convexity,
+                         'Discount Rate' : discount_rate})
+
+def key_rate_durations(cashflows, bump=0.01, compounding='Daily'):
+    """Key rate durations of every bond at the 2/5/10/20yr tenors.
+    Each key rate is bumped up and down by bump (percent, default 1bp) and the
+    cached cash flows repriced, no schedules are rebuilt
+    """
+    bond_vals = price_cashflows(cashflows, compounding=compounding)
+    durations = np.empty((cashflows['bond_count'], len(key_rate_tenors)))
+    for j in range(len(key_rate_tenors)):
+        shift = cashflows['key_rate_weights'][:, j] * bump
+        bond_vals_up = price_cashflows(cashflows, shift, compounding)
+        bond_vals_down = price_cashflows(cashflows, -shift, compounding)
+        durations[:, j] = (bond_vals_down - bond_vals_up) / (2 * bump / 100 * bond_vals)
+    return bond_vals, durations
+
+def key_rate_duration_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                           day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    bond = single_bond_portfolio(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)
+    durations = key_rate_durations(portfolio_cashflows(bond, day_count_convention=day_count_convention, as_of=as_of),\
+                                   compounding=compounding)[1][0]
+    return dict(zip(key_rate_tenors, durations))
+
+def key_rate_duration_portfolio(csv_location, day_count_convention='ACT/365F', as_of=None, compounding='Daily'):
+    """Key rate durations per bond and for the portfolio, the portfolio
+    figure weighted by bond value as in portfolio_duration
+    """
+    portfolio = generate_portfolio(csv_location)
+    bond_vals, durations = key_rate_durations(portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of),\
+                                              compounding=compounding)
+    bond_key_rate_durations = pd.DataFrame(durations, columns=key_rate_tenors, index=portfolio.index)
+    portfolio_key_rate_durations = dict(zip(key_rate_tenors, np.dot(bond_vals, durations) / bond_vals.sum()))
+    return {'Bond Key Rate Durations' : bond_key_rate_durations,
+            'Portfolio Key Rate Durations' : portfolio_key_rate_durations}
+
+def analytics_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                   day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    bond = single_bond_portfolio(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)
+    return cashflow_analytics(portfolio_cashflows(bond, day_count_convention=day_count_convention, as_of=as_of),\
+                              compounding).iloc[0].to_dict()
+
+def analytics_portfolio(csv_location, day_count_convention='ACT/365F', as_of=None, compounding='Daily'):
+    """Per bond analytics plus portfolio totals, DV01/PV01 summed and
+    duration/convexity weighted by bond value
+    """
+    portfolio = generate_portfolio(csv_location)
+    bond_analytics = cashflow_analytics(portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of),\
+                                        compounding)
+    bond_analytics.index = portfolio.index
+    portfolio_val = bond_analytics['Bond Value'].sum()
+    weights = bond_analytics['Bond Value'] / portfolio_val
+    portfolio_analytics = {'Portfolio Value' : portfolio_val,
+                           'DV01' : bond_analytics['DV01'].sum(),
+                           'PV01' : bond_analytics['PV01'].sum(),
+                           'Effective Duration' : (weights * bond_analytics['Effective Duration']).sum(),
+                           'Effective Convexity' : (weights * bond_analytics['Effective Convexity']).sum()}
+    return {'Bond Analytics' : bond_analytics, 'Portfolio Analytics' : portfolio_analytics}
+
+def settlement_prices(cashflows, settlement_date=None, compounding='Daily'):
+    """Dirty value, accrued interest and clean value of every bond for
+    settlement on settlement_date (default the buffer's valuation date), plus the
+    dirty/clean prices per 100 face.
+    Flows paid on or before settlement belong to the seller and the rest are
+    discounted back to the settlement date. Accrued interest is the coupon
+    being earned times the fraction of its period elapsed at settlement
+    """
+    if settlement_date is None:
+        settlement = cashflows['valuation_ordinal']
+    else:
+        settlement = BankDate(settlement_date).toordinal()
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    day_count_convention = cashflows['day_count_convention']
+    ordinals = cashflows['ordinals']
+    accrual_start = cashflows['accrual_start_ordinals']
+    flow_rate = cashflow_discount_rates(cashflows)[bond_index]
+    outstanding = ordinals > settlement
+    years_from_settlement = year_fraction(settlement, ordinals, day_count_convention)
+    pv_fcf = np.where(outstanding, cashflows['amounts'], 0.0) * discount_kernel(flow_rate, years_from_settlement, compounding)[0]
+    dirty_vals = np.bincount(bond_index, weights=pv_fcf, minlength=bond_count)
+    accruing = outstanding & (accrual_start <= settlement)
+    #A period rolled down to nothing has nothing to accrue
+    period_years = year_fraction(accrual_start, ordinals, day_count_convention)
+    accrual_fraction = np.divide(year_fraction(accrual_start, settlement, day_count_convention), period_years,\
+                                 out=np.zeros(len(ordinals)), where=period_years > 0)
+    accrued = np.bincount(bond_index, weights=np.where(accruing, cashflows['coupons'] * accrual_fraction, 0.0),\
+                          minlength=bond_count)
+    clean_vals = dirty_vals - accrued
+    #Quoted per 100 of the face still outstanding, which is the face value for bullets.
+    #Bonds fully repaid by settlement have no price
+    outstanding_face = np.bincount(bond_index, weights=np.where(outstanding, cashflows['amounts'] - cashflows['coupons'], 0.0),\
+                                   minlength=bond_count)
+    has_face = outstanding_face > 0
+    return pd.DataFrame({'Dirty Value' : dirty_vals,
+                         'Accrued Interest' : accrued,
+                         'Clean Value' : clean_vals,
+                         'Dirty Price' : np.divide(dirty_vals * 100, outstanding_face, out=np.full(bond_count, np.nan),\
+                                                   where=has_face),
+                         'Clean Price' : np.divide(clean_vals * 100, outstanding_face, out=np.full(bond_count, np.nan),\
+                                                   where=has_face)})
+
+def settlement_price_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                          settlement_date=None,day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    bond = single_bond_portfolio(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)
+    cashflows = portfolio_cashflows(bond, day_count_convention=day_count_convention, as_of=as_of)
+    return settlement_prices(cashflows, settlement_date, compounding).iloc[0].to_dict()
+
+def settlement_price_portfolio(csv_location, settlement_date=None, day_count_convention='ACT/365F', as_of=None,\
+                               compounding='Daily'):
+    portfolio = generate_portfolio(csv_location)
+    cashflows = portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of)
+    bond_prices = settlement_prices(cashflows, settlement_date, compounding)
+    bond_prices.index = portfolio.index
+    return bond_prices
+
 def generate_yield_comparison_table_raw(csv_location):
     """Builds a table containing daily 
     yield quotes of corporate bonds
@@ -762,9 +1637,713 @@ def generate_yield_comparison_table_raw(csv_location):
                        )
     return daily_yield_change_array
 
-yesterdays_yield_close_values_corp = generate_yield_comparison_table_raw ('/Users/baronabramowitz/Desktop/corporate_bond_yields_daily_values.csv').iloc[[0]] 
+yield_close_csv_location = '/Users/baronabramowitz/Desktop/corporate_bond_yields_daily_values.csv'
+yesterdays_yield_close_values_corp = generate_yield_comparison_table_raw (yield_close_csv_location).iloc[[0]] 
 
-def value_at_risk_yield_change_upper_bound_by_rating(csv_location, loss_percentile):
+def yield_close_values_as_of(yield_table, as_of):
+    """The one row curve (like yesterdays_yield_close_values_corp) for the
+    last close on or before as_of, whatever order the table is stored in
+    """
+    date_ordinals = iso_date_ordinals(yield_table['Date'], 'Date')
+    on_or_before = date_ordinals <= BankDate(as_of).toordinal()
+    if not on_or_before.any():
+        raise BankDateError('No yield close on or before %s' % as_of)
+    return yield_table.iloc[[np.flatnonzero(on_or_before)[np.argmax(date_ordinals[on_or_before])]]].reset_index(drop=True)
+
+def value_portfolio_as_of_dates(csv_location, as_of_dates, yield_csv_location=None,\
+                                day_count_convention='ACT/365F', compounding='Daily'):
+    """Values the portfolio on every date in as_of_dates in one go.
+    The schedules and flattened cash flows are built once, from the earliest
+    date, and each later date is a rebase of the same arrays.
+    With yield_csv_location each date is discounted off the close on or
+    before it, otherwise off yesterdays_yield_close_values_corp.
+    Returns a frame of bond values, one row per date, with the portfolio total
+    """
+    portfolio = generate_portfolio(csv_location)
+    as_of_dates = sorted(BankDate(as_of) for as_of in as_of_dates)
+    yield_table = None
+    if yield_csv_location is not None:
+        yield_table = generate_yield_comparison_table_raw(yield_csv_location)
+    cashflows = portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of_dates[0])
+    bond_vals = []
+    for as_of in as_of_dates:
+        discount_rates = None
+        if yield_table is not None:
+            discount_rates = yield_close_values_as_of(yield_table, as_of)
+        bond_vals.append(price_cashflows(rebase_cashflows(cashflows, as_of, discount_rates), compounding=compounding))
+    portfolio_vals = pd.DataFrame(bond_vals, index=[str(as_of) for as_of in as_of_dates], columns=portfolio.index)
+    portfolio_vals['Portfolio Value'] = portfolio_vals.sum(axis=1)
+    return portfolio_vals
+
+def key_rate_history(yield_table, bond_ratings):
+    """Key rate quotes for every bond on every row of yield_table, shaped
+    (dates, bonds, tenors), read column by column rather than row by row
+    """
+    unique_ratings = sorted(set(bond_ratings))
+    rating_history = np.full((len(yield_table), len(unique_ratings), len(key_rate_tenors)), np.nan)
+    for i, bond_rating in enumerate(unique_ratings):
+        for j, tenor in enumerate(key_rate_tenors):
+            column = str(tenor + '_' + str(bond_rating))
+            if column in yield_table.columns:
+                rating_history[:, i, j] = yield_table[column].values
+    return rating_history[:, [unique_ratings.index(rating) for rating in bond_ratings]]
+
+def revaluation_history(portfolio_csv_location, yield_csv_location, day_count_convention='ACT/365F',\
+                        compounding='Daily'):
+    """Revalues a fixed portfolio at every close in the yield file, oldest
+    first, giving the daily value, duration and convexity and splitting each
+    day's P&L into
+        carry: the book rolled forward a day on the previous close, plus
+               any cash flows paid in between
+        curve: the move from the previous close to today's on the rolled book
+    The cash flows are flattened once at the first date and every following
+    day is rebased from the day before, so only the still outstanding flows
+    are touched
+    """
+    portfolio = generate_portfolio(portfolio_csv_location)
+    yield_table = generate_yield_comparison_table_raw(yield_csv_location)
+    yield_table = yield_table.iloc[np.argsort(iso_date_ordinals(yield_table['Date'], 'Date'), kind='stable')]
+    dates = list(yield_table['Date'])
+    curve_history = key_rate_history(yield_table, list(portfolio['bond_rating']))
+    cashflows = portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=dates[0])
+    history = []
+    previous_val = None
+    for date, key_rates in zip(dates, curve_history):
+        rolled = rebase_cashflows(cashflows, date)
+        cash_received = cashflows['amounts'].sum() - rolled['amounts'].sum()
+        carry_val = price_cashflows(rolled, compounding=compounding).sum()
+        rolled['key_rates'] = key_rates
+        analytics = cashflow_analytics(rolled, compounding)
+        portfolio_val = analytics['Bond Value'].sum()
+        weights = analytics['Bond Value'] / portfolio_val
+        day = {'Date' : date,
+               'Portfolio Value' : portfolio_val,
+               'Effective Duration' : np.nansum(weights * analytics['Effective Duration']),
+               'Effective Convexity' : np.nansum(weights * analytics['Effective Convexity']),
+               'Cash Received' : cash_received,
+               'Carry P&L' : np.nan,
+               'Curve P&L' : np.nan,
+               'Total P&L' : np.nan}
+        if previous_val is not None:
+            day['Carry P&L'] = carry_val + cash_received - previous_val
+            day['Curve P&L'] = portfolio_val - carry_val
+            day['Total P&L'] = portfolio_val + cash_received - previous_val
+        history.append(day)
+        previous_val = portfolio_val
+        cashflows = rolled
+    return pd.DataFrame(history).set_index('Date')
+
+def tenor_years(tenor):
+    """'2yr' -> 2.0"""
+    return float(str(tenor).replace('yr', ''))
+
+def parallel_shock(tenors, size, shock):
+    return np.full(len(tenors), float(size))
+
+def twist_shock(tenors, size, shock):
+    """Rotation about shock['pivot'] (default 10yr), size is the change of
+    the longest tenor's rate relative to the shortest's
+    """
+    pivot = tenor_years(shock.get('pivot', '10yr'))
+    return size * (tenors - pivot) / (tenors.max() - tenors.min())
+
+def butterfly_shock(tenors, size, shock):
+    """The wings move by size and the belly (shock['belly'], default the
+    5yr and 10yr) by -size
+    """
+    belly = [tenor_years(tenor) for tenor in shock.get('belly', ['5yr', '10yr'])]
+    return np.where(np.isin(tenors, belly), -float(size), float(size))
+
+def short_rate_shock(tenors, size, shock):
+    """size decaying with tenor, exp(-t/4) as in the Basel IRRBB shocks"""
+    return size * np.exp(-tenors / shock.get('decay', 4.0))
+
+def long_rate_shock(tenors, size, shock):
+    return size * (1 - np.exp(-tenors / shock.get('decay', 4.0)))
+
+def custom_shock(tenors, size, shock):
+    """shock['shocks'] maps a tenor ('5yr') to its shock in basis points"""
+    tenor_shocks = dict((tenor_years(tenor), bp) for tenor, bp in shock['shocks'].items())
+    return np.array([tenor_shocks.get(tenor, 0.0) for tenor in tenors], dtype=np.float64)
+
+curve_shock_shapes = {'parallel' : parallel_shock,
+                      'twist' : twist_shock,
+                      'butterfly' : butterfly_shock,
+                      'short' : short_rate_shock,
+                      'long' : long_rate_shock,
+                      'custom' : custom_shock
+                     }
+
+#Basel IRRBB style pack, sizes in basis points, a list of shocks is summed
+interest_rate_stress_scenarios = {
+    'Parallel Up' : {'shape' : 'parallel', 'size' : 200},
+    'Parallel Down' : {'shape' : 'parallel', 'size' : -200},
+    'Steepener' : [{'shape' : 'short', 'size' : -0.65 * 300}, {'shape' : 'long', 'size' : 0.9 * 150}],
+    'Flattener' : [{'shape' : 'short', 'size' : 0.8 * 300}, {'shape' : 'long', 'size' : -0.6 * 150}],
+    'Short Rates Up' : {'shape' : 'short', 'size' : 300},
+    'Short Rates Down' : {'shape' : 'short', 'size' : -300},
+    }
+
+def scenario_shock_grid(scenarios, discount_rates=None):
+    """The shift, in the percent units of the yield table, each scenario
+    applies to every column of the tenor/rating grid in discount_rates,
+    one row per scenario.
+    scenarios maps a name to a shock or a list of shocks that are added up.
+    A shock is a dict with the 'shape' (a key of curve_shock_shapes), its
+    'size' in basis points, any parameters of the shape and optionally the
+    'ratings' it is restricted to
+    """
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    columns = [column for column in discount_rates.columns if column != 'Date']
+    column_tenors = np.array([tenor_years(column.split('_')[0]) for column in columns])
+    column_ratings = np.array([column.split('_')[1] for column in columns])
+    grid = np.zeros((len(scenarios), len(columns)))
+    for i, shocks in enumerate(scenarios.values()):
+        if isinstance(shocks, dict):
+            shocks = [shocks]
+        for shock in shocks:
+            if shock['shape'] not in curve_shock_shapes:
+                raise BankDateError('Unknown curve shock shape: %s' % shock['shape'])
+            shift = curve_shock_shapes[shock['shape']](column_tenors, shock.get('size', 0.0), shock)
+            if shock.get('ratings') is not None:
+                shift = np.where(np.isin(column_ratings, list(shock['ratings'])), shift, 0.0)
+            grid[i] += shift / 100
+    return pd.DataFrame(grid, index=list(scenarios), columns=columns)
+
+def scenario_rate_shifts(cashflows, shock_grid):
+    """Each bond's discount rate shift under every scenario in shock_grid,
+    shaped (scenarios, bonds). The rate is linear in the key rates, so the
+    shift is the bond's key rate weights times its rating's shocks
+    """
+    bond_ratings = np.asarray(cashflows['bond_ratings'])
+    weights = cashflows['key_rate_weights']
+    shifts = np.zeros((len(shock_grid), cashflows['bond_count']))
+    for bond_rating in sorted(set(bond_ratings)):
+        rating_bonds = bond_ratings == bond_rating
+        rating_shocks = np.column_stack([shock_grid[column].values if column in shock_grid.columns\
+                                         else np.zeros(len(shock_grid))\
+                                         for column in [tenor + '_' + str(bond_rating) for tenor in key_rate_tenors]])
+        shifts[:, rating_bonds] = rating_shocks.dot(weights[rating_bonds].T)
+    return shifts
+
+def shifted_values(cashflows, rate_shifts, max_chunk_size=5000000, compounding='Daily'):
+    """Bond values for every row of rate_shifts, per bond shifts (percent)
+    to the discount rates shaped (scenarios, bonds). All the rows are
+    discounted together as one (scenarios x flows) array and summed per
+    bond with a single bincount, in chunks of rows holding at most
+    max_chunk_size flows so big books stay within memory
+    """
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    flow_count = len(bond_index)
+    base_rates = cashflow_discount_rates(cashflows)[bond_index]
+    rate_shifts = np.atleast_2d(rate_shifts)
+    values = np.zeros((len(rate_shifts), bond_count))
+    chunk_size = max(1, max_chunk_size // max(flow_count, 1))
+    for start in range(0, len(rate_shifts), chunk_size):
+        chunk_shifts = rate_shifts[start:start + chunk_size]
+        flow_rates = base_rates + chunk_shifts[:, bond_index]
+        pv_fcf = cashflows['amounts'] * discount_kernel(flow_rates, cashflows['year_fractions'], compounding)[0]
+        flat_index = (np.arange(len(chunk_shifts))[:, None] * bond_count + bond_index).ravel()
+        values[start:start + len(chunk_shifts)] = np.bincount(flat_index, weights=pv_fcf.ravel(),\
+                                                              minlength=len(chunk_shifts) * bond_count)\
+                                                  .reshape(len(chunk_shifts), bond_count)
+    return values
+
+def scenario_values(cashflows, shock_grid, max_chunk_size=5000000, compounding='Daily'):
+    """Bond values under every scenario in shock_grid, shaped (scenarios,
+    bonds), see shifted_values
+    """
+    return shifted_values(cashflows, scenario_rate_shifts(cashflows, shock_grid), max_chunk_size, compounding)
+
+def scenario_revaluation(csv_location, scenarios=None, discount_rates=None, day_count_convention='ACT/365F',\
+                         as_of=None, compounding='Daily'):
+    """Revalues the portfolio under a library of curve scenarios (default
+    interest_rate_stress_scenarios) in one batch.
+    Returns the per scenario summary and the (scenarios x bonds) frame of
+    PV changes
+    """
+    if scenarios is None:
+        scenarios = interest_rate_stress_scenarios
+    portfolio = generate_portfolio(csv_location) if isinstance(csv_location, str) else csv_location
+    cashflows = portfolio_cashflows(portfolio, discount_rates, day_count_convention, as_of)
+    shock_grid = scenario_shock_grid(scenarios, discount_rates)
+    base_vals = price_cashflows(cashflows, compounding=compounding)
+    pv_changes = pd.DataFrame(scenario_values(cashflows, shock_grid, compounding=compounding) - base_vals,\
+                              index=shock_grid.index, columns=portfolio.index)
+    base_val = base_vals.sum()
+    summary = pd.DataFrame({'Base Value' : base_val,
+                            'Scenario Value' : base_val + pv_changes.sum(axis=1),
+                            'PV Change' : pv_changes.sum(axis=1),
+                            'PV Change %' : 100 * pv_changes.sum(axis=1) / base_val},
+                           index=shock_grid.index)
+    return summary, pv_changes
+
+class CreditError(Exception):
+    '''A class to implement error messages from the credit pricing functions.'''
+    pass
+
+credit_ratings = ['AAA', 'AA', 'A', 'BBB', 'BB', 'B', 'CCC']
+
+#One year rating transition probabilities in percent (the CreditMetrics
+#technical document table), rows are today's rating, 'D' is default
+rating_transition_matrix = pd.DataFrame(
+    [[90.81, 8.33, 0.68, 0.06, 0.12, 0.00, 0.00, 0.00],
+     [0.70, 90.65, 7.79, 0.64, 0.06, 0.14, 0.02, 0.00],
+     [0.09, 2.27, 91.05, 5.52, 0.74, 0.26, 0.01, 0.06],
+     [0.02, 0.33, 5.95, 86.93, 5.30, 1.17, 0.12, 0.18],
+     [0.03, 0.14, 0.67, 7.73, 80.53, 8.84, 1.00, 1.06],
+     [0.00, 0.11, 0.24, 0.43, 6.48, 83.46, 4.07, 5.20],
+     [0.22, 0.00, 0.22, 1.30, 2.38, 11.24, 64.86, 19.79]],
+    index=credit_ratings, columns=credit_ratings + ['D'])
+
+#Spread (basis points) of a rating over the one above it, per key rate tenor,
+#for the ratings the yield file doesn't quote. Placeholders until quotes exist
+credit_spread_addons = pd.DataFrame(
+    [[60, 70, 80, 90],
+     [150, 160, 160, 160],
+     [200, 210, 210, 210],
+     [500, 470, 450, 430]],
+    index=['BBB', 'BB', 'B', 'CCC'], columns=key_rate_tenors)
+
+credit_recovery_rate = 0.4
+
+def credit_curves(discount_rates=None, risk_free_rates=None, spread_addons=None):
+    """Splits the rating curves into a risk free curve and a spread curve
+    per rating, in percent at the key rate tenors.
+    risk_free_rates is a one row frame (or dict) keyed by tenor ('2yr', ...),
+    by default the lowest quote at each tenor. A tenor a rating isn't
+    quoted at takes the spread at its nearest quoted tenor (the yield file
+    has no 2yr AAA), and ratings missing from discount_rates take the
+    spread of the rating above plus spread_addons (default
+    credit_spread_addons)
+    Returns the risk free rates and a frame of spreads, one row per rating
+    """
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    if spread_addons is None:
+        spread_addons = credit_spread_addons
+    quotes = pd.DataFrame(key_rates_by_rating(credit_ratings, discount_rates),\
+                          index=credit_ratings, columns=key_rate_tenors)
+    if risk_free_rates is None:
+        risk_free = risk_free_key_rates(discount_rates)
+    else:
+        risk_free = pd.Series([float(np.asarray(risk_free_rates[tenor]).ravel()[0]) for tenor in key_rate_tenors],\
+                              index=key_rate_tenors)
+    if risk_free.isnull().any():
+        raise CreditError('No risk free rate for %s' % list(risk_free.index[risk_free.isnull()]))
+    spreads = quotes - risk_free
+    tenors = np.array([tenor_years(tenor) for tenor in key_rate_tenors])
+    for i, bond_rating in enumerate(credit_ratings):
+        missing = spreads.loc[bond_rating].isnull().values
+        if not missing.any():
+            continue
+        if not missing.all():
+            quoted = np.flatnonzero(~missing)
+            nearest = quoted[np.abs(tenors[missing][:, None] - tenors[quoted]).argmin(axis=1)]
+            spreads.loc[bond_rating, np.array(key_rate_tenors)[missing]] = spreads.loc[bond_rating].values[nearest]
+            continue
+        if i == 0 or bond_rating not in spread_addons.index:
+            raise CreditError('No quote or spread add-on for %s' % bond_rating)
+        addon = spreads.loc[credit_ratings[i - 1]] + spread_addons.loc[bond_rating] / 100
+        spreads.loc[bond_rating] = spreads.loc[bond_rating].where(~missing, addon)
+    return risk_free, spreads
+
+def credit_discount_rates(risk_free, spreads):
+    """Risk free plus spread as a one row curve in the yield file layout
+    ('5yr_BBB', ...) so every pricing function can discount off it
+    """
+    curve = {}
+    for bond_rating in spreads.index:
+        for tenor in key_rate_tenors:
+            curve[tenor + '_' + str(bond_rating)] = [risk_free[tenor] + spreads.at[bond_rating, tenor]]
+    return pd.DataFrame(curve)
+
+def migration_values(cashflows, curve, horizon=None, recovery_rate=credit_recovery_rate, compounding='Daily'):
+    """Value of every bond at the horizon (default a year after the
+    valuation date) for each rating it could migrate to, shaped
+    (bonds, credit_ratings + default). The book is priced once per rating
+    bucket, not once per simulated path. Flows paid before the horizon are
+    added back undiscounted, a default is worth recovery_rate of face
+    """
+    if horizon is None:
+        horizon = BankDate(_pythondate.fromordinal(int(cashflows['valuation_ordinal']))) + '1y'
+    rolled = rebase_cashflows(cashflows, horizon)
+    cash_received = np.bincount(cashflows['bond_index'], weights=cashflows['amounts'],\
+                                minlength=cashflows['bond_count'])\
+                    - np.bincount(rolled['bond_index'], weights=rolled['amounts'], minlength=rolled['bond_count'])
+    values = np.zeros((cashflows['bond_count'], len(credit_ratings) + 1))
+    for j, bond_rating in enumerate(credit_ratings):
+        migrated = dict(rolled)
+        migrated['key_rates'] = np.repeat(key_rates_by_rating([bond_rating], curve), rolled['bond_count'], axis=0)
+        values[:, j] = price_cashflows(migrated, compounding=compounding) + cash_received
+    values[:, -1] = recovery_rate * cashflows['face_values']
+    return values
+
+def migration_thresholds(transition_matrix=None):
+    """Standard normal asset return thresholds per rating, worst outcome
+    first: a draw below the first is a default, between the first and
+    second a move to the worst rating and so on
+    """
+    if transition_matrix is None:
+        transition_matrix = rating_transition_matrix
+    probabilities = transition_matrix[credit_ratings + ['D']].values[:, ::-1]
+    probabilities = probabilities / probabilities.sum(axis=1, keepdims=True)
+    cumulative = np.clip(np.cumsum(probabilities, axis=1)[:, :-1], 1e-12, 1 - 1e-12)
+    standard_normal = NormalDist()
+    return np.vectorize(standard_normal.inv_cdf)(cumulative)
+
+def simulate_rating_migrations(bond_ratings, simulation_count, transition_matrix=None, asset_correlation=0.0,\
+                               random_state=None):
+    """End ratings of every bond over simulation_count paths, as column
+    numbers of migration_values, shaped (simulations, bonds). Asset returns
+    load asset_correlation on one market factor shared by the whole book
+    """
+    random_state = np.random.default_rng(random_state)
+    rating_numbers = dict((rating, i) for i, rating in enumerate(credit_ratings))
+    unknown = set(bond_ratings) - set(rating_numbers)
+    if unknown:
+        raise CreditError('No transition probabilities for %s' % sorted(unknown))
+    bond_rating_numbers = np.array([rating_numbers[rating] for rating in bond_ratings], dtype=np.int64)
+    thresholds = migration_thresholds(transition_matrix)
+    market = random_state.standard_normal((simulation_count, 1))
+    asset_returns = sqrt(asset_correlation) * market\
+                    + sqrt(1 - asset_correlation) * random_state.standard_normal((simulation_count, len(bond_ratings)))
+    migrations = np.empty(asset_returns.shape, dtype=np.int64)
+    for i in set(bond_rating_numbers):
+        rating_bonds = bond_rating_numbers == i
+        #Thresholds run worst first, columns of migration_values best first
+        migrations[:, rating_bonds] = len(credit_ratings) - np.searchsorted(thresholds[i], asset_returns[:, rating_bonds])
+    return migrations
+
+def credit_value_at_risk(csv_location, loss_percentile, simulation_count=10000, asset_correlation=0.2,\
+                         discount_rates=None, risk_free_rates=None, transition_matrix=None,\
+                         recovery_rate=credit_recovery_rate, day_count_convention='ACT/365F', as_of=None,\
+                         random_state=None, max_chunk_size=5000000, compounding='Daily'):
+    """One year credit VaR of the portfolio from simulated rating migrations.
+    Bonds are revalued once per rating bucket off the risk free plus spread
+    curves and each path just picks its bonds' buckets, in chunks of paths
+    holding at most max_chunk_size bond outcomes.
+    loss_percentile as a whole number, eg 99 not .99
+    """
+    portfolio = generate_portfolio(csv_location) if isinstance(csv_location, str) else csv_location
+    curve = credit_discount_rates(*credit_curves(discount_rates, risk_free_rates))
+    cashflows = portfolio_cashflows(portfolio, curve, day_count_convention, as_of)
+    values = migration_values(cashflows, curve, recovery_rate=recovery_rate, compounding=compounding)
+    bond_ratings = list(portfolio['bond_rating'])
+    bond_numbers = np.arange(len(bond_ratings))
+    chunk_size = max(1, max_chunk_size // max(len(bond_ratings), 1))
+    random_state = np.random.default_rng(random_state)
+    path_vals = []
+    for start in range(0, simulation_count, chunk_size):
+        migrations = simulate_rating_migrations(bond_ratings, min(chunk_size, simulation_count - start),\
+                                                transition_matrix, asset_correlation, random_state)
+        path_vals.append(values[bond_numbers, migrations].sum(axis=1))
+    path_vals = np.concatenate(path_vals)
+    current_ratings = [credit_ratings.index(rating) for rating in bond_ratings]
+    unmigrated_val = values[bond_numbers, current_ratings].sum()
+    expected_val = path_vals.mean()
+    worst_val = np.percentile(path_vals, 100 - loss_percentile)
+    return {'Value' : price_cashflows(cashflows, compounding=compounding).sum(),
+            'Horizon Value' : unmigrated_val,
+            'Expected Horizon Value' : expected_val,
+            'Expected Loss' : unmigrated_val - expected_val,
+            'Credit VaR' : expected_val - worst_val,
+            'Credit VaR Percentage' : (expected_val - worst_val) * 100 / expected_val}
+
+def newton_solve(values_and_slopes, targets, initial=None, tolerance=1e-10, max_iterations=50, max_step=None):
+    """Solves values(x) = targets for a whole array of unknowns at once.
+    values_and_slopes(x, rows) gives the values and derivatives for the
+    unknowns still being solved (rows indexes them), so converged ones
+    drop out of later iterations. A row has converged once its error is
+    within tolerance of max(|target|, 1). max_step caps each Newton step.
+    Returns the solutions and the per row diagnostics: iterations, whether
+    it converged and the final error
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    solutions = np.zeros(len(targets)) if initial is None else np.array(initial, dtype=np.float64)
+    iterations = np.zeros(len(targets), dtype=np.int64)
+    converged = np.zeros(len(targets), dtype=bool)
+    residuals = np.full(len(targets), np.nan)
+    rows = np.flatnonzero(np.isfinite(targets))
+    for iteration in range(max_iterations + 1):
+        if not len(rows):
+            break
+        values, slopes = values_and_slopes(solutions[rows], rows)
+        errors = values - targets[rows]
+        residuals[rows] = errors
+        done = np.abs(errors) <= tolerance * np.maximum(np.abs(targets[rows]), 1.0)
+        converged[rows[done]] = True
+        if iteration == max_iterations:
+            break
+        rows, errors, slopes = rows[~done], errors[~done], slopes[~done]
+        solvable = np.isfinite(slopes) & (slopes != 0)
+        rows, errors, slopes = rows[solvable], errors[solvable], slopes[solvable]
+        steps = errors / slopes
+        if max_step is not None:
+            steps = np.clip(steps, -max_step, max_step)
+        solutions[rows] -= steps
+        iterations[rows] += 1
+    return solutions, pd.DataFrame({'Iterations' : iterations, 'Converged' : converged, 'Residual' : residuals})
+
+def zero_curve_cashflow_discount_factors(cashflows, discount_rates=None, compounding='Daily'):
+    """Discount factor of every flow off its rating's zero curve (see
+    zero_curve_discount_factors). The factors are kept in the buffer keyed
+    by the compounding and the key rates they were built from, so asking
+    again with the same curve doesn't redo them and another curve never
+    gets them back
+    """
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    bond_ratings = np.asarray(cashflows['bond_ratings'])
+    rating_set = sorted(set(bond_ratings))
+    rating_key_rates = key_rates_by_rating(rating_set, discount_rates)
+    cache = cashflows.setdefault('zero_discount_factors', {})
+    curve_key = (compounding, rating_key_rates.tobytes())
+    if curve_key in cache:
+        return cache[curve_key]
+    flow_ratings = bond_ratings[cashflows['bond_index']]
+    discount_factors = np.zeros(len(flow_ratings))
+    for bond_rating, key_rates in zip(rating_set, rating_key_rates):
+        rating_flows = flow_ratings == bond_rating
+        discount_factors[rating_flows] = zero_curve_discount_factors(cashflows['year_fractions'][rating_flows],\
+                                                                     key_rates, compounding)
+    cache[curve_key] = discount_factors
+    return discount_factors
+
+def z_spreads(cashflows, market_values, discount_rates=None, tolerance=1e-10, max_iterations=50,\
+              compounding='Daily'):
+    """Z-spread (percent, compounded on top of the zero curve the same way
+    as the curve, see discount_kernel) of every bond given its market
+    (dirty) value, solved for the whole book in one Newton iteration over
+    the flattened flows. With the kernel's factor f and growth g for z
+        P(z)  = sum(cf * df * f)
+        P'(z) = -sum(cf * df * f * t / g) / 100
+    The zero curve discount factors are computed once and reused by every
+    iteration. Returns the spreads with the solver diagnostics
+    """
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    discounted_flows = cashflows['amounts'] * zero_curve_cashflow_discount_factors(cashflows, discount_rates,\
+                                                                                   compounding)
+    years = cashflows['year_fractions']
+    def values_and_slopes(spreads, rows):
+        #Every flow is recomputed, it's cheaper than selecting the unsolved ones
+        bond_spreads = np.zeros(bond_count)
+        bond_spreads[rows] = spreads
+        spread_factors, growth = discount_kernel(bond_spreads[bond_index], years, compounding)[:2]
+        pv_fcf = discounted_flows * spread_factors
+        values = np.bincount(bond_index, pv_fcf, bond_count)
+        slopes = -np.bincount(bond_index, pv_fcf * years / growth, bond_count) / 100
+        return values[rows], slopes[rows]
+    spreads, diagnostics = newton_solve(values_and_slopes, market_values, tolerance=tolerance,\
+                                        max_iterations=max_iterations, max_step=5.0)
+    diagnostics.insert(0, 'Z-Spread', np.where(diagnostics['Converged'], spreads, np.nan))
+    return diagnostics
+
+def z_spread_portfolio(csv_location, market_prices, discount_rates=None, day_count_convention='ACT/365F',\
+                       as_of=None, compounding='Daily'):
+    """Z-spreads of the portfolio from market prices (dirty, per 100 face)"""
+    portfolio = generate_portfolio(csv_location) if isinstance(csv_location, str) else csv_location
+    cashflows = portfolio_cashflows(portfolio, discount_rates, day_count_convention, as_of)
+    market_values = np.asarray(market_prices, dtype=np.float64) * np.asarray(portfolio['face_value']) / 100
+    return z_spreads(cashflows, market_values, discount_rates, compounding=compounding)
+
+class HullWhiteTree:
+    '''Hull-White one factor trinomial tree for the short rate, built as in
+    Hull's Options, Futures and Other Derivatives and fitted to the zero
+    curve of key_rates (see zero_curve_discount_factors), the key rates
+    read under compounding.
+    mean_reversion and volatility are the a and sigma of
+    dr = (theta(t) - a r) dt + sigma dW, rates are continuously compounded
+    decimals on the tree. Nodes are stored as one array per time step so
+    backward induction is a handful of numpy ops per step across every
+    node and every bond rolled back together
+    '''
+
+    def __init__(self, key_rates, horizon, mean_reversion=0.1, volatility=0.01, steps_per_year=12,\
+                 compounding='Daily'):
+        if mean_reversion <= 0:
+            raise CashFlowError('The Hull-White tree needs a positive mean reversion')
+        self.steps_per_year = steps_per_year
+        self.dt = dt = 1 / steps_per_year
+        self.step_count = max(int(np.ceil(horizon * steps_per_year)), 1)
+        self.dx = volatility * sqrt(3 * dt)
+        self.jmax = max(int(np.ceil(0.184 / (mean_reversion * dt))), 1)
+        node_j = np.arange(-self.jmax, self.jmax + 1)
+        self.x = node_j * self.dx
+        m = np.exp(-mean_reversion * dt) - 1
+        jm = node_j * m
+        self.pu = 1/6 + (jm*jm + jm)/2
+        self.pm = 2/3 - jm*jm
+        self.pd = 1/6 + (jm*jm - jm)/2
+        nodes = np.arange(len(node_j))
+        self.up, self.mid, self.down = nodes + 1, nodes.copy(), nodes - 1
+        #The edges branch inwards so the tree stops widening at jmax
+        top, bottom = len(node_j) - 1, 0
+        jm_top, jm_bottom = jm[top], jm[bottom]
+        self.pu[top] = 7/6 + (jm_top*jm_top + 3*jm_top)/2
+        self.pm[top] = -1/3 - jm_top*jm_top - 2*jm_top
+        self.pd[top] = 1/6 + (jm_top*jm_top + jm_top)/2
+        self.up[top], self.mid[top], self.down[top] = top, top - 1, top - 2
+        self.pu[bottom] = 1/6 + (jm_bottom*jm_bottom - jm_bottom)/2
+        self.pm[bottom] = -1/3 - jm_bottom*jm_bottom + 2*jm_bottom
+        self.pd[bottom] = 7/6 + (jm_bottom*jm_bottom - 3*jm_bottom)/2
+        self.up[bottom], self.mid[bottom], self.down[bottom] = bottom + 2, bottom + 1, bottom
+        self.compounding = compounding
+        self.alphas = self.fit(key_rates)
+
+    def fit(self, key_rates):
+        """Shift of every step's rates that reprices the zero curve, from the
+        Arrow-Debreu prices rolled forward through the tree
+        """
+        dt = self.dt
+        discount_factors = zero_curve_discount_factors(dt * np.arange(1, self.step_count + 1), key_rates,\
+                                                       self.compounding)
+        arrow_debreu = np.zeros(len(self.x))
+        arrow_debreu[self.jmax] = 1.0
+        alphas = np.zeros(self.step_count)
+        for step in range(self.step_count):
+            alphas[step] = np.log(np.dot(arrow_debreu, np.exp(-self.x * dt)) / discount_factors[step]) / dt
+            discounted = arrow_debreu * np.exp(-(alphas[step] + self.x) * dt)
+            arrow_debreu = np.bincount(self.up, discounted * self.pu, len(self.x))\
+                           + np.bincount(self.mid, discounted * self.pm, len(self.x))\
+                           + np.bincount(self.down, discounted * self.pd, len(self.x))
+        return alphas
+
+    def rollback(self, flows, calls=None, puts=None, spreads=0.0):
+        """Today's value of every row of flows, the cash paid at each step
+        (shape (bonds, step_count + 1)). After a step's flow is paid the
+        holder gets at most calls and at least puts (same shape, inf/-inf
+        where there's no exercise). spreads are per bond decimal spreads
+        added to every rate, the OAS
+        """
+        dt = self.dt
+        spread_discounts = np.exp(-np.asarray(spreads, dtype=np.float64) * dt).reshape(-1, 1)
+        vals = np.repeat(flows[:, self.step_count][:, None], len(self.x), axis=1)
+        for step in range(self.step_count - 1, -1, -1):
+            vals = (vals[:, self.up] * self.pu + vals[:, self.mid] * self.pm + vals[:, self.down] * self.pd)\
+                   * np.exp(-(self.alphas[step] + self.x) * dt) * spread_discounts
+            if calls is not None:
+                vals = np.minimum(vals, calls[:, step][:, None])
+            if puts is not None:
+                vals = np.maximum(vals, puts[:, step][:, None])
+            vals += flows[:, step][:, None]
+        return vals[:, self.jmax]
+
+def lattice_grids(cashflows, portfolio, steps_per_year):
+    """The cash flows and call/put exercise values of every bond on the
+    time steps of a tree, shaped (bonds, steps). A bond is callable
+    (putable) on each payment date from call_date (put_date) at call_price
+    (put_price) per 100 of the face still outstanding after that date
+    """
+    bond_index = cashflows['bond_index']
+    bond_count = cashflows['bond_count']
+    flow_steps = np.round(cashflows['year_fractions'] * steps_per_year).astype(np.int64)
+    step_count = (flow_steps.max() if len(flow_steps) else 0) + 1
+    flat_steps = bond_index * step_count + flow_steps
+    flows = np.bincount(flat_steps, cashflows['amounts'], bond_count * step_count).reshape(bond_count, step_count)
+    principals = cashflows['amounts'] - cashflows['coupons']
+    #Face left after each flow, summing principals back from each bond's last flow
+    bond_principals = np.bincount(bond_index, principals, bond_count)
+    outstanding_face = bond_principals[bond_index] - (np.cumsum(principals) - (np.cumsum(bond_principals)\
+                                                      - bond_principals)[bond_index])
+    exercise = {}
+    for date_column, price_column, initial, combine in [('call_date', 'call_price', np.inf, np.minimum),\
+                                                        ('put_date', 'put_price', -np.inf, np.maximum)]:
+        exercise_dates = portfolio_column(portfolio, date_column, '')
+        if not any(exercise_dates):
+            exercise[date_column] = None
+            continue
+        first_ordinals = np.array([BankDate(date).toordinal() if date else np.iinfo(np.int64).max\
+                                   for date in exercise_dates], dtype=np.int64)
+        prices = np.asarray(portfolio_column(portfolio, price_column, 100.0), dtype=np.float64)
+        exercisable = (cashflows['ordinals'] >= first_ordinals[bond_index]) & (outstanding_face > 1e-9)
+        grid = np.full(bond_count * step_count, initial)
+        combine.at(grid, flat_steps[exercisable],\
+                   prices[bond_index[exercisable]] / 100 * outstanding_face[exercisable])
+        exercise[date_column] = grid.reshape(bond_count, step_count)
+    return flows, exercise['call_date'], exercise['put_date']
+
+def lattice_analytics(csv_location, market_prices=None, mean_reversion=0.1, volatility=0.01, steps_per_year=12,\
+                      bump=0.01, discount_rates=None, day_count_convention='ACT/365F', as_of=None,\
+                      tolerance=1e-8, max_iterations=50, compounding='Daily'):
+    """Values callable and putable bonds (call_date/call_price,
+    put_date/put_price columns) on a Hull-White tree per rating, fitted to
+    the rating's curve in discount_rates.
+    With market_prices (dirty, per 100 face, one per bond) the OAS (percent)
+    that reprices each bond is solved by newton_solve for all bonds at
+    once, the slope from a second rollback, otherwise the OAS is zero. Effective duration and
+    convexity bump the curve by bump (percent) holding the OAS.
+    Bonds with identical terms (and price) are rolled back once, so a book
+    of many similar bonds costs one tree per rating and a rollback per
+    distinct bond.
+    Option Value is straight minus optioned value, positive for calls
+    """
+    portfolio = generate_portfolio(csv_location) if isinstance(csv_location, str) else csv_location
+    portfolio = portfolio.reset_index(drop=True)
+    if discount_rates is None:
+        discount_rates = yesterdays_yield_close_values_corp
+    terms = portfolio.drop(columns='face_value').astype(str)
+    if market_prices is not None:
+        terms['market_price'] = np.asarray(market_prices, dtype=np.float64)
+    structures = terms.groupby(list(terms.columns), sort=False, dropna=False).ngroup().values
+    structure_rows = np.unique(structures, return_index=True)[1]
+    structure_portfolio = portfolio.iloc[structure_rows].reset_index(drop=True)
+    structure_portfolio['face_value'] = 100.0
+    cashflows = portfolio_cashflows(structure_portfolio, discount_rates, day_count_convention, as_of)
+    flows, calls, puts = lattice_grids(cashflows, structure_portfolio, steps_per_year)
+    structure_count = len(structure_portfolio)
+    results = dict((column, np.zeros(structure_count)) for column in\
+                   ['Bond Value', 'Straight Value', 'OAS', 'Effective Duration', 'Effective Convexity'])
+    results['OAS Iterations'] = np.zeros(structure_count, dtype=np.int64)
+    results['OAS Converged'] = np.ones(structure_count, dtype=bool)
+    structure_ratings = np.asarray(structure_portfolio['bond_rating'])
+    for bond_rating in sorted(set(structure_ratings)):
+        rows = np.flatnonzero(structure_ratings == bond_rating)
+        last_step = np.flatnonzero(flows[rows].any(axis=0))
+        step_count = (last_step.max() if len(last_step) else 0)
+        rating_flows = flows[rows, :step_count + 1]
+        rating_calls = None if calls is None else calls[rows, :step_count + 1]
+        rating_puts = None if puts is None else puts[rows, :step_count + 1]
+        key_rates = key_rates_by_rating([bond_rating], discount_rates)[0]
+        def tree_values(tree, spreads, exercise=True, subset=slice(None)):
+            if exercise:
+                return tree.rollback(rating_flows[subset], None if rating_calls is None else rating_calls[subset],\
+                                     None if rating_puts is None else rating_puts[subset], spreads)
+            return tree.rollback(rating_flows[subset], spreads=spreads)
+        tree = HullWhiteTree(key_rates, step_count / steps_per_year, mean_reversion, volatility, steps_per_year,\
+                             compounding)
+        spreads = np.zeros(len(rows))
+        if market_prices is not None:
+            targets = np.asarray(terms['market_price'].values[structure_rows][rows], dtype=np.float64)
+            def values_and_slopes(oas, subset):
+                vals = tree_values(tree, oas, subset=subset)
+                return vals, (tree_values(tree, oas + 1e-6, subset=subset) - vals) / 1e-6
+            spreads, diagnostics = newton_solve(values_and_slopes, targets, tolerance=tolerance,\
+                                                max_iterations=max_iterations, max_step=0.05)
+            results['OAS Iterations'][rows] = diagnostics['Iterations'].values
+            results['OAS Converged'][rows] = diagnostics['Converged'].values
+        vals = tree_values(tree, spreads)
+        bumped_down = tree_values(HullWhiteTree(key_rates - bump, step_count / steps_per_year, mean_reversion,\
+                                                volatility, steps_per_year, compounding), spreads)
+        bumped_up = tree_values(HullWhiteTree(key_rates + bump, step_count / steps_per_year, mean_reversion,\
+                                              volatility, steps_per_year, compounding), spreads)
+        results['Bond Value'][rows] = vals
+        results['Straight Value'][rows] = tree_values(tree, spreads, exercise=False)
+        results['OAS'][rows] = spreads * 100
+        results['Effective Duration'][rows] = (bumped_down - bumped_up) / (2 * vals * bump / 100)
+        results['Effective Convexity'][rows] = (bumped_down + bumped_up - 2 * vals) / (vals * (bump / 100) ** 2)
+    face_scale = np.asarray(portfolio['face_value'], dtype=np.float64) / 100
+    analytics = pd.DataFrame(dict((column, results[column][structures]) for column in results))
+    for column in ['Bond Value', 'Straight Value']:
+        analytics[column] *= face_scale
+    analytics['Option Value'] = analytics['Straight Value'] - analytics['Bond Value']
+    return analytics[['Bond Value', 'Straight Value', 'Option Value', 'OAS', 'Effective Duration',\
+                      'Effective Convexity', 'OAS Iterations', 'OAS Converged']]
+
+def value_at_risk_yield_change_upper_bound_by_rating(csv_location, loss_percentile, sketches=None):
     """Takes a table of daily bond yield quotes, 
     extracts the quotes for the ratings,
     (currently supported bond ratings limited to                    
@@ -776,13 +2355,18 @@ def value_at_risk_yield_change_upper_bound_by_rating(csv_location, loss_percenti
     determines the lower bound for the inputted percentile 
     (percentile as a whole number, eg 95th percentile as 95 not .95)
     Intended to be run before trading, once a trading day and the VaR bounds should be stored
+    With sketches (a YieldChangeSketches) the percentiles are read off the
+    streaming sketches and the csv isn't loaded
     """
-    daily_yield_change_array = generate_yield_comparison_table_raw(csv_location)
     upper_bounds = []
     bond_ratings_set = ['2yr_AA','2yr_A',\
         '5yr_AAA','5yr_AA', '5yr_A',\
         '10yr_AAA','10yr_AA','10yr_A',\
         '20yr_AAA','20yr_AA', '20yr_A']
+    if sketches is not None:
+        return dict((bond_rating_val, sketches.percentile(bond_rating_val, loss_percentile))\
+                    for bond_rating_val in bond_ratings_set)
+    daily_yield_change_array = generate_yield_comparison_table_raw(csv_location)
     for bond_rating_val in bond_ratings_set:
         daily_yield_change_rating_specific_no_date = daily_yield_change_array[bond_rating_val]
         upper_bound = np.percentile(daily_yield_change_rating_specific_no_date,loss_percentile)
@@ -790,61 +2374,443 @@ def value_at_risk_yield_change_upper_bound_by_rating(csv_location, loss_percenti
     upper_bound_set = dict(zip(bond_ratings_set,upper_bounds))
     return upper_bound_set
 
-def value_at_risk_single_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,csv_location,loss_percentile):
-    bond_val = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type)[0]
-    bond_maturity_remaining = (BankDate().nbr_of_days(maturity_date))/365
-    if bond_maturity_remaining < 2:
-        bond_rating = str('2yr_' + bond_rating)
-        discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
-    elif 2 <= bond_maturity_remaining <= 3.5:
-        bond_rating = str('2yr_' + bond_rating)
-        discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
-    elif 3.5 < bond_maturity_remaining <= 7.5:
-        bond_rating = str('5yr_' + bond_rating)
-        discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
-    elif 7.5 < bond_maturity_remaining <= 15:
-        bond_rating = str('10yr_' + bond_rating)
-        discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
-    elif 15 < bond_maturity_remaining:
-        bond_rating = str('20yr_' + bond_rating)
-        discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
-    else:
-        print('WTF')
-
-    upper_bound = value_at_risk_yield_change_upper_bound_by_rating(csv_location,loss_percentile)[bond_rating]
+#Maturity (years) up to which the 2, 5 and 10yr yield columns are used for
+#VaR, the 20yr beyond
+var_bucket_edges = [3.5, 7.5, 15]
+var_bucket_tenors = ['2yr', '5yr', '10yr', '20yr']
+
+def tenor_bucket(maturity_years):
+    """The yield column tenor ('2yr', '5yr', '10yr' or '20yr') VaR uses for
+    a remaining maturity in years, or an array of them for an array"""
+    buckets = np.array(var_bucket_tenors)[np.searchsorted(var_bucket_edges, maturity_years, side='left')]
+    return str(buckets) if np.ndim(buckets) == 0 else buckets
+
+def value_at_risk_single_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,csv_location,loss_percentile,\
+                              as_of=None,upper_bounds=None):
+    #upper_bounds lets callers pass value_at_risk_yield_change_upper_bound_by_rating output they already have
+    bond_val = value_bond(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,as_of=as_of)[0]
+    bond_maturity_remaining = (BankDate(as_of).nbr_of_days(maturity_date))/365
+    bond_rating = tenor_bucket(bond_maturity_remaining) + '_' + bond_rating
+    discount_rate = yesterdays_yield_close_values_corp.at[0,bond_rating]
+
+    if upper_bounds is None:
+        upper_bounds = value_at_risk_yield_change_upper_bound_by_rating(csv_location,loss_percentile)
+    upper_bound = upper_bounds[bond_rating]
     new_discount_rate = discount_rate + upper_bound
-    new_bond_val = value_bond_var(face_value,maturity_date,coupon_rate,payments_per_year,new_discount_rate)[0]
+    new_bond_val = value_bond_var(face_value,maturity_date,coupon_rate,payments_per_year,new_discount_rate,\
+                                  as_of=as_of)[0]
     v_a_r_single_bond = bond_val - new_bond_val
     v_a_r_single_bond_percent = v_a_r_single_bond * 100 / bond_val
     return {'VaR' : v_a_r_single_bond, 'VaR Percentage' : v_a_r_single_bond_percent}
 
-yield_change_matrix = generate_yield_comparison_table_raw ('/Users/baronabramowitz/Desktop/cleaned_corporate_bond_yield_change_data.csv')
-yield_change_corr_matrix = yield_change_matrix.corr()
-yield_change_cov_matrix = yield_change_matrix.cov()
+class CovarianceEngine:
+    """Rolling window and EWMA covariance of daily yield changes.
+    A running mean and the co-moments about it (Welford) are kept so a new
+    day of yield changes costs O(k**2) instead of a rescan of the whole
+    history, without the cancellation of sum(x*x) - sum(x)**2/n.
+    window=None keeps every observation (same as DataFrame.cov())
+    """
+    def __init__(self, columns, window=None, ewma_lambda=0.94):
+        self.columns = list(columns)
+        k = len(self.columns)
+        self.window = window
+        self.ewma_lambda = ewma_lambda
+        self.window_buffer = np.zeros((window or 0, k))
+        self.window_position = 0
+        self.window_count = 0
+        self.window_mean = np.zeros(k)
+        self.window_comoment = np.zeros((k, k))
+        self.ewma_mean = np.zeros(k)
+        self.ewma_cov = np.zeros((k, k))
+        self.observations = 0
+        self.last_date = None
+
+    def update(self, yield_changes, date=None):
+        """Adds one day of yield changes (ordered as self.columns)"""
+        self.update_many([yield_changes], None if date is None else [date])
+
+    def update_many(self, yield_changes, dates=None):
+        """Adds days of yield changes, oldest first, the same as update day
+        by day. A history longer than the window refills it in one go, the
+        full history merges the new days' co-moments (Chan et al) and the
+        EWMA covariance is one weighted matrix product, so only the EWMA
+        mean is stepped through day by day
+        """
+        rows = np.asarray(yield_changes, dtype=np.float64).reshape(-1, len(self.columns))
+        if not len(rows):
+            return
+        if self.window and len(rows) >= self.window:
+            self.window_buffer = rows[-self.window:].copy()
+            self.window_position = 0
+            self.window_count = self.window
+            self.window_mean = self.window_buffer.mean(axis=0)
+            centred = self.window_buffer - self.window_mean
+            self.window_comoment = np.dot(centred.T, centred)
+        elif self.window:
+            for x in rows:
+                self._update_window(x)
+        else:
+            new_mean = rows.mean(axis=0)
+            centred = rows - new_mean
+            total = self.window_count + len(rows)
+            delta = new_mean - self.window_mean
+            self.window_comoment = self.window_comoment + np.dot(centred.T, centred)\
+                                   + np.outer(delta, delta) * self.window_count * len(rows) / total
+            self.window_mean = self.window_mean + delta * len(rows) / total
+            self.window_count = total
+
+        #cov_t = lambda * (cov_t-1 + (1 - lambda) * outer(delta_t, delta_t)), delta_t off the previous mean
+        first = 0
+        if self.observations == 0:
+            self.ewma_mean = rows[0].copy()
+            first = 1
+        previous_means = np.empty((len(rows) - first, len(self.columns)))
+        mean = self.ewma_mean.copy()
+        for i, x in enumerate(rows[first:]):
+            previous_means[i] = mean
+            mean += (1 - self.ewma_lambda) * (x - mean)
+        deltas = rows[first:] - previous_means
+        weights = (1 - self.ewma_lambda) * self.ewma_lambda ** np.arange(len(deltas), 0, -1)
+        self.ewma_cov = self.ewma_lambda ** len(deltas) * self.ewma_cov + np.dot((deltas * weights[:, None]).T, deltas)
+        self.ewma_mean = mean
+        self.observations += len(rows)
+        if dates is not None:
+            self.last_date = str(dates[-1])
+
+    def _update_window(self, x):
+        if self.window:
+            if self.window_count == self.window:
+                self._remove_from_window(self.window_buffer[self.window_position])
+            self.window_buffer[self.window_position] = x
+            self.window_position = (self.window_position + 1) % self.window
+            if self.window_position == 0:
+                #Recentre once per full window so the removals don't drift
+                self.window_count = self.window
+                self.window_mean = self.window_buffer.mean(axis=0)
+                centred = self.window_buffer - self.window_mean
+                self.window_comoment = np.dot(centred.T, centred)
+            else:
+                self._add_to_window(x)
+        else:
+            self._add_to_window(x)
+
+    def _add_to_window(self, x):
+        self.window_count += 1
+        delta = x - self.window_mean
+        self.window_mean += delta / self.window_count
+        self.window_comoment += np.outer(delta, x - self.window_mean)
+
+    def _remove_from_window(self, x):
+        #The inverse of _add_to_window
+        self.window_count -= 1
+        if self.window_count == 0:
+            self.window_mean = np.zeros(len(self.columns))
+            self.window_comoment = np.zeros((len(self.columns), len(self.columns)))
+            return
+        delta = x - self.window_mean
+        self.window_mean -= delta / self.window_count
+        self.window_comoment -= np.outer(x - self.window_mean, delta)
+
+    def update_from_table(self, yield_change_table):
+        """Feeds the rows of a yield change table dated after the last update,
+        oldest first (the csv files are stored newest first). Dates are
+        compared as dates so unpadded strings are ordered right
+        """
+        date_ordinals = iso_date_ordinals(yield_change_table['Date'], 'Date')
+        new_rows = np.arange(len(yield_change_table))
+        if self.last_date is not None:
+            new_rows = new_rows[date_ordinals > BankDate(self.last_date).toordinal()]
+        new_rows = new_rows[np.argsort(date_ordinals[new_rows], kind='stable')]
+        if len(new_rows):
+            self.update_many(yield_change_table[self.columns].to_numpy(dtype=np.float64)[new_rows],\
+                             [BankDate(_pythondate.fromordinal(int(date_ordinals[new_rows[-1]])))])
+        return len(new_rows)
+
+    def rolling_covariance(self):
+        cov = self.window_comoment / (self.window_count - 1)
+        return pd.DataFrame(cov, index=self.columns, columns=self.columns)
+
+    def ewma_covariance(self):
+        return pd.DataFrame(self.ewma_cov, index=self.columns, columns=self.columns)
 
-def value_at_risk_portfolio_set(portfolio_csv_location,loss_percentile):
+    @staticmethod
+    def _to_correlation(cov):
+        stdev = np.sqrt(np.diag(cov.values))
+        return cov / np.outer(stdev, stdev)
+
+    def rolling_correlation(self):
+        return self._to_correlation(self.rolling_covariance())
+
+    def ewma_correlation(self):
+        return self._to_correlation(self.ewma_covariance())
+
+    def save(self, state_location):
+        np.savez(state_location,
+                 columns=np.array(self.columns),
+                 settings=np.array([self.window or 0, self.ewma_lambda,
+                                    self.window_position, self.window_count, self.observations]),
+                 last_date=np.array(self.last_date or ''),
+                 window_buffer=self.window_buffer,
+                 window_mean=self.window_mean,
+                 window_comoment=self.window_comoment,
+                 ewma_mean=self.ewma_mean,
+                 ewma_cov=self.ewma_cov)
+
+    @classmethod
+    def load(cls, state_location):
+        with np.load(state_location) as state:
+            window, ewma_lambda, position, count, observations = state['settings']
+            engine = cls(list(state['columns']), int(window) or None, float(ewma_lambda))
+            engine.window_position = int(position)
+            engine.window_count = int(count)
+            engine.observations = int(observations)
+            engine.last_date = str(state['last_date']) or None
+            engine.window_buffer = state['window_buffer']
+            engine.window_mean = state['window_mean']
+            engine.window_comoment = state['window_comoment']
+            engine.ewma_mean = state['ewma_mean']
+            engine.ewma_cov = state['ewma_cov']
+        return engine
+
+def load_covariance_engine(state_location, yield_change_table, window=None, ewma_lambda=0.94, save=True):
+    """Restores the covariance state saved by the previous run and rolls it
+    forward over the days that arrived since, then saves it again unless
+    save is False. Falls back to building from the full history the first
+    time
+    """
+    try:
+        engine = CovarianceEngine.load(state_location)
+        if engine.window != window or engine.ewma_lambda != ewma_lambda:
+            raise ValueError('Covariance state settings changed')
+    except (IOError, ValueError, KeyError):
+        engine = CovarianceEngine([column for column in yield_change_table.columns if column != 'Date'],\
+                                  window, ewma_lambda)
+    if engine.update_from_table(yield_change_table) and save:
+        engine.save(state_location)
+    return engine
+
+class QuantileSketch:
+    """Streaming percentiles in bounded memory, a merging t-digest.
+    Values are buffered and folded into at most about compression/2
+    weighted centroids, small ones in the tails and large ones in the
+    middle, so extreme percentiles stay accurate. Sketches built on
+    separate shards of data can be merged. A percentile is an
+    interpolation between the centroids, however long the history
+    """
+    def __init__(self, compression=500):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._ranks = None
+        self._values = None
+
+    def update(self, values):
+        """Adds one value or an array of them"""
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        self.buffer.append(values)
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._ranks = None
+        if sum(len(buffered) for buffered in self.buffer) > 5 * self.compression:
+            self._compress()
+
+    def _compress(self):
+        means = np.concatenate([self.means] + self.buffer)
+        weights = np.concatenate([self.weights] + [np.ones(len(buffered)) for buffered in self.buffer])
+        self.buffer = []
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        if len(means) <= self.compression:
+            #Short histories are kept exactly
+            self.means, self.weights = means, weights
+            return
+        total = weights.sum()
+        #Greedy merge, a centroid grows while it spans at most one step of
+        #the k1 scale k(q) = compression/(2 pi) * asin(2q - 1)
+        scale = self.compression / (2 * np.pi)
+        merged_means, merged_weights = [], []
+        current_mean, current_weight = means[0], weights[0]
+        merged_below = 0.0
+        quantile_limit = (np.sin(min(np.arcsin(-1.0) + 1 / scale, np.pi / 2)) + 1) / 2
+        for mean, weight in zip(means[1:], weights[1:]):
+            if (merged_below + current_weight + weight) / total <= quantile_limit:
+                current_mean += (mean - current_mean) * weight / (current_weight + weight)
+                current_weight += weight
+            else:
+                merged_means.append(current_mean)
+                merged_weights.append(current_weight)
+                merged_below += current_weight
+                k = np.arcsin(2 * merged_below / total - 1) + 1 / scale
+                quantile_limit = (np.sin(min(k, np.pi / 2)) + 1) / 2
+                current_mean, current_weight = mean, weight
+        merged_means.append(current_mean)
+        merged_weights.append(current_weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def percentile(self, percentile):
+        """The percentile (whole number, eg 95 not .95) of every value added,
+        interpolated between the centroid ranks like np.percentile"""
+        if not self.count:
+            return np.nan
+        if self._ranks is None:
+            if self.buffer:
+                self._compress()
+            self._ranks = np.concatenate(([0.0], np.cumsum(self.weights) - self.weights / 2 - 0.5, [self.count - 1.0]))
+            self._values = np.concatenate(([self.min], self.means, [self.max]))
+        return float(np.interp(percentile / 100 * (self.count - 1), self._ranks, self._values))
+
+    @classmethod
+    def merge(cls, sketches):
+        """One sketch of everything the given sketches have seen"""
+        sketches = list(sketches)
+        merged = cls(sketches[0].compression if sketches else 500)
+        for sketch in sketches:
+            merged.means = np.concatenate((merged.means, sketch.means))
+            merged.weights = np.concatenate((merged.weights, sketch.weights))
+            merged.buffer.extend(sketch.buffer)
+            merged.count += sketch.count
+            merged.min = min(merged.min, sketch.min)
+            merged.max = max(merged.max, sketch.max)
+        merged._compress()
+        return merged
+
+class YieldChangeSketches:
+    """A QuantileSketch of the daily yield changes of every rating/tenor
+    column, fed as new days land, standing in for np.percentile over the
+    whole history in value_at_risk_yield_change_upper_bound_by_rating
+    """
+    def __init__(self, columns, compression=500):
+        self.columns = list(columns)
+        self.compression = compression
+        self.sketches = dict((column, QuantileSketch(compression)) for column in self.columns)
+        self.last_date = None
+
+    def update_from_table(self, yield_change_table):
+        """Feeds the rows of a yield change table dated after the last update,
+        compared as dates so unpadded strings are ordered right"""
+        date_ordinals = iso_date_ordinals(yield_change_table['Date'], 'Date')
+        new_rows = yield_change_table
+        if self.last_date is not None:
+            is_new = date_ordinals > BankDate(self.last_date).toordinal()
+            new_rows, date_ordinals = new_rows[is_new], date_ordinals[is_new]
+        for column in self.columns:
+            self.sketches[column].update(new_rows[column].values)
+        if len(new_rows):
+            self.last_date = str(BankDate(_pythondate.fromordinal(int(date_ordinals.max()))))
+        return len(new_rows)
+
+    def percentile(self, column, percentile):
+        return self.sketches[column].percentile(percentile)
+
+    def upper_bounds(self, loss_percentile):
+        return dict((column, self.percentile(column, loss_percentile)) for column in self.columns)
+
+    @classmethod
+    def merge(cls, sketch_sets):
+        """Combines sketch sets built over separate shards of the history"""
+        sketch_sets = list(sketch_sets)
+        merged = cls(sketch_sets[0].columns, sketch_sets[0].compression)
+        for column in merged.columns:
+            merged.sketches[column] = QuantileSketch.merge(sketch_set.sketches[column] for sketch_set in sketch_sets)
+        last_dates = [sketch_set.last_date for sketch_set in sketch_sets if sketch_set.last_date is not None]
+        merged.last_date = max(last_dates, key=lambda date: BankDate(date).toordinal()) if last_dates else None
+        return merged
+
+    def save(self, state_location):
+        state = {'columns' : np.array(self.columns),
+                 'compression' : np.array(self.compression),
+                 'last_date' : np.array(self.last_date or '')}
+        for i, column in enumerate(self.columns):
+            sketch = self.sketches[column]
+            if sketch.buffer:
+                sketch._compress()
+            state['means_%s' % i] = sketch.means
+            state['weights_%s' % i] = sketch.weights
+            state['summary_%s' % i] = np.array([sketch.count, sketch.min, sketch.max])
+        np.savez(state_location, **state)
+
+    @classmethod
+    def load(cls, state_location):
+        with np.load(state_location) as state:
+            sketch_set = cls(list(state['columns']), int(state['compression']))
+            sketch_set.last_date = str(state['last_date']) or None
+            for i, column in enumerate(sketch_set.columns):
+                sketch = sketch_set.sketches[column]
+                sketch.means = state['means_%s' % i]
+                sketch.weights = state['weights_%s' % i]
+                count, sketch.min, sketch.max = state['summary_%s' % i]
+                sketch.count = int(count)
+        return sketch_set
+
+def load_yield_change_sketches(state_location, yield_change_table, compression=500):
+    """Restores the sketches saved by the previous run, adds the days that
+    arrived since and saves them again, building from the full history the
+    first time
+    """
+    try:
+        sketch_set = YieldChangeSketches.load(state_location)
+        if sketch_set.compression != compression:
+            raise ValueError('Quantile sketch settings changed')
+    except (IOError, ValueError, KeyError):
+        sketch_set = YieldChangeSketches([column for column in yield_change_table.columns if column != 'Date'],\
+                                         compression)
+    if sketch_set.update_from_table(yield_change_table):
+        sketch_set.save(state_location)
+    return sketch_set
+
+yield_change_csv_location = '/Users/baronabramowitz/Desktop/cleaned_corporate_bond_yield_change_data.csv'
+covariance_state_location = '/Users/baronabramowitz/Desktop/yield_change_covariance_state.npz'
+
+covariance_window = 250
+covariance_ewma_lambda = 0.94
+
+#Importing restores the saved covariance state and rolls it forward in
+#memory, the state file is only written by reload_market_data(save_state=True)
+yield_change_matrix = generate_yield_comparison_table_raw (yield_change_csv_location)
+yield_change_cov_engine = load_covariance_engine(covariance_state_location, yield_change_matrix,\
+                                                 covariance_window, covariance_ewma_lambda, save=False)
+yield_change_corr_matrix = yield_change_cov_engine.rolling_correlation()
+yield_change_cov_matrix = yield_change_cov_engine.rolling_covariance()
+yield_change_ewma_corr_matrix = yield_change_cov_engine.ewma_correlation()
+yield_change_ewma_cov_matrix = yield_change_cov_engine.ewma_covariance()
+
+def reload_market_data(save_state=False):
+    """Rereads yesterday's closes and the yield change history and rolls
+    the covariance forward, as on import. For long running callers once the
+    day has rolled over. save_state writes the rolled covariance state back
+    to covariance_state_location for the next run
+    """
+    global yesterdays_yield_close_values_corp, yield_change_matrix, yield_change_cov_engine,\
+           yield_change_corr_matrix, yield_change_cov_matrix, yield_change_ewma_corr_matrix,\
+           yield_change_ewma_cov_matrix
+    yesterdays_yield_close_values_corp = generate_yield_comparison_table_raw(yield_close_csv_location).iloc[[0]]
+    yield_change_matrix = generate_yield_comparison_table_raw(yield_change_csv_location)
+    yield_change_cov_engine = load_covariance_engine(covariance_state_location, yield_change_matrix,\
+                                                     covariance_window, covariance_ewma_lambda, save=save_state)
+    yield_change_corr_matrix = yield_change_cov_engine.rolling_correlation()
+    yield_change_cov_matrix = yield_change_cov_engine.rolling_covariance()
+    yield_change_ewma_corr_matrix = yield_change_cov_engine.ewma_correlation()
+    yield_change_ewma_cov_matrix = yield_change_cov_engine.ewma_covariance()
+
+def value_at_risk_portfolio_set(portfolio_csv_location,loss_percentile,as_of=None):
     portfolio = generate_portfolio(portfolio_csv_location)
-    val_portfolio_output = value_portfolio(portfolio_csv_location)
+    val_portfolio_output = value_portfolio(portfolio_csv_location, as_of=as_of)
     portfolio_proportions = []
     for bond_val in val_portfolio_output[1]:
         bond_val = bond_val/val_portfolio_output[0]
         portfolio_proportions.append(bond_val)
 
     print(val_portfolio_output[2])
-    maturity_list = []
-    for maturity in val_portfolio_output[2]:
-        if maturity < 2:
-            maturity_list.append(str('2yr_'))
-        elif 2 <= maturity <= 3.5:
-            maturity_list.append(str('2yr_'))
-        elif 3.5 < maturity <= 7.5:
-            maturity_list.append(str('5yr_'))
-        elif 7.5 < maturity <= 15:
-            maturity_list.append(str('10yr_'))
-        elif 15 < maturity:
-            maturity_list.append(str('20yr_'))
-        else:
-            print('WTF')
+    maturity_list = [tenor + '_' for tenor in tenor_bucket(val_portfolio_output[2])]
     print(maturity_list)
 
     loss_percentiles_pre_zip = []
@@ -861,7 +2827,7 @@ def value_at_risk_portfolio_set(portfolio_csv_location,loss_percentile):
                    portfolio['payments_per_year'],portfolio['bond_rating'],portfolio['bond_type'],\
                    yield_change_csv_location_pre_zip,loss_percentiles_pre_zip):
         bond_rating_list.append(bond[4])
-        bond_var = value_at_risk_single_bond(*bond)['VaR']
+        bond_var = value_at_risk_single_bond(*bond, as_of=as_of)['VaR']
         bond_var_squared = bond_var ** 2
         bond_var_portfolio_squared.append(bond_var_squared)
     bond_rating_maturity = list(map(str.__add__,maturity_list,bond_rating_list))
@@ -880,12 +2846,31 @@ def value_at_risk_portfolio_set(portfolio_csv_location,loss_percentile):
 class test_suite(unittest.TestCase):
      """Large Selection of Tests for the above code"""
      def test_bond_convexity(self):
-         self.assertEqual(35.18162670582754,convexity_bond(10000.0, '2022-06-15', 2.5, 2, 'AAA','Corporate'))
+         #Convexity against a revaluation 1bp either side of the bond's discount rate
+         args = (10000.0, str(BankDate() + '2y'), 2.5, 2)
+         discount_rate = value_bond(*args, 'AA', 'Corporate')[4]
+         for compounding in compounding_conventions:
+             bond_val, up_val, down_val = [value_bond_var(*args, discount_rate + shift, compounding=compounding)[0]\
+                                           for shift in [0.0, 0.01, -0.01]]
+             self.assertAlmostEqual((up_val + down_val - 2 * bond_val) / (bond_val * 1e-8),\
+                                    convexity_bond(*args, 'AA', 'Corporate', compounding=compounding), places=4)
      def test_portfoio_convexity(self):
-         self.assertEqual(135.44277212465033,convexity_portfolio('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'))
+         #Value weighted bond convexities against the book revalued 1bp either side
+         portfolio_csv_location = '/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'
+         cashflows = portfolio_cashflows(generate_portfolio(portfolio_csv_location))
+         book_val, up_val, down_val = [price_cashflows(cashflows, shift).sum() for shift in [0.0, 0.01, -0.01]]
+         self.assertAlmostEqual((up_val + down_val - 2 * book_val) / (book_val * 1e-8),\
+                                convexity_portfolio(portfolio_csv_location), places=3)
      def test_portfolio_duration(self):
-         self.assertEqual({'Modified Portfolio Duration': 10.662022505468682,
- 'Portfolio Duration': 10.936440783039282},portfolio_duration('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'))
+         portfolio_csv_location = '/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'
+         cashflows = portfolio_cashflows(generate_portfolio(portfolio_csv_location))
+         book_val, up_val, down_val = [price_cashflows(cashflows, shift).sum() for shift in [0.0, 0.01, -0.01]]
+         self.assertAlmostEqual((down_val - up_val) / (book_val * 2e-4),\
+                                portfolio_duration(portfolio_csv_location)['Modified Portfolio Duration'], places=4)
+         #Compounded continuously the Macaulay and modified durations agree
+         continuous_duration = portfolio_duration(portfolio_csv_location, compounding='Continuous')
+         self.assertAlmostEqual(continuous_duration['Portfolio Duration'],\
+                                continuous_duration['Modified Portfolio Duration'], places=10)
      def test_value_portfolio(self):
          self.assertEqual((5328131.2278631562,
  [10827.821620777519,
@@ -896,10 +2881,397 @@ class test_suite(unittest.TestCase):
   353237.85002647078,
   439159.02809525008,
   302270.75075817748]),value_portfolio('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'))
+     def test_rolling_covariance_engine(self):
+        #Checks the incremental window covariance against a full rescan
+        rating_columns = [column for column in yield_change_matrix.columns if column != 'Date']
+        engine = CovarianceEngine(rating_columns, window=250)
+        engine.update_from_table(yield_change_matrix)
+        np.testing.assert_allclose(yield_change_matrix[rating_columns].iloc[:250].cov().values,\
+            engine.rolling_covariance().values, atol=1e-12)
+     def test_key_rate_durations_sum_to_parallel_duration(self):
+        #Key rate weights sum to one so the key rate durations add up to the duration for a
+        #parallel move of the bond's discount rate, here for a 7 year bond between the 5yr and 10yr
+        bond = single_bond_portfolio(10000.0, str(BankDate() + '7y'), 3.0, 2, 'AA', 'Corporate')
+        cashflows = portfolio_cashflows(bond)
+        bond_val = price_cashflows(cashflows)[0]
+        parallel_duration = (price_cashflows(cashflows, -0.01)[0] - price_cashflows(cashflows, 0.01)[0])\
+                            / (2 * 0.0001 * bond_val)
+        key_durations = key_rate_durations(cashflows)[1][0]
+        self.assertAlmostEqual(parallel_duration, key_durations.sum(), places=5)
+        #The 7 year point sits nearer the 5yr tenor and takes most of its weight from it
+        self.assertGreater(key_durations[1], key_durations[2])
+        self.assertEqual([0.0, 0.0], list(key_durations[[0, 3]]))
+        np.testing.assert_allclose(key_rate_weights([1.0, 3.5, 7.0, 15.0, 30.0]).sum(axis=1), 1.0)
+        np.testing.assert_allclose(key_rate_weights(3.5)[0], [0.5, 0.5, 0.0, 0.0])
+     def test_analytic_dv01_matches_repricing(self):
+        #Checks the analytic DV01 against a 1bp bump and reprice of the cached flows
+        bond = generate_portfolio('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv').iloc[[0]]
+        cashflows = portfolio_cashflows(bond)
+        bumped_dv01 = (price_cashflows(cashflows, -0.01)[0] - price_cashflows(cashflows, 0.01)[0]) / 2
+        self.assertAlmostEqual(bumped_dv01, cashflow_analytics(cashflows)['DV01'][0], places=6)
+     def test_day_count_year_fractions(self):
+        start = np.array([_pythondate(2015, 12, 31).toordinal(), _pythondate(2016, 1, 31).toordinal()])
+        end = np.array([_pythondate(2016, 12, 31).toordinal(), _pythondate(2016, 3, 31).toordinal()])
+        np.testing.assert_allclose(year_fraction(start, end, 'ACT/360'), [366 / 360, 60 / 360])
+        np.testing.assert_allclose(year_fraction(start, end, 'ACT/ACT ISDA'), [1 / 365 + 365 / 366, 60 / 366])
+        np.testing.assert_allclose(year_fraction(start, end, '30/360'), [1, 60 / 360])
+     def test_as_of_batch_matches_single_dates(self):
+        #Rebasing one set of cash flows has to agree with valuing each date from scratch
+        portfolio_csv_location = '/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'
+        as_of_dates = [BankDate(), BankDate() + '45d', BankDate() + '1y']
+        batch_vals = value_portfolio_as_of_dates(portfolio_csv_location, as_of_dates)['Portfolio Value']
+        for as_of, batch_val in zip(as_of_dates, batch_vals):
+            self.assertAlmostEqual(value_portfolio(portfolio_csv_location, as_of=as_of)[0], batch_val, places=6)
+     def test_discount_kernel_duration_matches_bumped_value(self):
+         #Modified duration from the kernel's growth term against a revaluation 1bp either side
+         args = (10000.0, str(BankDate() + '7y'), 4.0, 2)
+         for compounding in compounding_conventions:
+             bond_output = value_bond_var(*args, 5.0, compounding=compounding)
+             bond_val = bond_output[0]
+             bumped = value_bond_var(*args, 4.99, compounding=compounding)[0] - value_bond_var(*args, 5.01, compounding=compounding)[0]
+             years = payment_schedule(args[1], args[3])['year_fractions']['ACT/365F']
+             factors, growth, step = discount_kernel(5.0, years, compounding)
+             modified_duration = np.sum(np.asarray(bond_output[1]) * years / growth) / bond_val
+             self.assertAlmostEqual(bumped / (0.0002 * bond_val), modified_duration, places=5)
+     def test_vectorized_date_rolling_matches_bankdate(self):
+         holidays = ['2024-03-29', '2024-04-01', '2024-12-25', '2024-12-26']
+         dates = [BankDate('2024-03-01') + '%sd' % day for day in range(0, 320, 3)]
+         for daterolling in busday_rolls:
+             self.assertEqual([date.adjust_to_bankingday(daterolling, holidays).toordinal() for date in dates],
+                              list(adjust_to_bankingdays([date.toordinal() for date in dates], daterolling, holidays)))
+     def test_imm_and_cds_roll_dates(self):
+         imm_dates = [str(BankDate(_pythondate.fromordinal(int(date)))) for date in roll_dates('2024-01-01', '2024-12-31')]
+         self.assertEqual(['2024-03-20', '2024-06-19', '2024-09-18', '2024-12-18'], imm_dates)
+         self.assertEqual('2024-06-19', str(BankDate('2024-03-20').next_imm_date()))
+         cds_dates = next_roll_dates([BankDate('2024-03-19').toordinal(), BankDate('2024-03-20').toordinal()], 'CDS')
+         self.assertEqual(['2024-03-20', '2024-06-20'], [str(_pythondate.fromordinal(int(date))) for date in cds_dates])
+     def test_months_difference_matches_bankdate(self):
+         starts = ['2020-01-31', '2020-03-15', '2021-02-28', '2019-12-01']
+         ends = ['2020-02-29', '2020-01-20', '2024-02-29', '2019-12-01']
+         start_ordinals = [BankDate(date).toordinal() for date in starts]
+         end_ordinals = [BankDate(date).toordinal() for date in ends]
+         self.assertEqual([BankDate(start).nbr_of_months(end) for start, end in zip(starts, ends)],
+                          list(months_difference(start_ordinals, end_ordinals)))
+         self.assertEqual([BankDate(start).nbr_of_years(end) for start, end in zip(starts, ends)],
+                          list(years_difference(start_ordinals, end_ordinals)))
+     def test_quantile_sketch_merge(self):
+        #Sketches of two shards merged have to agree with the percentile of all the data
+        changes = np.random.RandomState(7).standard_t(4, 200000)
+        shards = [QuantileSketch(), QuantileSketch()]
+        shards[0].update(changes[:50000])
+        shards[1].update(changes[50000:])
+        merged = QuantileSketch.merge(shards)
+        self.assertEqual(merged.count, len(changes))
+        for percentile in [1, 5, 95, 99]:
+            exact = np.percentile(changes, percentile)
+            self.assertAlmostEqual(merged.percentile(percentile), exact, delta=abs(exact) * .005)
+     def test_amortizing_principal_schedule(self):
+        #Quarterly amortization over 20 years retires 1/80 of face per payment date
+        portfolio = pd.DataFrame({'face_value':[800000.0],'maturity_date':[str(BankDate() + '10y')],\
+                                  'coupon_rate':[4.0],'payments_per_year':[4.0],'bond_rating':['AA'],\
+                                  'bond_type':['Corporate'],'principal_type':['Amortizing'],\
+                                  'issue_date':[str(BankDate() + '-10y')]})
+        flows = project_cashflows(portfolio)
+        self.assertEqual(len(flows), 40)
+        self.assertAlmostEqual(flows['principal'].sum(), 400000.0)
+        self.assertAlmostEqual(flows['coupon'].iloc[-1], 0.01 * 10000.0)
+     def test_credit_curves_reprice_quoted_ratings(self):
+        #Risk free plus spread has to give back the quoted curve for the quoted ratings
+        portfolio = generate_portfolio('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv')
+        curve = credit_discount_rates(*credit_curves())
+        for credit_val, quoted_val in zip(price_cashflows(portfolio_cashflows(portfolio, curve)),\
+                                          price_cashflows(portfolio_cashflows(portfolio))):
+            self.assertAlmostEqual(credit_val, quoted_val, places=6)
+     def test_cashflow_ladder_totals(self):
+        #However the flows are bucketed they must add back up to the book
+        portfolio_csv_location = '/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'
+        book_value = sum(value_portfolio(portfolio_csv_location)[1])
+        for buckets in ['weekly', 'monthly', ['1m','3m','6m','1y','2y','5y','10y','30y']]:
+            ladder = cashflow_ladder(portfolio_csv_location, buckets)
+            self.assertAlmostEqual(ladder['PV'].sum(), book_value, places=4)
+            self.assertAlmostEqual(ladder['Coupon'].sum() + ladder['Principal'].sum(), ladder['Amount'].sum(), places=4)
+     def test_z_spread_cache_follows_curve_and_rebase(self):
+        portfolio = pd.DataFrame({'face_value':[10000.0, 5000.0],'maturity_date':[str(BankDate() + '7y'), str(BankDate() + '3y')],\
+                                  'coupon_rate':[4.0, 3.0],'payments_per_year':[2, 4],'bond_rating':['AA', 'A'],\
+                                  'bond_type':['Corporate', 'Corporate']})
+        cashflows = portfolio_cashflows(portfolio)
+        market_values = np.array([9800.0, 5000.0])
+        shifted_curve = yesterdays_yield_close_values_corp.copy()
+        rate_columns = [column for column in shifted_curve.columns if column != 'Date']
+        shifted_curve[rate_columns] = shifted_curve[rate_columns] + 1.0
+        base_spreads = z_spreads(cashflows, market_values)['Z-Spread'].values
+        shifted_spreads = z_spreads(cashflows, market_values, shifted_curve)['Z-Spread'].values
+        self.assertTrue(np.all(shifted_spreads < base_spreads - 0.5))
+        np.testing.assert_allclose(z_spreads(cashflows, market_values)['Z-Spread'].values, base_spreads, atol=1e-12)
+        #A rebased buffer must not pick up factors cached for the original flows
+        rebase_date = BankDate() + '1y'
+        rebased_spreads = z_spreads(rebase_cashflows(cashflows, rebase_date), market_values)['Z-Spread'].values
+        fresh_spreads = z_spreads(rebase_cashflows(portfolio_cashflows(portfolio), rebase_date), market_values)['Z-Spread'].values
+        np.testing.assert_allclose(rebased_spreads, fresh_spreads, atol=1e-12)
+     def test_parse_iso_dates(self):
+         dates = ['2024-02-29', '2023-02-29', '2000-02-29', '1900-02-29', '2024-13-01', '2024-3-5',\
+                  None, np.nan, _pythondate(2024, 3, 5), BankDate('2031-12-31'), '2024-00-10', '']
+         ordinals, invalid = parse_iso_dates(dates)
+         self.assertEqual([False, True, False, True, True, False, True, True, False, False, True, True], list(invalid))
+         self.assertEqual([_pythondate(2024, 2, 29).toordinal(), _pythondate(2000, 2, 29).toordinal(),\
+                           _pythondate(2024, 3, 5).toordinal(), _pythondate(2024, 3, 5).toordinal(),\
+                           _pythondate(2031, 12, 31).toordinal()], list(ordinals[~invalid]))
+         self.assertTrue(np.all(ordinals[invalid] == 0))
+         with self.assertRaises(BankDateError) as raised:
+             iso_date_ordinals(dates, 'maturity_date')
+         self.assertEqual("Rows [1, 3, 4, 6, 7, 10, 11] of maturity_date are not YYYY-MM-DD dates: "\
+                          "['2023-02-29', '1900-02-29', '2024-13-01', None, nan, '2024-00-10', '']", str(raised.exception))
+         #Strings that aren't dates are not kept, and the cache stays within its size
+         self.assertNotIn('2023-02-29', _iso_date_cache)
+         self.assertLessEqual(len(_iso_date_cache), iso_date_cache_size)
+     def test_yield_change_sketches_save_load_and_update(self):
+        rating_columns = [column for column in yield_change_matrix.columns if column != 'Date']
+        history = yield_change_matrix.sort_values('Date').reset_index(drop=True)
+        sketch_set = YieldChangeSketches(rating_columns)
+        self.assertEqual(400, sketch_set.update_from_table(history.iloc[:400]))
+        with tempfile.TemporaryDirectory() as directory:
+            state_location = os.path.join(directory, 'sketches.npz')
+            sketch_set.save(state_location)
+            loaded = YieldChangeSketches.load(state_location)
+        self.assertEqual(history['Date'].iloc[399], loaded.last_date)
+        for column in rating_columns:
+            for percentile in [1, 50, 95, 99]:
+                self.assertEqual(sketch_set.percentile(column, percentile), loaded.percentile(column, percentile))
+        #Only the days after the last update are added, whatever the table repeats
+        self.assertEqual(len(history) - 400, loaded.update_from_table(history))
+        self.assertEqual(0, loaded.update_from_table(history))
+        self.assertEqual(len(history), loaded.sketches[rating_columns[0]].count)
+        #Unpadded dates sort after the last update only when they are later
+        last_date = BankDate(loaded.last_date)
+        late_rows = history.iloc[:3].copy()
+        late_rows['Date'] = ['%d-%d-%d' % (day.year, day.month, day.day)\
+                             for day in [last_date + '-20d', last_date + '9d', last_date + '40d']]
+        self.assertEqual(2, loaded.update_from_table(late_rows))
+        self.assertEqual(str(last_date + '40d'), loaded.last_date)
+        #The percentiles off the sketches stand in for the ones over the csv
+        sketch_set = YieldChangeSketches(rating_columns)
+        sketch_set.update_from_table(history)
+        from_csv = value_at_risk_yield_change_upper_bound_by_rating(yield_change_csv_location, 95)
+        from_sketches = value_at_risk_yield_change_upper_bound_by_rating(None, 95, sketches=sketch_set)
+        self.assertEqual(sorted(from_csv), sorted(from_sketches))
+        for bond_rating_val in from_csv:
+            self.assertAlmostEqual(from_csv[bond_rating_val], from_sketches[bond_rating_val],\
+                                   delta=abs(from_csv[bond_rating_val]) * .01)
+     def test_covariance_engine_keeps_precision(self):
+        #Changes far from zero cancel catastrophically in sum(x*x) - sum(x)**2/n
+        changes = 1e4 + 1e-3 * np.random.RandomState(11).standard_normal((130, 3))
+        windowed, full = CovarianceEngine(['a', 'b', 'c'], window=50), CovarianceEngine(['a', 'b', 'c'])
+        for day, day_changes in enumerate(changes):
+            windowed.update(day_changes)
+            full.update(day_changes)
+            if day >= 1 and day % 7 in (0, 6):
+                np.testing.assert_allclose(np.cov(changes[max(day - 49, 0):day + 1].T),\
+                                           windowed.rolling_covariance().values, atol=1e-12)
+                np.testing.assert_allclose(np.cov(changes[:day + 1].T), full.rolling_covariance().values, atol=1e-12)
+        with tempfile.TemporaryDirectory() as directory:
+            state_location = os.path.join(directory, 'covariance.npz')
+            windowed.save(state_location)
+            loaded = CovarianceEngine.load(state_location)
+        loaded.update(changes[0])
+        windowed.update(changes[0])
+        np.testing.assert_allclose(windowed.rolling_covariance().values, loaded.rolling_covariance().values, rtol=1e-12)
+     def test_covariance_engine_orders_dates_as_dates(self):
+        table = pd.DataFrame({'Date' : ['2016-9-30', '2016-10-2', '2016-10-10', '2016-10-1'],
+                              'a' : [1.0, 3.0, 4.0, 2.0]})
+        engine = CovarianceEngine(['a'])
+        engine.update_from_table(table.iloc[:3])
+        self.assertEqual('2016-10-10', engine.last_date)
+        self.assertEqual(0, engine.update_from_table(table))
+        #Fed oldest first
+        engine = CovarianceEngine(['a'], window=4)
+        self.assertEqual(4, engine.update_from_table(table))
+        self.assertEqual([1.0, 2.0, 3.0, 4.0], list(engine.window_buffer[:, 0]))
+     def test_payment_dates_follow_frequency(self):
+         maturity_date = '2031-06-16'
+         #The first date is the valuation date itself
+         quarterly = payment_dates(maturity_date, 4, '2029-01-01')
+         self.assertEqual([str(date) for date in quarterly], [str(date) for date in payment_dates(maturity_date, '3m', '2029-01-01')])
+         self.assertEqual(list(payment_schedule(maturity_date, 4, as_of='2029-01-01')['ordinals']),\
+                          [date.toordinal() for date in quarterly[1:]])
+         self.assertEqual(days_to_payment(maturity_date, 12, '2029-01-01'), days_to_payment(maturity_date, '1m', '2029-01-01'))
+     def test_settlement_prices_of_repaid_bonds(self):
+         portfolio = pd.DataFrame({'face_value':[10000.0, 5000.0],'maturity_date':[str(BankDate() + '1y'), str(BankDate() + '5y')],\
+                                   'coupon_rate':[4.0, 3.0],'payments_per_year':[2, 2],'bond_rating':['AA', 'AA'],\
+                                   'bond_type':['Corporate', 'Corporate']})
+         with warnings.catch_warnings():
+             warnings.simplefilter('error')
+             prices = settlement_prices(portfolio_cashflows(portfolio), BankDate() + '2y')
+         self.assertEqual(0.0, prices['Dirty Value'][0])
+         self.assertTrue(np.isnan(prices['Dirty Price'][0]) and np.isnan(prices['Clean Price'][0]))
+         self.assertTrue(np.isfinite(prices['Dirty Price'][1]))
+     def test_settlement_prices_by_hand(self):
+         #4% semiannual, 10000 face, valued 2025-01-15. The coupon dates roll to 2024-12-16, 2025-06-16, 2025-12-15,
+         #2026-06-15, 2026-12-15 and 2027-06-15: the first coupon has run 30 of its 182 days
+         portfolio = pd.DataFrame({'face_value':[10000.0],'maturity_date':['2027-06-15'],'coupon_rate':[4.0],\
+                                   'payments_per_year':[2],'bond_rating':['AA'],'bond_type':['Corporate']})
+         cashflows = portfolio_cashflows(portfolio, as_of='2025-01-15')
+         rate = cashflow_discount_rates(cashflows)[0]
+         dirty_val = sum(amount * (1 + rate / 36500) ** -days for amount, days in\
+                         zip([200.0, 200.0, 200.0, 200.0, 10200.0], [152, 334, 516, 699, 881]))
+         accrued = 200.0 * 30 / 182
+         prices = settlement_prices(cashflows)
+         self.assertAlmostEqual(dirty_val, prices['Dirty Value'][0], places=8)
+         self.assertAlmostEqual(accrued, prices['Accrued Interest'][0], places=10)
+         self.assertAlmostEqual(dirty_val - accrued, prices['Clean Value'][0], places=8)
+         self.assertAlmostEqual((dirty_val - accrued) / 100, prices['Clean Price'][0], places=10)
+         #A period that starts and ends on the same day accrues nothing
+         cashflows['accrual_start_ordinals'][1] = cashflows['ordinals'][1]
+         with warnings.catch_warnings():
+             warnings.simplefilter('error')
+             self.assertEqual(0.0, settlement_prices(cashflows, '2025-06-16')['Accrued Interest'][0])
+     def test_revaluation_history_pnl_adds_up(self):
+         #Carry plus curve P&L has to give the day's total, coupons paid over the days included
+         portfolio = pd.DataFrame({'face_value':[10000.0, 5000.0],'maturity_date':['2027-06-15', '2031-03-20'],\
+                                   'coupon_rate':[4.0, 3.0],'payments_per_year':[2, 4],'bond_rating':['AA', 'A'],\
+                                   'bond_type':['Corporate', 'Corporate']})
+         dates = ['2026-06-10', '2026-06-11', '2026-06-12', '2026-06-15', '2026-06-16', '2026-06-17', '2026-06-18']
+         rate_columns = [tenor + '_' + rating for rating in ['AA', 'A'] for tenor in key_rate_tenors]
+         moves = np.random.RandomState(5).normal(0, 0.05, (len(dates), len(rate_columns))).cumsum(axis=0)
+         yield_table = pd.DataFrame(np.linspace(1.5, 4.0, len(rate_columns)) + moves, columns=rate_columns)
+         yield_table.insert(0, 'Date', dates)
+         with tempfile.TemporaryDirectory() as directory:
+             portfolio_csv_location = os.path.join(directory, 'portfolio.csv')
+             yield_csv_location = os.path.join(directory, 'yields.csv')
+             portfolio.to_csv(portfolio_csv_location, index=False)
+             #Stored newest first like the curve files
+             yield_table.iloc[::-1].to_csv(yield_csv_location, index=False)
+             history = revaluation_history(portfolio_csv_location, yield_csv_location)
+         self.assertEqual(dates, list(history.index))
+         self.assertAlmostEqual(200.0, history['Cash Received']['2026-06-15'], places=10)
+         days = history.iloc[1:]
+         np.testing.assert_allclose(days['Carry P&L'] + days['Curve P&L'], days['Total P&L'], rtol=0, atol=1e-8)
+         self.assertAlmostEqual(history['Portfolio Value'].iloc[-1] + history['Cash Received'].sum()\
+                                - history['Portfolio Value'].iloc[0], days['Total P&L'].sum(), places=8)
+     def test_project_cashflows_pv_matches_price_cashflows(self):
+         portfolio = generate_portfolio('/Users/baronabramowitz/Desktop/bond_portfolio_data.csv')
+         flows = project_cashflows(portfolio)
+         bond_pvs = flows.groupby('bond_id')['pv'].sum()
+         np.testing.assert_allclose(price_cashflows(portfolio_cashflows(portfolio)), bond_pvs.reindex(portfolio.index).values,\
+                                    rtol=1e-12)
+         np.testing.assert_allclose(flows['coupon'] + flows['principal'], flows['amount'], rtol=1e-12)
+     def test_parallel_shock_is_constant_shift(self):
+         #Between the 2yr and 20yr the key rate weights add up to one, so a parallel curve shock
+         #moves every bond's discount rate by the same amount
+         portfolio = pd.DataFrame({'face_value':[10000.0, 5000.0, 20000.0],\
+                                   'maturity_date':[str(BankDate() + tenor) for tenor in ['3y', '7y', '15y']],\
+                                   'coupon_rate':[4.0, 3.0, 5.0],'payments_per_year':[2, 4, 1],\
+                                   'bond_rating':['AA', 'A', 'AA'],'bond_type':['Corporate'] * 3})
+         cashflows = portfolio_cashflows(portfolio)
+         scenarios = dict((name, interest_rate_stress_scenarios[name]) for name in ['Parallel Up', 'Parallel Down'])
+         scenarios['Parallel 35bp'] = {'shape' : 'parallel', 'size' : 35}
+         self.assertIs(parallel_shock, curve_shock_shapes['parallel'])
+         np.testing.assert_allclose(shifted_values(cashflows, np.repeat([[2.0], [-2.0], [0.35]], 3, axis=1)),\
+                                    scenario_values(cashflows, scenario_shock_grid(scenarios)), rtol=1e-12)
+     def test_credit_curves_without_2yr_aaa(self):
+        #The yield file quotes AAA from the 5yr out only
+        curve = yesterdays_yield_close_values_corp.drop(columns=['2yr_AAA'], errors='ignore')
+        risk_free, spreads = credit_curves(curve)
+        self.assertFalse(spreads.isnull().values.any())
+        self.assertEqual(spreads.at['AAA', '5yr'], spreads.at['AAA', '2yr'])
+        credit_curve = credit_discount_rates(risk_free, spreads)
+        for column in curve.columns:
+            if column != 'Date':
+                self.assertAlmostEqual(curve[column].iloc[0], credit_curve[column].iloc[0], places=10)
+        portfolio = pd.DataFrame({'face_value':[10000.0, 5000.0],'maturity_date':[str(BankDate() + '3y'), str(BankDate() + '7y')],\
+                                  'coupon_rate':[4.0, 3.0],'payments_per_year':[2, 2],'bond_rating':['AAA', 'BBB'],\
+                                  'bond_type':['Corporate', 'Corporate']})
+        credit_var = credit_value_at_risk(portfolio, 99, simulation_count=2000, discount_rates=curve, random_state=1)
+        self.assertTrue(credit_var['Credit VaR'] > 0)
+     def test_floating_rate_note_off_default_curve(self):
+        #The index curve is the lowest quote per tenor, without going through the credit curves
+        curve = yesterdays_yield_close_values_corp.drop(columns=['2yr_AAA'], errors='ignore')
+        frn = pd.DataFrame({'face_value':[10000.0],'maturity_date':[str(BankDate() + '5y')],'coupon_rate':[0.5],\
+                            'payments_per_year':[4],'bond_rating':['AA'],'bond_type':['Corporate'],'coupon_type':['Floating']})
+        flows = project_cashflows(frn, curve)
+        self.assertEqual(20, len(flows))
+        self.assertTrue((flows['coupon'] > 0.5 / 400 * 10000.0).all())
+        np.testing.assert_allclose(risk_free_key_rates(curve).values,\
+                                   np.nanmin(key_rates_by_rating(['AAA', 'AA', 'A'], curve), axis=0))
+     def test_revaluation_history_orders_unpadded_dates(self):
+         portfolio = pd.DataFrame({'face_value':[10000.0],'maturity_date':['2029-06-15'],'coupon_rate':[4.0],\
+                                   'payments_per_year':[2],'bond_rating':['AA'],'bond_type':['Corporate']})
+         dates = ['2026-9-28', '2026-9-29', '2026-9-30', '2026-10-1', '2026-10-2']
+         yield_table = pd.DataFrame(dict((tenor + '_AA', np.linspace(2.0, 2.2, len(dates)) + i * 0.5)\
+                                         for i, tenor in enumerate(key_rate_tenors)))
+         yield_table.insert(0, 'Date', dates)
+         with tempfile.TemporaryDirectory() as directory:
+             portfolio_csv_location = os.path.join(directory, 'portfolio.csv')
+             yield_csv_location = os.path.join(directory, 'yields.csv')
+             portfolio.to_csv(portfolio_csv_location, index=False)
+             yield_table.iloc[::-1].to_csv(yield_csv_location, index=False)
+             history = revaluation_history(portfolio_csv_location, yield_csv_location)
+         self.assertEqual(dates, list(history.index))
+         days = history.iloc[1:]
+         np.testing.assert_allclose(days['Carry P&L'] + days['Curve P&L'], days['Total P&L'], rtol=0, atol=1e-8)
+     def test_yield_close_values_as_of_unpadded_dates(self):
+         yield_table = pd.DataFrame({'Date' : ['2026-9-30', '2026-10-2', '2026-9-28', '2026-9-29'],\
+                                     '5yr_AA' : [3.0, 5.0, 1.0, 2.0]})
+         self.assertEqual(3.0, yield_close_values_as_of(yield_table, '2026-10-01')['5yr_AA'][0])
+         self.assertEqual(5.0, yield_close_values_as_of(yield_table, '2026-10-05')['5yr_AA'][0])
+         self.assertEqual(1.0, yield_close_values_as_of(yield_table, '2026-09-28')['5yr_AA'][0])
+         with self.assertRaises(BankDateError):
+             yield_close_values_as_of(yield_table, '2026-09-27')
+     def test_covariance_engine_bulk_update_matches_daily(self):
+        changes = np.random.RandomState(13).standard_normal((320, 4)) * [1.0, 0.5, 2.0, 0.1]
+        for window in [None, 50, 400]:
+            daily, bulk = CovarianceEngine(list('abcd'), window=window), CovarianceEngine(list('abcd'), window=window)
+            for day_changes in changes:
+                daily.update(day_changes)
+            bulk.update_many(changes[:100])
+            bulk.update_many(changes[100:])
+            np.testing.assert_allclose(daily.rolling_covariance().values, bulk.rolling_covariance().values, rtol=1e-10)
+            np.testing.assert_allclose(daily.ewma_covariance().values, bulk.ewma_covariance().values, rtol=1e-10)
+            np.testing.assert_allclose(daily.ewma_mean, bulk.ewma_mean, rtol=1e-10)
+        #What the module publishes is the windowed estimate over the latest days
+        rating_columns = [column for column in yield_change_matrix.columns if column != 'Date']
+        latest = yield_change_matrix.iloc[np.argsort(-iso_date_ordinals(yield_change_matrix['Date']))][:covariance_window]
+        np.testing.assert_allclose(latest[rating_columns].cov().values, yield_change_cov_matrix.values, atol=1e-12)
+     def test_schedule_caches_stay_bounded(self):
+        maturity_date = str(BankDate() + '3y')
+        for days in range(valuation_dates_per_schedule + 5):
+            payment_schedule(maturity_date, 2, as_of=BankDate() + '%sd' % days)
+        as_of_dates = _payment_schedule_cache[(maturity_date, 2)]['as_of']
+        self.assertEqual(valuation_dates_per_schedule, len(as_of_dates))
+        self.assertNotIn(BankDate().toordinal(), as_of_dates)
+        #Valuing on an evicted date rebuilds it rather than failing
+        self.assertEqual(list(payment_schedule(maturity_date, 2)['ordinals']),\
+                         list(payment_schedule(maturity_date, 2, as_of=BankDate())['ordinals']))
+        for year in range(busday_calendar_cache_size + 5):
+            business_day_calendar(['%s-12-25' % (2000 + year)])
+        self.assertLessEqual(len(_busday_calendars), busday_calendar_cache_size)
+        self.assertLessEqual(len(_payment_schedule_cache), payment_schedule_cache_size)
      def test_bond_dur(self):
-        #Checks if bond duration properly calculates
-        self.assertEqual({'Bond Duration': 5.4524899454500195, 'Modified Duration': 5.340342747747326},\
-            duration_bond(10000.0, '2022-06-15', 2.5, 2, 'AAA','Corporate'))
+        #Modified duration against a revaluation 1bp either side of the bond's discount rate
+        args = (10000.0, str(BankDate() + '6y'), 2.5, 2)
+        discount_rate = value_bond(*args, 'AAA', 'Corporate')[4]
+        for compounding in compounding_conventions:
+            bond_val, up_val, down_val = [value_bond_var(*args, discount_rate + shift, compounding=compounding)[0]\
+                                          for shift in [0.0, 0.01, -0.01]]
+            durations = duration_bond(*args, 'AAA', 'Corporate', compounding=compounding)
+            self.assertAlmostEqual((down_val - up_val) / (bond_val * 2e-4), durations['Modified Duration'], places=4)
+            self.assertGreaterEqual(durations['Bond Duration'], durations['Modified Duration'] - 1e-12)
+     def test_compounding_reaches_every_path(self):
+        portfolio_csv_location = '/Users/baronabramowitz/Desktop/bond_portfolio_data.csv'
+        portfolio = generate_portfolio(portfolio_csv_location)
+        for compounding in ['Annual', 'Continuous']:
+            book_val = value_portfolio(portfolio_csv_location, compounding=compounding)[0]
+            self.assertAlmostEqual(book_val, analytics_portfolio(portfolio_csv_location, compounding=compounding)\
+                                   ['Portfolio Analytics']['Portfolio Value'], places=4)
+            self.assertAlmostEqual(book_val, project_cashflows(portfolio, compounding=compounding)['pv'].sum(), places=4)
+            self.assertAlmostEqual(book_val, cashflow_ladder(portfolio, compounding=compounding)['PV'].sum(), places=4)
+            self.assertAlmostEqual(book_val, scenario_revaluation(portfolio, compounding=compounding)[0]\
+                                   ['Base Value'].iloc[0], places=4)
+            self.assertAlmostEqual(book_val, value_portfolio_as_of_dates(portfolio_csv_location, [BankDate()],\
+                                   compounding=compounding)['Portfolio Value'].iloc[0], places=4)
+            cashflows = portfolio_cashflows(portfolio)
+            bond_vals, durations = key_rate_durations(cashflows, compounding=compounding)
+            self.assertAlmostEqual(book_val, bond_vals.sum(), places=4)
+            self.assertNotAlmostEqual(bond_vals.sum(), key_rate_durations(cashflows)[0].sum(), places=4)
      def test_bond_val(self):
         #Checks if bond value properly calculates
         self.assertEqual((10398.50651287065,
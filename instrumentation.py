@@ -0,0 +1,215 @@
+'''Opt-in timing of the hot paths in bond_stuff_in_progress.
+
+enable() swaps the module's functions for timed wrappers. Calls between
+them go through the module globals, so value_portfolio -> value_bond ->
+payment_schedule -> daterange is timed all the way down, as is the
+portfolio_cashflows -> price_cashflows/cashflow_analytics path.
+disable() puts the originals back, so there is no overhead at all while
+it is off. Code holding its own reference to a function, e.g. a
+PricingService built before enable(), keeps calling the untimed one.
+The counters and timings are plain dicts updated without a lock, so
+they're only exact when the timed code runs on one thread at a time, as
+it does on the pricing service's single worker.
+
+    import instrumentation
+    instrumentation.enable()
+    bond_stuff_in_progress.portfolio_duration(csv_location)
+    print(instrumentation.export_prometheus())
+
+Timings are cumulative, so a parent's time includes its children's.
+'''
+
+from collections import deque
+import json
+import time
+import unittest
+
+import numpy as np
+
+import bond_stuff_in_progress as bonds
+
+instrumented_functions = [
+    'generate_portfolio', 'generate_yield_comparison_table_raw',
+    'daterange', 'payment_dates', 'days_to_payment', 'payment_schedule',
+    'value_bond', 'value_bond_var', 'duration_bond', 'convexity_bond',
+    'value_portfolio', 'portfolio_duration', 'convexity_portfolio',
+    'portfolio_cashflows', 'price_cashflows', 'cashflow_analytics',
+    'value_at_risk_yield_change_upper_bound_by_rating', 'value_at_risk_single_bond',
+    'value_at_risk_portfolio_set',
+    ]
+
+#name of the cache -> dict of hit/miss counters kept by bond_stuff_in_progress
+instrumented_caches = {
+    'payment_schedule': bonds.payment_schedule_cache_stats,
+    'iso_date': bonds.iso_date_cache_stats,
+    }
+
+latency_percentiles = [50, 90, 99]
+
+#Latency samples kept per function for the percentiles
+sample_size = 10000
+
+
+class FunctionStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def record(self, seconds):
+        self.calls += 1
+        self.total_seconds += seconds
+        self.samples.append(seconds)
+
+    def percentiles(self):
+        if not self.samples:
+            return dict((percentile, 0.0) for percentile in latency_percentiles)
+        return dict(zip(latency_percentiles, np.percentile(np.array(self.samples), latency_percentiles)))
+
+
+stats = {}
+_originals = {}
+
+
+def _timed(name, function):
+    function_stats = stats.setdefault(name, FunctionStats())
+    clock = time.perf_counter
+
+    def timed_function(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            function_stats.errors += 1
+            raise
+        finally:
+            function_stats.record(clock() - start)
+    timed_function.__name__ = function.__name__
+    timed_function.__doc__ = function.__doc__
+    timed_function.__wrapped__ = function
+    return timed_function
+
+
+def enable(function_names=None):
+    '''Starts timing the given functions (default instrumented_functions)'''
+    for name in function_names or instrumented_functions:
+        if name not in _originals:
+            _originals[name] = getattr(bonds, name)
+            setattr(bonds, name, _timed(name, _originals[name]))
+
+
+def disable():
+    '''Puts the untimed functions back, the stats collected are kept'''
+    for name, function in _originals.items():
+        setattr(bonds, name, function)
+    _originals.clear()
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def reset():
+    '''Zeroes the figures. The stats objects stay, wrappers already in
+    place keep recording into them'''
+    for function_stats in stats.values():
+        function_stats.reset()
+    for cache_stats in instrumented_caches.values():
+        for counter in cache_stats:
+            cache_stats[counter] = 0
+
+
+class instrumented:
+    '''Context manager timing the hot paths inside a with block'''
+
+    def __init__(self, function_names=None):
+        self.function_names = function_names
+
+    def __enter__(self):
+        enable(self.function_names)
+        return self
+
+    def __exit__(self, *exc_info):
+        disable()
+        return False
+
+
+def report():
+    '''The collected figures as a plain dict'''
+    functions = {}
+    for name, function_stats in stats.items():
+        if not function_stats.calls and not function_stats.errors:
+            continue
+        functions[name] = {'calls' : function_stats.calls,
+                           'errors' : function_stats.errors,
+                           'total_seconds' : function_stats.total_seconds,
+                           'mean_seconds' : function_stats.total_seconds / function_stats.calls
+                                            if function_stats.calls else 0.0}
+        for percentile, seconds in function_stats.percentiles().items():
+            functions[name]['p%s_seconds' % percentile] = float(seconds)
+    caches = {}
+    for name, cache_stats in instrumented_caches.items():
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        caches[name] = {'hits' : cache_stats['hits'],
+                        'misses' : cache_stats['misses'],
+                        'hit_rate' : cache_stats['hits'] / lookups if lookups else 0.0}
+    return {'functions' : functions, 'caches' : caches}
+
+
+def export_json(indent=None):
+    return json.dumps(report(), indent=indent, sort_keys=True)
+
+
+def export_prometheus(prefix='bond_stuff'):
+    '''The collected figures in the Prometheus text exposition format'''
+    collected = report()
+    lines = ['# TYPE %s_function_calls_total counter' % prefix]
+    for name, figures in sorted(collected['functions'].items()):
+        lines.append('%s_function_calls_total{function="%s"} %d' % (prefix, name, figures['calls']))
+    lines.append('# TYPE %s_function_errors_total counter' % prefix)
+    for name, figures in sorted(collected['functions'].items()):
+        lines.append('%s_function_errors_total{function="%s"} %d' % (prefix, name, figures['errors']))
+    lines.append('# TYPE %s_function_seconds summary' % prefix)
+    for name, figures in sorted(collected['functions'].items()):
+        for percentile in latency_percentiles:
+            lines.append('%s_function_seconds{function="%s",quantile="%s"} %.9g'
+                         % (prefix, name, percentile / 100, figures['p%s_seconds' % percentile]))
+        lines.append('%s_function_seconds_sum{function="%s"} %.9g' % (prefix, name, figures['total_seconds']))
+        lines.append('%s_function_seconds_count{function="%s"} %d' % (prefix, name, figures['calls']))
+    lines.append('# TYPE %s_cache_hits_total counter' % prefix)
+    for name, figures in sorted(collected['caches'].items()):
+        lines.append('%s_cache_hits_total{cache="%s"} %d' % (prefix, name, figures['hits']))
+    lines.append('# TYPE %s_cache_misses_total counter' % prefix)
+    for name, figures in sorted(collected['caches'].items()):
+        lines.append('%s_cache_misses_total{cache="%s"} %d' % (prefix, name, figures['misses']))
+    return '\n'.join(lines) + '\n'
+
+
+class test_suite(unittest.TestCase):
+
+    def tearDown(self):
+        disable()
+        reset()
+
+    def test_reset_while_enabled_keeps_recording(self):
+        enable(['tenor_bucket'])
+        bonds.tenor_bucket(5.0)
+        self.assertEqual(1, report()['functions']['tenor_bucket']['calls'])
+        reset()
+        self.assertNotIn('tenor_bucket', report()['functions'])
+        bonds.tenor_bucket(5.0)
+        bonds.tenor_bucket(12.0)
+        self.assertEqual(2, report()['functions']['tenor_bucket']['calls'])
+
+    def test_disable_restores_functions(self):
+        original = bonds.tenor_bucket
+        with instrumented(['tenor_bucket']):
+            self.assertIsNot(original, bonds.tenor_bucket)
+            self.assertEqual('10yr', bonds.tenor_bucket(12.0))
+        self.assertIs(original, bonds.tenor_bucket)
+        self.assertIn('bond_stuff_function_calls_total{function="tenor_bucket"} 1', export_prometheus())
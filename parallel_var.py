@@ -0,0 +1,290 @@
+'''Parallel value at risk for bond_stuff_in_progress portfolios.
+
+value_at_risk_portfolio_set goes bond by bond, rereading the yield change
+csv for every one. Here the yield change matrix and the flattened portfolio
+cash flows are copied once into multiprocessing.shared_memory and the work
+is cut into tasks over percentiles, blocks of historical scenarios and
+shards of the portfolio. A task only carries a few names and slice bounds,
+the workers map the shared blocks straight into numpy arrays, and every task
+writes its own slice of a shared result array. Results are merged in task
+order, so they don't depend on which worker finished first or how many
+there were.
+
+Two VaRs come back for each loss percentile:
+    Bond VaR        per bond, the same measure as value_at_risk_single_bond:
+                    the bond repriced at its maturity bucket's rate plus that
+                    column's percentile yield change
+    Historical VaR  the portfolio fully revalued under every day of yield
+                    changes through its key rate weights, and the loss at
+                    the percentile of that P&L
+
+    import parallel_var
+    parallel_var.parallel_value_at_risk(csv_location, [95, 99])
+
+The workers only need numpy. bond_stuff_in_progress, which reads the curves
+when it's imported, is only imported by the process setting the run up.
+'''
+
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+default_yield_change_csv_location = '/Users/baronabramowitz/Desktop/cleaned_corporate_bond_yield_change_data.csv'
+
+
+class SharedArrays:
+    '''numpy arrays copied once into shared memory blocks. specs describes
+    them as (block name, shape, dtype) so other processes can attach to
+    them with attach_shared_arrays without anything being pickled.'''
+
+    def __init__(self, arrays):
+        self.blocks = {}
+        self.arrays = {}
+        self.specs = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.blocks[key] = block
+            self.arrays[key] = shared
+            self.specs[key] = (block.name, array.shape, array.dtype.str)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        '''Frees the blocks, the arrays must not be used afterwards'''
+        self.arrays.clear()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def attach_shared_arrays(specs):
+    '''The shared blocks described by SharedArrays.specs and numpy views of
+    them. The blocks have to be closed once the views are gone'''
+    blocks = {}
+    arrays = {}
+    for key, (name, shape, dtype) in specs.items():
+        blocks[key] = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[key].buf)
+    return blocks, arrays
+
+
+def close_shared_blocks(blocks):
+    for block in blocks.values():
+        try:
+            block.close()
+        except BufferError:
+            #A failed task's traceback still holds views, the mapping goes
+            #when they are collected
+            pass
+
+
+def discount_factors(rates, years, frequency):
+    '''The factors of bonds.discount_kernel for rates (percent) compounded
+    frequency times a year, inf for continuous and 0 for simple interest,
+    without importing bond_stuff_in_progress into the workers'''
+    rates = rates / 100
+    if frequency == 0:
+        return 1 / (1 + rates * years)
+    elif np.isinf(frequency):
+        return np.exp(-rates * years)
+    else:
+        return np.exp(-frequency * years * np.log1p(rates / frequency))
+
+
+def shard_values(data, start, stop, rate_shifts):
+    '''Values of bonds start to stop for each row of rate_shifts (percent,
+    shaped (scenarios, stop - start)), discounted off the bond rates at the
+    run's compounding'''
+    first_flow, last_flow = data['flow_offsets'][start], data['flow_offsets'][stop]
+    bond_index = data['bond_index'][first_flow:last_flow] - start
+    bond_count = stop - start
+    flow_rates = data['bond_rates'][start:stop][bond_index] + rate_shifts[:, bond_index]
+    pv_fcf = data['amounts'][first_flow:last_flow] * discount_factors(flow_rates, data['year_fractions'][first_flow:last_flow],\
+                                                                      data['compounding_frequency'][0])
+    flat_index = (np.arange(len(rate_shifts))[:, None] * bond_count + bond_index).ravel()
+    return np.bincount(flat_index, pv_fcf.ravel(), len(rate_shifts) * bond_count).reshape(len(rate_shifts), bond_count)
+
+
+def _bond_var_task(data, percentile_number, start, stop):
+    bucket_columns = data['bucket_columns'][start:stop]
+    upper_bounds = np.where(bucket_columns >= 0, data['upper_bounds'][percentile_number][bucket_columns], np.nan)
+    #Like value_bond_var, the shocked value discounts at the bucket's rate, not the interpolated one
+    shifts = np.vstack((np.zeros(stop - start), data['bucket_rates'][start:stop] + upper_bounds\
+                        - data['bond_rates'][start:stop]))
+    bond_vals, shocked_vals = shard_values(data, start, stop, shifts)
+    data['bond_var'][percentile_number, start:stop] = bond_vals - shocked_vals
+
+
+def _scenario_task(data, shard_number, start, stop, first_scenario, last_scenario):
+    changes = data['yield_changes'][first_scenario:last_scenario]
+    key_columns = data['key_columns'][start:stop]
+    weights = np.where(key_columns >= 0, data['key_rate_weights'][start:stop], 0.0)
+    rate_shifts = (changes[:, np.maximum(key_columns, 0)] * weights).sum(axis=2)
+    shifts = np.vstack((np.zeros((1, stop - start)), rate_shifts))
+    vals = shard_values(data, start, stop, shifts)
+    data['scenario_pnl'][shard_number, first_scenario:last_scenario] = (vals[1:] - vals[0]).sum(axis=1)
+
+
+_task_functions = {'bond' : _bond_var_task,
+                   'scenario' : _scenario_task}
+
+def _run_task(task):
+    '''Runs a task in a pool worker, mapping the shared blocks for the task
+    only so nothing stays attached once it's done'''
+    kind, specs, arguments = task
+    blocks, data = attach_shared_arrays(specs)
+    try:
+        _task_functions[kind](data, *arguments)
+    finally:
+        del data
+        close_shared_blocks(blocks)
+
+
+def var_inputs(portfolio_csv_location, loss_percentiles, yield_change_csv_location, day_count_convention, as_of,\
+               compounding):
+    '''The arrays the workers share, built from the portfolio cash flow buffer'''
+    import bond_stuff_in_progress as bonds
+    portfolio = bonds.generate_portfolio(portfolio_csv_location)
+    cashflows = bonds.portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of)
+    yield_change_table = bonds.generate_yield_comparison_table_raw(yield_change_csv_location)
+    columns = [column for column in yield_change_table.columns if column != 'Date']
+    column_numbers = dict((column, i) for i, column in enumerate(columns))
+    yield_changes = yield_change_table[columns].to_numpy(dtype=np.float64)
+    bond_ratings = [str(rating) for rating in cashflows['bond_ratings']]
+    #The remaining maturity under the book's day count, as the cash flows were built
+    bucket_tenors = bonds.tenor_bucket(cashflows['maturity_remaining'])
+    bucket_columns = np.array([column_numbers.get(tenor + '_' + rating, -1)\
+                               for tenor, rating in zip(bucket_tenors, bond_ratings)], dtype=np.int64)
+    curve = bonds.yesterdays_yield_close_values_corp
+    bucket_rates = np.array([curve[tenor + '_' + rating].iloc[0] if tenor + '_' + rating in curve.columns else np.nan\
+                             for tenor, rating in zip(bucket_tenors, bond_ratings)])
+    key_columns = np.array([[column_numbers.get(tenor + '_' + rating, -1) for tenor in bonds.key_rate_tenors]\
+                            for rating in bond_ratings], dtype=np.int64).reshape(-1, len(bonds.key_rate_tenors))
+    flow_counts = np.bincount(cashflows['bond_index'], minlength=cashflows['bond_count'])
+    inputs = {'yield_changes' : yield_changes,
+              'upper_bounds' : np.percentile(yield_changes, loss_percentiles, axis=0).reshape(len(loss_percentiles), -1),
+              'amounts' : cashflows['amounts'],
+              'year_fractions' : cashflows['year_fractions'],
+              'compounding_frequency' : np.array([bonds.compounding_frequencies[compounding]], dtype=np.float64),
+              'bond_index' : cashflows['bond_index'],
+              'flow_offsets' : np.concatenate(([0], np.cumsum(flow_counts))),
+              'bond_rates' : bonds.cashflow_discount_rates(cashflows),
+              'bucket_rates' : bucket_rates,
+              'bucket_columns' : bucket_columns,
+              'key_rate_weights' : cashflows['key_rate_weights'],
+              'key_columns' : key_columns}
+    return portfolio, bonds.price_cashflows(cashflows, compounding=compounding).sum(), inputs
+
+
+def parallel_value_at_risk(portfolio_csv_location, loss_percentiles, yield_change_csv_location=None, processes=None,\
+                           shard_size=10000, max_chunk_size=5000000, day_count_convention='ACT/365F', as_of=None,\
+                           compounding='Daily'):
+    '''Bond and historical VaR of the portfolio at every loss percentile
+    (whole numbers, eg 95 not .95).
+    The portfolio is split into shards of shard_size bonds and the
+    scenarios into blocks holding at most max_chunk_size flow revaluations,
+    each task running in a pool of processes (default one per cpu, 0 or 1
+    runs them in this process). Flows are discounted at compounding, see
+    bonds.discount_kernel.
+    Returns the per bond VaR (one column per percentile) and a frame with
+    the historical VaR per percentile
+    '''
+    if yield_change_csv_location is None:
+        yield_change_csv_location = default_yield_change_csv_location
+    loss_percentiles = list(loss_percentiles)
+    portfolio, portfolio_val, inputs = var_inputs(portfolio_csv_location, loss_percentiles, yield_change_csv_location,\
+                                   day_count_convention, as_of, compounding)
+    bond_count = len(portfolio)
+    scenario_count = len(inputs['yield_changes'])
+    shard_bounds = [(start, min(start + shard_size, bond_count)) for start in range(0, bond_count, shard_size)]
+    inputs['bond_var'] = np.zeros((len(loss_percentiles), bond_count))
+    inputs['scenario_pnl'] = np.zeros((len(shard_bounds), scenario_count))
+    with SharedArrays(inputs) as shared:
+        tasks = []
+        for shard_number, (start, stop) in enumerate(shard_bounds):
+            for percentile_number in range(len(loss_percentiles)):
+                tasks.append(('bond', (percentile_number, start, stop)))
+            shard_flows = max(int(inputs['flow_offsets'][stop] - inputs['flow_offsets'][start]), 1)
+            scenario_block = max(1, max_chunk_size // shard_flows)
+            for first_scenario in range(0, scenario_count, scenario_block):
+                tasks.append(('scenario', (shard_number, start, stop, first_scenario,\
+                                           min(first_scenario + scenario_block, scenario_count))))
+        if processes is not None and processes <= 1:
+            #In this process the tasks work on the parent's own arrays
+            for kind, arguments in tasks:
+                _task_functions[kind](shared.arrays, *arguments)
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                for _ in pool.imap_unordered(_run_task, [(kind, shared.specs, arguments)\
+                                                                for kind, arguments in tasks]):
+                    pass
+        bond_var = pd.DataFrame(shared['bond_var'].T.copy(), index=portfolio.index, columns=loss_percentiles)
+        #Shards are added up in the same order whatever the pool did
+        portfolio_pnl = np.zeros(scenario_count)
+        for shard_pnl in shared['scenario_pnl']:
+            portfolio_pnl += shard_pnl
+    historical_var = -np.percentile(portfolio_pnl, [100 - percentile for percentile in loss_percentiles])
+    return bond_var, pd.DataFrame({'Portfolio Value' : portfolio_val,
+                                   'Sum of Bond VaR' : bond_var.sum().values,
+                                   'Historical VaR' : historical_var,
+                                   'Historical VaR Percentage' : historical_var * 100 / portfolio_val},
+                                  index=loss_percentiles)
+
+
+
+class test_suite(unittest.TestCase):
+
+    def test_matches_serial_value_at_risk(self):
+        #Bond VaR against value_at_risk_single_bond, which value_at_risk_portfolio_set runs bond by bond,
+        #and historical VaR against the serial scenario revaluation
+        import bond_stuff_in_progress as bonds
+        portfolio = pd.DataFrame({'face_value' : [10000.0, 25000.0, 5000.0],
+                                  'maturity_date' : [str(bonds.BankDate() + tenor) for tenor in ['3y', '6y', '12y']],
+                                  'coupon_rate' : [3.0, 4.5, 2.0], 'payments_per_year' : [2, 1, 4],
+                                  'bond_rating' : ['AA', 'A', 'AA'], 'bond_type' : ['Corporate'] * 3})
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            portfolio.to_csv(csv_location, index=False)
+            serial_results = parallel_value_at_risk(csv_location, [95, 99], processes=1)
+            pool_results = parallel_value_at_risk(csv_location, [95, 99], processes=2, shard_size=2)
+        for bond_var, summary in [serial_results, pool_results]:
+            for percentile in [95, 99]:
+                upper_bounds = bonds.value_at_risk_yield_change_upper_bound_by_rating(default_yield_change_csv_location,
+                                                                                     percentile)
+                for i, bond in enumerate(portfolio.itertuples(index=False)):
+                    single = bonds.value_at_risk_single_bond(*bond, default_yield_change_csv_location, percentile,
+                                                             upper_bounds=upper_bounds)
+                    self.assertAlmostEqual(single['VaR'], bond_var[percentile].iloc[i], places=6)
+            cashflows = bonds.portfolio_cashflows(portfolio)
+            yield_changes = bonds.generate_yield_comparison_table_raw(default_yield_change_csv_location)
+            pnl = (bonds.scenario_values(cashflows, yield_changes) - bonds.price_cashflows(cashflows)).sum(axis=1)
+            np.testing.assert_allclose(summary['Historical VaR'].values, -np.percentile(pnl, [5, 1]), rtol=1e-10)
+
+    def test_discount_factors_match_kernel(self):
+        import bond_stuff_in_progress as bonds
+        rates = np.array([[0.5, 3.0, 7.5], [1.0, 4.0, 12.0]])
+        years = np.array([0.25, 2.0, 30.0])
+        for compounding, frequency in bonds.compounding_frequencies.items():
+            np.testing.assert_allclose(discount_factors(rates, years, frequency),
+                                       bonds.discount_kernel(rates, years, compounding)[0], rtol=1e-14)
+
+if __name__ == '__main__':
+    import sys
+    print(parallel_value_at_risk(sys.argv[1], [float(percentile) for percentile in sys.argv[2:]] or [95, 99]))
@@ -0,0 +1,503 @@
+'''Local pricing daemon for bond_stuff_in_progress.
+
+Importing bond_stuff_in_progress reads the curves and covariance, and every
+portfolio call rereads the csv and rebuilds the schedules. The daemon does
+that once and keeps the results warm, so repeat questions are answered from
+memory. An answer is recomputed once its portfolio file has changed, and
+when the day rolls over the curves and covariance are reread and every
+cached answer dropped. At most max_cached_results answers are kept, the
+least recently used going first.
+
+Requests are newline delimited JSON over a local socket, either a single
+request or a list of them answered as a batch:
+
+    {"id": 1, "method": "value_bond", "params": {"face_value": 10000.0,
+     "maturity_date": "2022-06-15", "coupon_rate": 2.5, "payments_per_year": 2,
+     "bond_rating": "AAA", "bond_type": "Corporate"}}
+
+The value_bond requests in a batch are priced together in one vectorized pass,
+and single value_bond/duration_bond/convexity_bond requests arriving from
+different clients within a couple of milliseconds are coalesced the same way.
+The same coalescing is available in process through value_bond_async,
+duration_bond_async and convexity_bond_async.
+
+Run with  python pricing_service.py [port] [portfolio csv to warm up ...]
+'''
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import bond_stuff_in_progress as bonds
+
+default_port = 8765
+
+max_cached_results = 256
+
+bond_fields = ['face_value', 'maturity_date', 'coupon_rate', 'payments_per_year', 'bond_rating', 'bond_type']
+
+coalesced_bond_methods = {
+    'value_bond':      ['Bond Value', 'Discount Rate'],
+    'duration_bond':   ['Bond Duration', 'Modified Duration'],
+    'convexity_bond':  ['Bond Convexity'],
+    }
+
+#One worker for all pricing, coalesced batches included: the bonds module
+#caches (payment schedules, parsed dates) and the instrumentation counters
+#are not locked, and the event loop only needs the work off its own thread
+pricing_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class PricingServiceError(Exception):
+    '''A class to implement error messages from class PricingService.'''
+    pass
+
+
+def to_json_value(value):
+    '''Turns numpy and pandas results into plain JSON values'''
+    if isinstance(value, pd.DataFrame):
+        return value.to_dict(orient='list')
+    if isinstance(value, pd.Series):
+        return value.tolist()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return dict((str(key), to_json_value(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    return value
+
+
+def price_bonds(bond_params):
+    '''Value, duration and convexity of any number of single bonds in one
+    pass over a flattened cash flow buffer, grouped by valuation date, day
+    count and compounding. bond_params is a list of value_bond keyword dicts
+    '''
+    results = [None] * len(bond_params)
+    groups = {}
+    for i, params in enumerate(bond_params):
+        group = (str(bonds.BankDate(params.get('as_of'))), params.get('day_count_convention', 'ACT/365F'),\
+                 params.get('compounding', 'Daily'))
+        groups.setdefault(group, []).append(i)
+    for (as_of, day_count_convention, compounding), positions in groups.items():
+        book = pd.DataFrame([dict((field, bond_params[i][field]) for field in bond_fields) for i in positions])
+        cashflows = bonds.portfolio_cashflows(book, day_count_convention=day_count_convention, as_of=as_of)
+        measures = bonds.cashflow_durations(cashflows, compounding).to_dict(orient='records')
+        for i, bond_measures in zip(positions, measures):
+            results[i] = bond_measures
+    return results
+
+
+def price_bonds_each(bond_params):
+    '''price_bonds, except that a bond that can't be priced gets its
+    exception back in its place rather than failing the others. The batch
+    is priced in one pass and only repriced bond by bond if that fails
+    '''
+    try:
+        return price_bonds(bond_params)
+    except Exception:
+        results = []
+        for params in bond_params:
+            try:
+                results.append(price_bonds([params])[0])
+            except Exception as error:
+                results.append(error)
+        return results
+
+
+class BatchCoalescer:
+    '''Collects the calls made within window seconds of each other and runs
+    them as one batch_function(list of params) call on an executor, so the
+    event loop stays free and a burst of single requests costs one pass.
+    A batch is sent early once it reaches max_batch. An exception returned
+    in place of a result fails that request alone
+    '''
+
+    def __init__(self, batch_function, window=0.002, max_batch=10000, executor=None):
+        self.batch_function = batch_function
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor or pricing_executor
+        self._pending = []
+        self._flush_handle = None
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, params):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((params, future))
+        self.requests += 1
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.batch_function,
+                                                 [params for params, future in batch])
+        except Exception as error:
+            for params, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (params, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+_bond_coalescer = None
+
+def bond_coalescer():
+    '''The shared coalescer behind the *_async pricing functions'''
+    global _bond_coalescer
+    if _bond_coalescer is None:
+        _bond_coalescer = BatchCoalescer(price_bonds_each)
+    return _bond_coalescer
+
+async def price_bond_async(face_value,maturity_date,coupon_rate,payments_per_year,bond_rating,bond_type,\
+                           day_count_convention='ACT/365F',as_of=None,compounding='Daily'):
+    return await bond_coalescer().submit({'face_value' : face_value, 'maturity_date' : maturity_date,
+                                          'coupon_rate' : coupon_rate, 'payments_per_year' : payments_per_year,
+                                          'bond_rating' : bond_rating, 'bond_type' : bond_type,
+                                          'day_count_convention' : day_count_convention, 'as_of' : as_of,
+                                          'compounding' : compounding})
+
+async def value_bond_async(*args, **kwargs):
+    '''Bond value as value_bond()[0], coalesced with concurrent calls'''
+    return (await price_bond_async(*args, **kwargs))['Bond Value']
+
+async def duration_bond_async(*args, **kwargs):
+    '''duration_bond, coalesced with concurrent calls'''
+    measures = await price_bond_async(*args, **kwargs)
+    return {'Bond Duration' : measures['Bond Duration'], 'Modified Duration' : measures['Modified Duration']}
+
+async def convexity_bond_async(*args, **kwargs):
+    '''convexity_bond, coalesced with concurrent calls'''
+    return (await price_bond_async(*args, **kwargs))['Bond Convexity']
+
+
+class PricingService:
+    '''Keeps portfolio results keyed by method and parameters, each held
+    with the portfolio file's modification time it was computed from
+    '''
+
+    def __init__(self):
+        self._results = OrderedDict()
+        self._var_upper_bounds = OrderedDict()
+        self.market_date = str(bonds.BankDate())
+        self.max_cached_results = max_cached_results
+        #The covariance state is saved for the next run on every rollover
+        self.save_covariance_state = True
+        #The last failed market data reload, None once a reload succeeds
+        self.market_data_error = None
+        self.hits = 0
+        self.misses = 0
+        self.portfolio_methods = {
+            'value_portfolio':              bonds.value_portfolio,
+            'portfolio_duration':           bonds.portfolio_duration,
+            'convexity_portfolio':          bonds.convexity_portfolio,
+            'analytics_portfolio':          bonds.analytics_portfolio,
+            'key_rate_duration_portfolio':  bonds.key_rate_duration_portfolio,
+            'value_at_risk_portfolio_set':  bonds.value_at_risk_portfolio_set,
+            }
+
+    def refresh_market_data(self):
+        '''Rereads the market data and drops every cached answer once the day
+        has rolled over, returns whether it did'''
+        today = str(bonds.BankDate())
+        if today == self.market_date:
+            return False
+        bonds.reload_market_data(self.save_covariance_state)
+        self._results.clear()
+        self._var_upper_bounds.clear()
+        self.market_date = today
+        self.market_data_error = None
+        return True
+
+    def refresh_market_data_or_keep(self):
+        '''refresh_market_data, answering from the data already loaded if
+        the reload fails. The failure shows in stats and the reload is tried
+        again on the next request'''
+        try:
+            return self.refresh_market_data()
+        except Exception as error:
+            self.market_data_error = '%s: %s' % (type(error).__name__, error)
+            return False
+
+    def _cached(self, cache, key, mtime, compute):
+        #Least recently used first, a changed file replaces its old answer
+        if key in cache and cache[key][0] == mtime:
+            self.hits += 1
+            cache.move_to_end(key)
+        else:
+            self.misses += 1
+            cache[key] = (mtime, compute())
+            cache.move_to_end(key)
+            while len(cache) > self.max_cached_results:
+                cache.popitem(last=False)
+        return cache[key][1]
+
+    def _portfolio_result(self, method, params):
+        csv_location = params.get('csv_location') or params.get('portfolio_csv_location')
+        if csv_location is None:
+            raise PricingServiceError('%s needs a csv_location' % method)
+        return self._cached(self._results, (method, json.dumps(params, sort_keys=True)),
+                            os.path.getmtime(csv_location), lambda: self.portfolio_methods[method](**params))
+
+    def value_at_risk_single_bond(self, params):
+        '''value_at_risk_single_bond, with the percentile bounds kept rather
+        than reread from the yield change csv on every call
+        '''
+        upper_bounds = self._cached(self._var_upper_bounds, (params['csv_location'], params['loss_percentile']),
+                                    os.path.getmtime(params['csv_location']),
+                                    lambda: bonds.value_at_risk_yield_change_upper_bound_by_rating(
+                                        params['csv_location'], params['loss_percentile']))
+        return bonds.value_at_risk_single_bond(upper_bounds=upper_bounds, **params)
+
+    def handle(self, request):
+        return self.handle_batch([request])[0]
+
+    def handle_batch(self, requests):
+        '''Answers a list of requests, value_bond ones in a single pass'''
+        self.refresh_market_data_or_keep()
+        responses = [None] * len(requests)
+        value_bond_positions = []
+        for i, request in enumerate(requests):
+            method = request.get('method')
+            params = request.get('params', {})
+            try:
+                if method == 'value_bond':
+                    value_bond_positions.append(i)
+                    continue
+                elif method in self.portfolio_methods:
+                    result = self._portfolio_result(method, params)
+                elif method == 'duration_bond':
+                    result = bonds.duration_bond(**params)
+                elif method == 'convexity_bond':
+                    result = bonds.convexity_bond(**params)
+                elif method == 'value_at_risk_single_bond':
+                    result = self.value_at_risk_single_bond(params)
+                elif method == 'stats':
+                    result = {'hits' : self.hits, 'misses' : self.misses, 'cached' : len(self._results),
+                              'coalesced_requests' : bond_coalescer().requests,
+                              'coalesced_batches' : bond_coalescer().batches,
+                              'market_data_error' : self.market_data_error}
+                else:
+                    raise PricingServiceError('Unknown method %s' % method)
+                responses[i] = {'id' : request.get('id'), 'result' : to_json_value(result)}
+            except Exception as error:
+                responses[i] = {'id' : request.get('id'), 'error' : '%s: %s' % (type(error).__name__, error)}
+        if value_bond_positions:
+            results = price_bonds_each([requests[i].get('params', {}) for i in value_bond_positions])
+            for i, result in zip(value_bond_positions, results):
+                if isinstance(result, Exception):
+                    responses[i] = {'id' : requests[i].get('id'), 'error' : '%s: %s' % (type(result).__name__, result)}
+                else:
+                    result = dict((field, result[field]) for field in coalesced_bond_methods['value_bond'])
+                    responses[i] = {'id' : requests[i].get('id'), 'result' : to_json_value(result)}
+        return responses
+
+    def warm(self, csv_locations):
+        '''Precomputes the portfolio figures so the first caller doesn't wait'''
+        for csv_location in csv_locations:
+            for method in ('value_portfolio', 'portfolio_duration', 'convexity_portfolio'):
+                self._portfolio_result(method, {'csv_location' : csv_location})
+
+    async def handle_async(self, request):
+        '''Single bond requests go through the shared coalescer, everything
+        else runs on the pricing executor
+        '''
+        method = request.get('method')
+        loop = asyncio.get_running_loop()
+        if str(bonds.BankDate()) != self.market_date:
+            await loop.run_in_executor(pricing_executor, self.refresh_market_data_or_keep)
+        if method in coalesced_bond_methods:
+            try:
+                measures = await bond_coalescer().submit(request.get('params', {}))
+            except Exception as error:
+                return {'id' : request.get('id'), 'error' : '%s: %s' % (type(error).__name__, error)}
+            result = dict((field, measures[field]) for field in coalesced_bond_methods[method])
+            if method == 'convexity_bond':
+                result = result['Bond Convexity']
+            return {'id' : request.get('id'), 'result' : to_json_value(result)}
+        return await loop.run_in_executor(pricing_executor, self.handle, request)
+
+    async def serve_client(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode())
+            except ValueError as error:
+                response = {'id' : None, 'error' : 'Bad request: %s' % error}
+            else:
+                if isinstance(request, list):
+                    loop = asyncio.get_running_loop()
+                    response = await loop.run_in_executor(pricing_executor, self.handle_batch, request)
+                else:
+                    response = await self.handle_async(request)
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+        writer.close()
+
+
+async def serve(port=default_port, warm_csv_locations=(), host='127.0.0.1'):
+    service = PricingService()
+    service.warm(warm_csv_locations)
+    server = await asyncio.start_server(service.serve_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def request(method, params=None, port=default_port, host='127.0.0.1'):
+    '''Blocking client call for scripts and the interpreter.
+    method can be a list of (method, params) pairs to send as one batch
+    '''
+    import socket
+    if isinstance(method, list):
+        payload = [{'id' : i, 'method' : name, 'params' : call_params or {}}
+                   for i, (name, call_params) in enumerate(method)]
+    else:
+        payload = {'id' : 0, 'method' : method, 'params' : params or {}}
+    with socket.create_connection((host, port)) as connection:
+        connection.sendall((json.dumps(payload) + '\n').encode())
+        response = connection.makefile().readline()
+    return json.loads(response)
+
+
+
+class test_suite(unittest.TestCase):
+    '''Tests for the coalescer and the batch handling'''
+
+    good_bond = {'face_value' : 10000.0, 'maturity_date' : str(bonds.BankDate() + '5y'), 'coupon_rate' : 3.0,
+                 'payments_per_year' : 2, 'bond_rating' : 'AA', 'bond_type' : 'Corporate'}
+
+    def test_coalescer_merges_concurrent_requests(self):
+        batches = []
+        def batch_function(params_list):
+            batches.append(list(params_list))
+            return [params['x'] * 2 for params in params_list]
+        async def submit_all():
+            coalescer = BatchCoalescer(batch_function, window=0.01)
+            return await asyncio.gather(*[coalescer.submit({'x' : x}) for x in range(5)])
+        self.assertEqual([0, 2, 4, 6, 8], asyncio.run(submit_all()))
+        self.assertEqual(1, len(batches))
+        self.assertEqual(5, len(batches[0]))
+
+    def test_coalescer_isolates_bad_requests(self):
+        bad_bond = dict(self.good_bond, maturity_date='not a date')
+        async def submit_all():
+            coalescer = BatchCoalescer(price_bonds_each, window=0.01)
+            return await asyncio.gather(coalescer.submit(self.good_bond), coalescer.submit(bad_bond),
+                                        coalescer.submit(self.good_bond), return_exceptions=True)
+        good, bad, good_again = asyncio.run(submit_all())
+        expected = bonds.value_bond(*[self.good_bond[field] for field in bond_fields])[0]
+        self.assertAlmostEqual(expected, good['Bond Value'], places=6)
+        self.assertAlmostEqual(expected, good_again['Bond Value'], places=6)
+        self.assertIsInstance(bad, Exception)
+
+    def test_batch_request_isolates_bad_requests(self):
+        responses = PricingService().handle_batch([
+            {'id' : 1, 'method' : 'value_bond', 'params' : self.good_bond},
+            {'id' : 2, 'method' : 'value_bond', 'params' : dict(self.good_bond, maturity_date='not a date')}])
+        self.assertIn('result', responses[0])
+        self.assertIn('error', responses[1])
+
+    def counting_service(self):
+        service = PricingService()
+        calls = []
+        def count(csv_location, tag=0):
+            calls.append(tag)
+            return len(calls)
+        service.portfolio_methods['count'] = count
+        return service, calls
+
+    def test_changed_portfolio_replaces_cached_answer(self):
+        service, calls = self.counting_service()
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            open(csv_location, 'w').close()
+            self.assertEqual(1, service._portfolio_result('count', {'csv_location' : csv_location}))
+            self.assertEqual(1, service._portfolio_result('count', {'csv_location' : csv_location}))
+            os.utime(csv_location, (0, os.path.getmtime(csv_location) + 10))
+            self.assertEqual(2, service._portfolio_result('count', {'csv_location' : csv_location}))
+        self.assertEqual(1, len(service._results))
+        self.assertEqual((1, 2), (service.hits, service.misses))
+
+    def test_cache_keeps_most_recently_used(self):
+        service, calls = self.counting_service()
+        service.max_cached_results = 2
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            open(csv_location, 'w').close()
+            for tag in [0, 1, 0, 2, 0, 1]:
+                service._portfolio_result('count', {'csv_location' : csv_location, 'tag' : tag})
+        self.assertEqual([0, 1, 2, 1], calls)
+        self.assertEqual(2, len(service._results))
+
+    def test_day_rollover_drops_cached_answers(self):
+        service, calls = self.counting_service()
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            open(csv_location, 'w').close()
+            service._portfolio_result('count', {'csv_location' : csv_location})
+        self.assertFalse(service.refresh_market_data())
+        self.assertEqual(1, len(service._results))
+        service.save_covariance_state = False
+        service.market_date = '1900-01-01'
+        self.assertTrue(service.refresh_market_data())
+        self.assertEqual(0, len(service._results))
+        self.assertEqual(str(bonds.BankDate()), service.market_date)
+
+    def test_failed_reload_keeps_answering(self):
+        service = PricingService()
+        service.save_covariance_state = False
+        service.market_date = '1900-01-01'
+        reload_market_data = bonds.reload_market_data
+        def failing_reload(save_state=False):
+            raise IOError('yield file missing')
+        bonds.reload_market_data = failing_reload
+        try:
+            for _ in range(2):
+                responses = service.handle_batch([{'id' : 1, 'method' : 'value_bond', 'params' : self.good_bond},
+                                                  {'id' : 2, 'method' : 'stats'}])
+                self.assertIn('result', responses[0])
+                self.assertEqual('OSError: yield file missing', responses[1]['result']['market_data_error'])
+        finally:
+            bonds.reload_market_data = reload_market_data
+        self.assertEqual('1900-01-01', service.market_date)
+        service.handle_batch([{'id' : 1, 'method' : 'stats'}])
+        self.assertIsNone(service.market_data_error)
+        self.assertEqual(str(bonds.BankDate()), service.market_date)
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else default_port
+    asyncio.run(serve(port, sys.argv[2:]))
@@ -0,0 +1,286 @@
+'''Backtesting of VaR models against the yield change history.
+
+A window of window days is rolled through the history. On every day after
+the first window the model gives its VaR from the days in the window only,
+and that is compared with the P&L the book would have made on the day
+(the current portfolio revalued under that day's yield changes). Losses
+beyond the VaR are exceptions, which are tested with
+    Kupiec             is the number of exceptions right for the percentile
+    Christoffersen     do exceptions cluster, ie does one make the next
+                       more likely
+    conditional        both together
+Each test gives a likelihood ratio, chi squared under a correct model, and
+its p-value.
+
+The window statistics are kept incrementally: RollingQuantile holds the
+window sorted and each day inserts the new value and drops the oldest, so
+no day re-sorts or re-percentiles its window from scratch.
+
+Models:
+    historical    percentile of the book's own P&L over the window
+    upper_bound   value_at_risk_single_bond's measure: each bond repriced at
+                  its maturity bucket's percentile yield rise over the
+                  window, summed over the book
+
+    import var_backtest
+    daily, summary = var_backtest.backtest_portfolio_var(csv_location, 99)
+'''
+
+from bisect import bisect_left, insort
+from collections import deque
+from math import erfc, exp, log, sqrt
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import bond_stuff_in_progress as bonds
+from parallel_var import default_yield_change_csv_location
+
+
+class RollingQuantile:
+    '''Percentiles of the last window values added, interpolated like
+    np.percentile. Values are kept sorted, so an update is a binary search
+    plus one insert and one delete, and a percentile is a lookup. Values
+    that aren't finite are skipped, nan would break the sort order.'''
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.sorted_values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def update(self, value):
+        if not np.isfinite(value):
+            return
+        self.values.append(value)
+        insort(self.sorted_values, value)
+        if len(self.values) > self.window:
+            del self.sorted_values[bisect_left(self.sorted_values, self.values.popleft())]
+
+    def percentile(self, percentile):
+        position = percentile / 100 * (len(self.sorted_values) - 1)
+        below = int(position)
+        above = min(below + 1, len(self.sorted_values) - 1)
+        return self.sorted_values[below] + (position - below) * (self.sorted_values[above] - self.sorted_values[below])
+
+
+def historical_var_forecasts(pnl, window, loss_percentile):
+    '''VaR for every day from the P&L of the window of days before it, nan
+    until a full window has been seen'''
+    rolling = RollingQuantile(window)
+    forecasts = np.full(len(pnl), np.nan)
+    for day, day_pnl in enumerate(pnl):
+        if len(rolling) == window:
+            forecasts[day] = -rolling.percentile(100 - loss_percentile)
+        rolling.update(day_pnl)
+    return forecasts
+
+
+def historical_var_model(cashflows, yield_changes, pnl, window, loss_percentile):
+    return historical_var_forecasts(pnl, window, loss_percentile)
+
+
+def upper_bound_var_model(cashflows, yield_changes, pnl, window, loss_percentile, max_chunk_size=5000000):
+    '''VaR for every day as the sum over the book of each bond's loss when
+    its discount rate rises by its bucket column's loss_percentile yield
+    change over the window of days before (the bound
+    value_at_risk_yield_change_upper_bound_by_rating gives for the whole
+    history). Bonds whose bucket isn't quoted count for nothing'''
+    columns = [column for column in yield_changes.columns if column != 'Date']
+    column_numbers = dict((column, i) for i, column in enumerate(columns))
+    maturity_years = (cashflows['maturity_ordinals'] - cashflows['valuation_ordinal']) / 365
+    bucket_tenors = bonds.tenor_bucket(maturity_years)
+    bucket_columns = np.array([column_numbers.get(tenor + '_' + str(rating), -1)\
+                               for tenor, rating in zip(bucket_tenors, cashflows['bond_ratings'])], dtype=np.int64)
+    rolling = [RollingQuantile(window) for column in columns]
+    upper_bounds = np.full((len(yield_changes), len(columns)), np.nan)
+    for day, changes in enumerate(yield_changes[columns].to_numpy(dtype=np.float64)):
+        upper_bounds[day] = [column_quantile.percentile(loss_percentile) if len(column_quantile) == window else np.nan\
+                             for column_quantile in rolling]
+        for column_quantile, change in zip(rolling, changes):
+            column_quantile.update(change)
+    forecasts = np.full(len(yield_changes), np.nan)
+    #A day is forecast once every column the book uses has a full window of changes
+    used_columns = np.unique(bucket_columns[bucket_columns >= 0])
+    forecast_days = np.flatnonzero(np.isfinite(upper_bounds[:, used_columns]).all(axis=1))
+    if len(forecast_days):
+        rate_shifts = np.where(bucket_columns >= 0, upper_bounds[forecast_days][:, np.maximum(bucket_columns, 0)], 0.0)
+        base_vals = bonds.price_cashflows(cashflows)
+        forecasts[forecast_days] = (base_vals - bonds.shifted_values(cashflows, rate_shifts, max_chunk_size)).sum(axis=1)
+    return forecasts
+
+
+var_models = {'historical' : historical_var_model,
+              'upper_bound' : upper_bound_var_model}
+
+
+def chi_squared_p_value(statistic, degrees_of_freedom):
+    '''Upper tail of the chi squared distribution with 1 or 2 degrees of freedom'''
+    if degrees_of_freedom == 1:
+        return erfc(sqrt(max(statistic, 0.0) / 2))
+    if degrees_of_freedom == 2:
+        return exp(-max(statistic, 0.0) / 2)
+    raise ValueError('Only 1 or 2 degrees of freedom are supported')
+
+
+def _log_likelihood(misses, hits, probability):
+    #Bernoulli log likelihood with 0 * log(0) taken as 0
+    likelihood = 0.0
+    if misses:
+        likelihood += misses * log(1 - probability)
+    if hits:
+        likelihood += hits * log(probability)
+    return likelihood
+
+
+def kupiec_test(exceptions, observations, loss_percentile):
+    '''Kupiec proportion of failures likelihood ratio and its p-value'''
+    expected_rate = 1 - loss_percentile / 100
+    observed_rate = exceptions / observations if observations else 0.0
+    statistic = -2 * (_log_likelihood(observations - exceptions, exceptions, expected_rate)\
+                      - _log_likelihood(observations - exceptions, exceptions, observed_rate))
+    return statistic, chi_squared_p_value(statistic, 1)
+
+
+def christoffersen_test(exception_flags):
+    '''Christoffersen independence likelihood ratio and its p-value, from
+    the day to day transitions between exceptions and quiet days'''
+    flags = np.asarray(exception_flags, dtype=bool)
+    previous, current = flags[:-1], flags[1:]
+    n00 = int(np.sum(~previous & ~current))
+    n01 = int(np.sum(~previous & current))
+    n10 = int(np.sum(previous & ~current))
+    n11 = int(np.sum(previous & current))
+    transitions = n00 + n01 + n10 + n11
+    if not transitions:
+        return 0.0, 1.0
+    pi = (n01 + n11) / transitions
+    pi0 = n01 / (n00 + n01) if n00 + n01 else 0.0
+    pi1 = n11 / (n10 + n11) if n10 + n11 else 0.0
+    statistic = -2 * (_log_likelihood(n00 + n10, n01 + n11, pi)\
+                      - _log_likelihood(n00, n01, pi0) - _log_likelihood(n10, n11, pi1))
+    return statistic, chi_squared_p_value(statistic, 1)
+
+
+def backtest_value_at_risk(var_forecasts, pnl, loss_percentile, dates=None):
+    '''Compares VaR forecasts with the P&L realised on the same days (days
+    without a forecast are skipped). Returns the daily frame and a summary
+    of exceptions and test statistics'''
+    var_forecasts = np.asarray(var_forecasts, dtype=np.float64)
+    pnl = np.asarray(pnl, dtype=np.float64)
+    tested = np.isfinite(var_forecasts)
+    exceptions = -pnl > var_forecasts
+    daily = pd.DataFrame({'VaR' : var_forecasts, 'P&L' : pnl, 'Exception' : exceptions & tested},\
+                         index=dates)[tested]
+    observations = int(tested.sum())
+    exception_count = int(daily['Exception'].sum())
+    kupiec_statistic, kupiec_p_value = kupiec_test(exception_count, observations, loss_percentile)
+    christoffersen_statistic, christoffersen_p_value = christoffersen_test(daily['Exception'].values)
+    conditional_statistic = kupiec_statistic + christoffersen_statistic
+    summary = {'Observations' : observations,
+               'Exceptions' : exception_count,
+               'Expected Exceptions' : observations * (1 - loss_percentile / 100),
+               'Exception Rate' : exception_count / observations if observations else np.nan,
+               'Kupiec LR' : kupiec_statistic,
+               'Kupiec p-value' : kupiec_p_value,
+               'Christoffersen LR' : christoffersen_statistic,
+               'Christoffersen p-value' : christoffersen_p_value,
+               'Conditional Coverage LR' : conditional_statistic,
+               'Conditional Coverage p-value' : chi_squared_p_value(conditional_statistic, 2)}
+    return daily, summary
+
+
+def backtest_portfolio_var(portfolio_csv_location, loss_percentile, window=250, model='historical',\
+                           yield_change_csv_location=None, day_count_convention='ACT/365F', as_of=None):
+    '''Backtests a VaR model (a key of var_models) for the portfolio over the
+    yield change history, oldest day first. The realised P&L of a day is
+    the book revalued under that day's changes through its key rate weights'''
+    if model not in var_models:
+        raise ValueError('Unknown VaR model: %s' % model)
+    if yield_change_csv_location is None:
+        yield_change_csv_location = default_yield_change_csv_location
+    yield_changes = bonds.generate_yield_comparison_table_raw(yield_change_csv_location)
+    #Ordered as dates, the strings needn't be zero padded
+    yield_changes = yield_changes.iloc[np.argsort(bonds.iso_date_ordinals(yield_changes['Date'], 'Date'), kind='stable')]\
+                    .reset_index(drop=True)
+    portfolio = bonds.generate_portfolio(portfolio_csv_location)
+    cashflows = bonds.portfolio_cashflows(portfolio, day_count_convention=day_count_convention, as_of=as_of)
+    pnl = (bonds.scenario_values(cashflows, yield_changes) - bonds.price_cashflows(cashflows)).sum(axis=1)
+    forecasts = var_models[model](cashflows, yield_changes, pnl, window, loss_percentile)
+    return backtest_value_at_risk(forecasts, pnl, loss_percentile, dates=list(yield_changes['Date']))
+
+
+class test_suite(unittest.TestCase):
+
+    def test_kupiec_test(self):
+        #5 exceptions in 250 days at 99%: LR = -2*(245*log(.99) + 5*log(.01) - 245*log(.98) - 5*log(.02))
+        statistic, p_value = kupiec_test(5, 250, 99)
+        self.assertAlmostEqual(1.9568098, statistic, places=6)
+        self.assertAlmostEqual(0.1618549, p_value, places=6)
+        self.assertEqual((0.0, 1.0), kupiec_test(10, 1000, 99))
+        #The 5% critical values of chi squared with 1 and 2 degrees of freedom
+        self.assertAlmostEqual(0.05, chi_squared_p_value(3.8414588, 1), places=8)
+        self.assertAlmostEqual(0.05, chi_squared_p_value(5.9914645, 2), places=8)
+
+    def test_christoffersen_test(self):
+        #n00 = 10, n01 = 3, n10 = 3, n11 = 3:
+        #LR = -2*(13*log(13/19) + 6*log(6/19) - 10*log(10/13) - 3*log(3/13) - 6*log(1/2))
+        flags = [0, 0, 1, 1, 0, 0, 0, 1, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0]
+        statistic, p_value = christoffersen_test(flags)
+        self.assertAlmostEqual(1.3358104, statistic, places=6)
+        self.assertAlmostEqual(0.2477742, p_value, places=6)
+        self.assertEqual((0.0, 1.0), christoffersen_test([1]))
+
+    def test_rolling_quantile_matches_percentile(self):
+        values = np.random.RandomState(3).standard_normal(400)
+        values[[17, 90, 91, 250]] = [np.nan, np.inf, np.nan, -np.inf]
+        finite = values[np.isfinite(values)]
+        rolling = RollingQuantile(60)
+        seen = 0
+        for value in values:
+            rolling.update(value)
+            if np.isfinite(value):
+                seen += 1
+            window = finite[max(seen - 60, 0):seen]
+            self.assertEqual(len(window), len(rolling))
+            if len(window):
+                for percentile in [1, 5, 50, 99]:
+                    self.assertAlmostEqual(np.percentile(window, percentile), rolling.percentile(percentile), places=12)
+
+    def test_backtest_portfolio_var(self):
+        portfolio = pd.DataFrame({'face_value' : [10000.0, 25000.0], 'coupon_rate' : [3.0, 4.5],
+                                  'maturity_date' : [str(bonds.BankDate() + tenor) for tenor in ['3y', '8y']],
+                                  'payments_per_year' : [2, 1], 'bond_rating' : ['AA', 'A'],
+                                  'bond_type' : ['Corporate', 'Corporate']})
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            portfolio.to_csv(csv_location, index=False)
+            daily, summary = backtest_portfolio_var(csv_location, 95, window=100)
+        yield_changes = bonds.generate_yield_comparison_table_raw(default_yield_change_csv_location)
+        yield_changes = yield_changes.iloc[np.argsort(bonds.iso_date_ordinals(yield_changes['Date']))].reset_index(drop=True)
+        cashflows = bonds.portfolio_cashflows(portfolio)
+        pnl = (bonds.scenario_values(cashflows, yield_changes) - bonds.price_cashflows(cashflows)).sum(axis=1)
+        self.assertEqual(len(pnl) - 100, summary['Observations'])
+        np.testing.assert_allclose(pnl[100:], daily['P&L'].values)
+        np.testing.assert_allclose([-np.percentile(pnl[day - 100:day], 5) for day in range(100, len(pnl))],
+                                   daily['VaR'].values, rtol=1e-12)
+        self.assertEqual(int(np.sum(-pnl[100:] > daily['VaR'].values)), summary['Exceptions'])
+        self.assertEqual(kupiec_test(summary['Exceptions'], summary['Observations'], 95),
+                         (summary['Kupiec LR'], summary['Kupiec p-value']))
+        #The same history with unpadded dates in a shuffled file backtests the same
+        shuffled = yield_changes.sample(frac=1, random_state=2)
+        shuffled['Date'] = ['%d-%d-%d' % (day.year, day.month, day.day) for day in map(bonds.BankDate, shuffled['Date'])]
+        with tempfile.TemporaryDirectory() as directory:
+            csv_location = os.path.join(directory, 'portfolio.csv')
+            yield_change_csv_location = os.path.join(directory, 'yield_changes.csv')
+            portfolio.to_csv(csv_location, index=False)
+            shuffled.to_csv(yield_change_csv_location, index=False)
+            unpadded_daily, unpadded_summary = backtest_portfolio_var(csv_location, 95, window=100,
+                                                                      yield_change_csv_location=yield_change_csv_location)
+        np.testing.assert_allclose(daily[['VaR', 'P&L']].values, unpadded_daily[['VaR', 'P&L']].values, rtol=1e-12)
+        self.assertEqual(summary, unpadded_summary)